@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2019 Leiden University Medical Center
+# This file is part of git-synchronizer
+#
+# git-synchronizer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# git-synchronizer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
+
+"""
+Benchmark for git-synchronizer.
+
+Generates synthetic bare repositories, serves them over file://, a local
+git daemon or git http-backend, optionally with extra latency, and times
+git-synchronizer runs with different thread counts. Every run is done in a
+separate process, so the peak RSS of each run can be measured.
+"""
+
+import argparse
+import contextlib
+import http.server
+import json
+import os
+import random
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, cast
+
+
+def generate_repo(path: Path, commits: int, branches: int, tags: int,
+                  blob_size: int, seed: int):
+    """
+    Creates a bare repository with the given number of commits on master,
+    branches and annotated tags pointing at random commits, and a blob of
+    blob_size random bytes in every commit. Uses git fast-import.
+    """
+    subprocess.run(["git", "init", "--bare", "--quiet", str(path)],
+                   check=True)
+    rng = random.Random(seed)
+    stream = []  # type: List[bytes]
+    timestamp = 1556000000
+    for commit in range(commits):
+        data = bytes(rng.getrandbits(8) for _ in range(blob_size))
+        message = "Commit {0}\n".format(commit).encode("utf-8")
+        stream.append(b"blob\nmark :%d\ndata %d\n%s\n" % (
+            2 * commit + 1, len(data), data))
+        stream.append(b"commit refs/heads/master\nmark :%d\n" % (
+            2 * commit + 2))
+        stream.append(b"committer Benchmark <benchmark@example.com> "
+                      b"%d +0000\n" % (timestamp + commit))
+        stream.append(b"data %d\n%s" % (len(message), message))
+        if commit > 0:
+            stream.append(b"from :%d\n" % (2 * commit))
+        stream.append(b"M 100644 :%d file%d.bin\n\n" % (
+            2 * commit + 1, commit % 10))
+    for branch in range(branches):
+        stream.append(b"reset refs/heads/branch-%d\nfrom :%d\n\n" % (
+            branch, 2 * rng.randrange(commits) + 2))
+    for tag in range(tags):
+        message = "Tag {0}\n".format(tag).encode("utf-8")
+        stream.append(b"tag v%d\nfrom :%d\n" % (
+            tag, 2 * rng.randrange(commits) + 2))
+        stream.append(b"tagger Benchmark <benchmark@example.com> "
+                      b"%d +0000\n" % timestamp)
+        stream.append(b"data %d\n%s\n" % (len(message), message))
+    subprocess.run(["git", "fast-import", "--quiet"], cwd=str(path),
+                   input=b"".join(stream), check=True)
+
+
+def new_mirror(path: Path):
+    subprocess.run(["git", "init", "--bare", "--quiet", str(path)],
+                   check=True)
+    # Allow pushes through git http-backend.
+    subprocess.run(["git", "config", "http.receivepack", "true"],
+                   cwd=str(path), check=True)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def read_chunked(rfile) -> bytes:
+    """Reads a body with Transfer-Encoding: chunked."""
+    body = []  # type: List[bytes]
+    while True:
+        size = int(rfile.readline().split(b";")[0].strip(), 16)
+        if size == 0:
+            rfile.readline()
+            return b"".join(body)
+        body.append(rfile.read(size))
+        rfile.readline()
+
+
+class GitHTTPHandler(http.server.BaseHTTPRequestHandler):
+    """Serves repositories with git http-backend, like a CGI server."""
+
+    def _handle(self):
+        server = cast(GitHTTPServer, self.server)
+        time.sleep(server.latency)
+        path, _, query = self.path.partition("?")
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = read_chunked(self.rfile)
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length",
+                                                        0)))
+        environment = dict(
+            os.environ,
+            GIT_PROJECT_ROOT=str(server.root),
+            GIT_HTTP_EXPORT_ALL="1",
+            PATH_INFO=path,
+            QUERY_STRING=query,
+            REQUEST_METHOD=self.command,
+            CONTENT_TYPE=self.headers.get("Content-Type", ""),
+            CONTENT_LENGTH=str(len(body)),
+            HTTP_CONTENT_ENCODING=self.headers.get("Content-Encoding", ""),
+            GIT_PROTOCOL=self.headers.get("Git-Protocol", ""),
+            REMOTE_USER="benchmark",
+            REMOTE_ADDR="127.0.0.1")
+        output = subprocess.run(["git", "http-backend"], input=body,
+                                env=environment,
+                                stdout=subprocess.PIPE).stdout
+        separator = b"\r\n\r\n" if b"\r\n\r\n" in output else b"\n\n"
+        header_block, _, content = output.partition(separator)
+        status = 200
+        headers = []
+        for line in header_block.decode("latin-1").splitlines():
+            name, _, value = line.partition(":")
+            if name.lower() == "status":
+                status = int(value.strip().split()[0])
+            elif name:
+                headers.append((name, value.strip()))
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GitHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root: Path, latency: float):
+        super().__init__(("127.0.0.1", 0), GitHTTPHandler)
+        self.root = root
+        self.latency = latency
+
+
+class LatencyProxy(object):
+    """TCP proxy that delays every new connection by latency seconds."""
+
+    def __init__(self, target_port: int, latency: float):
+        self.target_port = target_port
+        self.latency = latency
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._connect, args=(client,),
+                             daemon=True).start()
+
+    def _connect(self, client: socket.socket):
+        time.sleep(self.latency)
+        upstream = socket.create_connection(("127.0.0.1", self.target_port))
+        threading.Thread(target=self._pump, args=(client, upstream),
+                         daemon=True).start()
+        self._pump(upstream, client)
+
+    @staticmethod
+    def _pump(source: socket.socket, destination: socket.socket):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                destination.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for sock in (source, destination):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def close(self):
+        self.sock.close()
+
+
+class Server(object):
+    """Serves the repositories in root over the given transport."""
+
+    def __init__(self, root: Path, transport: str, latency: float):
+        self.root = root
+        self.transport = transport
+        self.latency = latency
+        self._stack = contextlib.ExitStack()
+        self.base_url = "file://" + str(root.absolute())
+
+    def __enter__(self):
+        if self.transport == "git":
+            port = free_port()
+            process = subprocess.Popen(
+                ["git", "daemon", "--reuseaddr", "--export-all",
+                 "--enable=receive-pack", "--listen=127.0.0.1",
+                 "--port={0}".format(port),
+                 "--base-path={0}".format(self.root), str(self.root)],
+                stderr=subprocess.DEVNULL)
+            self._stack.callback(process.wait)
+            self._stack.callback(process.terminate)
+            for _ in range(100):
+                try:
+                    socket.create_connection(("127.0.0.1", port)).close()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+            if self.latency > 0:
+                proxy = LatencyProxy(port, self.latency)
+                self._stack.callback(proxy.close)
+                port = proxy.port
+            self.base_url = "git://127.0.0.1:{0}".format(port)
+        elif self.transport == "http":
+            http_server = GitHTTPServer(self.root, self.latency)
+            threading.Thread(target=http_server.serve_forever,
+                             daemon=True).start()
+            self._stack.callback(http_server.server_close)
+            self._stack.callback(http_server.shutdown)
+            self.base_url = "http://127.0.0.1:{0}".format(
+                http_server.server_address[1])
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stack.close()
+
+    def url(self, name: str) -> str:
+        return "{0}/{1}".format(self.base_url, name)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = max(int(round(fraction * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def run_synchronizer(config: Path, clone_dir: Path, threads: int,
+                     extra_args: List[str]) -> Dict[str, float]:
+    """Runs git-synchronizer in a separate process and measures it."""
+    metrics_file = clone_dir.parent / Path(clone_dir.name + ".jsonl")
+    if metrics_file.exists():
+        metrics_file.unlink()
+    command = [sys.executable, "-m", "git_synchronizer.git_synchronizer",
+               "--clone-dir", str(clone_dir), "--config", str(config),
+               "--threads", str(threads),
+               "--metrics-json", str(metrics_file)] + extra_args
+    start = time.monotonic()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    _, exit_status, usage = os.wait4(process.pid, 0)
+    wall_time = time.monotonic() - start
+    # Popen must not wait for the process it no longer owns.
+    process.returncode = exit_status
+    if exit_status != 0:
+        raise RuntimeError("git-synchronizer failed: {0}".format(command))
+    records = [json.loads(line) for line in
+               metrics_file.read_text().splitlines()]
+    latencies = [record["durations"].get("total", 0.0)
+                 for record in records]
+    return {
+        "wall_seconds": wall_time,
+        "repos_per_second": len(records) / wall_time,
+        "p50_seconds": percentile(latencies, 0.50),
+        "p99_seconds": percentile(latencies, 0.99),
+        # ru_maxrss is in KiB on Linux. It covers the synchronizer and the
+        # git processes it waited for.
+        "peak_rss_mib": usage.ru_maxrss / 1024,
+    }
+
+
+def argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repos", type=int, default=20,
+                        help="Number of source repositories.")
+    parser.add_argument("--mirrors", type=int, default=2,
+                        help="Number of mirrors per repository.")
+    parser.add_argument("--commits", type=int, default=50,
+                        help="Number of commits per repository.")
+    parser.add_argument("--branches", type=int, default=5,
+                        help="Number of extra branches per repository.")
+    parser.add_argument("--tags", type=int, default=20,
+                        help="Number of annotated tags per repository.")
+    parser.add_argument("--blob-size", type=int, default=1024,
+                        dest="blob_size",
+                        help="Size in bytes of the random blob in every "
+                             "commit.")
+    parser.add_argument("--threads", type=int, nargs="+",
+                        default=[1, 2, 4, 8],
+                        help="Thread counts to benchmark.")
+    parser.add_argument("--transport", choices=["file", "git", "http"],
+                        default="file",
+                        help="How the repositories are served. 'git' uses "
+                             "git daemon, 'http' uses git http-backend.")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds of extra latency for every connection "
+                             "(git) or request (http).")
+    parser.add_argument("--work-dir", type=Path, dest="work_dir",
+                        help="Directory for the generated repositories. "
+                             "Default: a temporary directory that is "
+                             "removed afterwards.")
+    parser.add_argument("--output", type=Path,
+                        help="Write the results as JSON to this file.")
+    parser.add_argument("extra_args", nargs=argparse.REMAINDER,
+                        help="Arguments after -- are passed to "
+                             "git-synchronizer, for instance "
+                             "-- --ref-diff-push.")
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    extra_args = [arg for arg in args.extra_args if arg != "--"]
+    work_dir = args.work_dir or Path(tempfile.mkdtemp(prefix="benchmark"))
+    served = work_dir / Path("served")
+    served.mkdir(parents=True, exist_ok=True)
+    for repo in range(args.repos):
+        generate_repo(served / Path("source{0}.git".format(repo)),
+                      args.commits, args.branches, args.tags, args.blob_size,
+                      seed=repo)
+    results = []  # type: List[dict]
+    print("{0:<6}{1:>8}{2:>6}{3:>10}{4:>10}{5:>10}{6:>10}{7:>10}".format(
+        "proto", "threads", "run", "wall s", "repos/s", "p50 s", "p99 s",
+        "RSS MiB"))
+    try:
+        with Server(served, args.transport, args.latency) as server:
+            for threads in args.threads:
+                name = "threads{0}".format(threads)
+                config_lines = []  # type: List[str]
+                for repo in range(args.repos):
+                    mirror_names = ["{0}-source{1}-mirror{2}.git".format(
+                        name, repo, mirror) for mirror in range(args.mirrors)]
+                    for mirror_name in mirror_names:
+                        new_mirror(served / Path(mirror_name))
+                    config_lines.append("\t".join(
+                        [server.url("source{0}.git".format(repo))] +
+                        [server.url(mirror_name)
+                         for mirror_name in mirror_names]))
+                config = work_dir / Path(name + ".tsv")
+                config.write_text("\n".join(config_lines) + "\n")
+                clone_dir = work_dir / Path(name)
+                # The cold run clones and pushes everything, the warm run
+                # finds nothing to do.
+                for run in ("cold", "warm"):
+                    measurements = run_synchronizer(config, clone_dir,
+                                                    threads, extra_args)
+                    print("{0:<6}{1:>8}{2:>6}".format(
+                        args.transport, threads, run) +
+                        "{wall_seconds:>10.2f}{repos_per_second:>10.2f}"
+                        "{p50_seconds:>10.3f}{p99_seconds:>10.3f}"
+                        "{peak_rss_mib:>10.1f}".format(**measurements),
+                        flush=True)
+                    result = dict(measurements, transport=args.transport,
+                                  latency=args.latency, threads=threads,
+                                  run=run)
+                    results.append(result)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(str(work_dir), ignore_errors=True)
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
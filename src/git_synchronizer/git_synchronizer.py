@@ -17,11 +17,37 @@
 # along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
 
 import argparse
+import asyncio
+import base64
+import concurrent.futures
+import contextlib
+import fcntl
+import fnmatch
+import functools
 import hashlib
+import heapq
+import hmac
+import http.server
+import json
+import os
 import queue
+import random
+import re
+import shlex
+import shutil
+import signal
+import socketserver
+import sqlite3
+import subprocess
+import sys
+import tempfile
 import threading
+import time
+import urllib.parse
+import urllib.request
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    TextIO, Tuple, cast)
 
 import git
 
@@ -32,6 +58,1100 @@ def string_to_md5(string: str) -> str:
     return hasher.hexdigest()
 
 
+def parse_refs(output: str) -> Dict[str, str]:
+    """Parses "sha<tab>ref" lines into a dictionary of ref name -> sha."""
+    refs = {}  # type: Dict[str, str]
+    for line in output.splitlines():
+        sha, ref = line.split('\t', 1)
+        refs[ref] = sha
+    return refs
+
+
+def ls_remote(url: str, timeout: Optional[float] = None) -> Dict[str, str]:
+    """
+    Returns a dictionary of ref name -> sha as advertised by url. git is
+    killed after timeout seconds.
+    """
+    return parse_refs(str(git.cmd.Git().ls_remote(
+        url, kill_after_timeout=timeout)))
+
+
+def refs_fingerprint(refs: Dict[str, str], mirror_urls: List[str]) -> str:
+    """
+    Returns a hash of the refs of the main url and the configured mirror
+    urls. If this does not change between runs there is nothing to
+    synchronize.
+    """
+    lines = ["{0}\t{1}".format(sha, ref) for ref, sha in
+             sorted(refs.items())]
+    # Adding a mirror should trigger a sync even if the source did not
+    # change.
+    lines.extend(sorted(mirror_urls))
+    return string_to_md5("\n".join(lines))
+
+
+# Matches scp-like urls such as git@github.com:LUMC/git-synchronizer.git
+SCP_URL_REGEX = re.compile(r"^(?:(?P<user>[^@/]+)@)?(?P<host>[^:/]+):")
+
+
+def url_host(url: str) -> Optional[str]:
+    """
+    Returns the host of a git url or None for local repositories.
+    """
+    if "://" in url:
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme == "file":
+            return None
+        return parsed.hostname
+    match = SCP_URL_REGEX.match(url)
+    if match:
+        return match.group("host")
+    return None
+
+
+def ssh_destination(url: str) -> Optional[Tuple[str, Optional[int]]]:
+    """
+    Returns the ssh destination ([user@]host) and port of a git url or None
+    if git does not use ssh for the url.
+    """
+    if "://" in url:
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ("ssh", "git+ssh", "ssh+git"):
+            return None
+        destination = parsed.hostname  # type: Optional[str]
+        if destination is None:
+            return None
+        if parsed.username:
+            destination = "{0}@{1}".format(parsed.username, destination)
+        return destination, parsed.port
+    match = SCP_URL_REGEX.match(url)
+    if match:
+        if match.group("user"):
+            return "{0}@{1}".format(match.group("user"),
+                                    match.group("host")), None
+        return match.group("host"), None
+    return None
+
+
+def normalize_url(url: str) -> str:
+    """
+    Returns host/path for a git url, so the https and ssh urls of the same
+    repository can be compared.
+    https://github.com/LUMC/git-synchronizer.git -> github.com/LUMC/git-synchronizer
+    git@github.com:LUMC/git-synchronizer.git -> github.com/LUMC/git-synchronizer
+    """  # noqa: E501
+    host = url_host(url)
+    if "://" in url:
+        path = urllib.parse.urlsplit(url).path
+    elif host is not None:
+        path = url.split(":", 1)[1]
+    else:
+        path = url
+    path = path.strip("/")
+    if path.endswith(".git"):
+        path = path[:-len(".git")]
+    if host is None:
+        return path
+    return "{0}/{1}".format(host.lower(), path)
+
+
+def shard_of(source_url: str, shard_count: int) -> int:
+    """
+    Returns the shard in range(shard_count) that mirrors source_url. This
+    uses rendezvous hashing: the shard with the highest hash of shard and
+    url wins. When a shard is added only the repos that the new shard wins
+    move, about 1/shard_count of them, so the other hosts keep their clones.
+    """
+    normalized_url = normalize_url(source_url)
+    return max(range(shard_count), key=lambda shard: string_to_md5(
+        "{0}\t{1}".format(shard, normalized_url)))
+
+
+class HostLimiter(object):
+    """
+    Limits the number of git operations that are performed on the same
+    remote host at the same time. Shared by all threads.
+    """
+
+    def __init__(self, max_per_host: int = 0):
+        # 0 means no limit.
+        self.max_per_host = max_per_host
+        self._semaphores = {}  # type: Dict[str, threading.Semaphore]
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def limit(self, url: str) -> Iterator[None]:
+        """Waits until an operation on the host of url is allowed."""
+        host = url_host(url)
+        if self.max_per_host < 1 or host is None:
+            yield
+            return
+        with self._lock:
+            semaphore = self._semaphores.setdefault(
+                host, threading.Semaphore(self.max_per_host))
+        with semaphore:
+            yield
+
+
+# Messages of git, ssh and curl for failures to reach a host, as opposed to
+# errors such as a rejected push or a missing repository.
+CONNECTION_ERROR_REGEX = re.compile("|".join([
+    "Could not resolve host", "Temporary failure in name resolution",
+    "Connection refused", "Connection timed out", "Connection reset",
+    "Operation timed out", "No route to host", "Network is unreachable",
+    "Failed to connect", "The remote end hung up unexpectedly",
+    "unexpected disconnect", "early EOF", "RPC failed",
+    r"The requested URL returned error: 5\d\d"]))
+
+
+def is_connection_error(error: Exception) -> bool:
+    return (isinstance(error, git.GitCommandError) and
+            CONNECTION_ERROR_REGEX.search(str(error.stderr)) is not None)
+
+
+# The phases that can have a timeout. check is the ls-remote of the main
+# url and push is every single push to a mirror.
+TIMEOUT_PHASES = ("check", "clone", "fetch", "push")
+
+# Message of git.Git.execute when it killed git after kill_after_timeout.
+TIMEOUT_REGEX = re.compile("did not complete in")
+
+
+class OperationTimeout(git.GitError):
+    """A git operation did not complete within the timeout of its phase."""
+
+
+def parse_timeout(value: str) -> Tuple[str, float]:
+    """Parses a phase=seconds command line argument."""
+    phase, _, seconds = value.partition("=")
+    if phase not in TIMEOUT_PHASES:
+        raise argparse.ArgumentTypeError(
+            "phase must be one of {0}".format(", ".join(TIMEOUT_PHASES)))
+    try:
+        return phase, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "'{0}' is not a number of seconds".format(seconds))
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of connecting to a host that is considered down."""
+
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive connection failures per remote host. Shared by all
+    workers. After failure_threshold consecutive failures the circuit of the
+    host opens: operations on the host fail fast with CircuitOpenError
+    instead of waiting for git's network timeout. After reset_timeout
+    seconds one operation is let through to test the host again.
+
+    Connection failures are retried up to retries times, after a random
+    delay of up to backoff * 2 ** attempt seconds.
+    """
+
+    def __init__(self, failure_threshold: int = 0,
+                 reset_timeout: float = 300, retries: int = 0,
+                 backoff: float = 1.0):
+        # 0 means the circuit never opens.
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.retries = retries
+        self.backoff = backoff
+        # host -> number of consecutive connection failures
+        self._failures = {}  # type: Dict[str, int]
+        # host -> time the circuit was opened or last tested
+        self._opened_at = {}  # type: Dict[str, float]
+        self._lock = threading.Lock()
+
+    def is_open(self, url: str) -> bool:
+        host = url_host(url)
+        with self._lock:
+            return host in self._opened_at
+
+    def check(self, url: str):
+        """Raises CircuitOpenError if operations on url should fail fast."""
+        host = url_host(url)
+        if host is None:
+            return
+        with self._lock:
+            opened_at = self._opened_at.get(host)
+            if opened_at is None:
+                return
+            if time.monotonic() - opened_at < self.reset_timeout:
+                raise CircuitOpenError(
+                    "Skipped {0}: {1} is unavailable".format(url, host))
+            # Let this operation test the host, and keep failing fast for
+            # the others until it is done.
+            self._opened_at[host] = time.monotonic()
+
+    def record_success(self, url: str):
+        host = url_host(url)
+        if host is None:
+            return
+        with self._lock:
+            self._failures.pop(host, None)
+            self._opened_at.pop(host, None)
+
+    def record_failure(self, url: str):
+        host = url_host(url)
+        if host is None:
+            return
+        with self._lock:
+            failures = self._failures.get(host, 0) + 1
+            self._failures[host] = failures
+            if 0 < self.failure_threshold <= failures:
+                self._opened_at[host] = time.monotonic()
+
+    def backoff_delay(self, attempt: int) -> float:
+        """The jittered exponential delay before retry number attempt."""
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+
+@contextlib.contextmanager
+def environment(variables: Dict[str, str]) -> Iterator[None]:
+    """Sets environment variables for git in the with block."""
+    old_values = {name: os.environ.get(name) for name in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for name, value in old_values.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def low_speed_environment(limit: int, seconds: int) -> Dict[str, str]:
+    """
+    The environment that makes git abort http transfers that are slower than
+    limit bytes per second for seconds seconds, and ssh connections that do
+    not respond for about seconds seconds.
+    """
+    ssh_options = ["-o", "ServerAliveInterval={0}".format(
+        max(1, seconds // 3)), "-o", "ServerAliveCountMax=3"]
+    return {
+        "GIT_HTTP_LOW_SPEED_LIMIT": str(limit),
+        "GIT_HTTP_LOW_SPEED_TIME": str(seconds),
+        "GIT_SSH_COMMAND": " ".join(
+            [os.environ.get("GIT_SSH_COMMAND", "ssh")] + ssh_options),
+    }
+
+
+class SSHMultiplexer(object):
+    """
+    Context manager that makes git reuse one ssh connection per host, using
+    ssh ControlMaster sockets in a temporary directory. The master
+    connections are closed on exit.
+    """
+
+    def __init__(self, urls: Iterable[str], control_persist: int = 60):
+        destinations = [ssh_destination(url) for url in urls]
+        self.destinations = {destination for destination in destinations
+                             if destination is not None}
+        self.control_persist = control_persist
+        self.control_dir = None  # type: Optional[str]
+        self._old_ssh_command = None  # type: Optional[str]
+
+    @property
+    def ssh_options(self) -> List[str]:
+        # %C is a hash of the connection details. This keeps the socket path
+        # short enough for unix sockets.
+        return ["-o", "ControlMaster=auto",
+                "-o", "ControlPath={0}".format(
+                    os.path.join(str(self.control_dir), "%C")),
+                "-o", "ControlPersist={0}".format(self.control_persist)]
+
+    def __enter__(self):
+        # Not in --clone-dir, which may be too long a path for a socket.
+        self.control_dir = tempfile.mkdtemp(prefix="git-sync-ssh")
+        self._old_ssh_command = os.environ.get("GIT_SSH_COMMAND")
+        ssh_command = self._old_ssh_command or "ssh"
+        os.environ["GIT_SSH_COMMAND"] = " ".join(
+            [ssh_command] + [shlex.quote(option)
+                             for option in self.ssh_options])
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._old_ssh_command is None:
+            del os.environ["GIT_SSH_COMMAND"]
+        else:
+            os.environ["GIT_SSH_COMMAND"] = self._old_ssh_command
+        for destination, port in self.destinations:
+            port_options = ["-p", str(port)] if port is not None else []
+            subprocess.run(["ssh"] + self.ssh_options + port_options +
+                           ["-O", "exit", destination],
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        shutil.rmtree(str(self.control_dir), ignore_errors=True)
+
+
+class ObjectPools(object):
+    """
+    Bare repositories in pools_dir that hold the objects of related
+    repositories, such as forks of the same project. The clones borrow
+    objects from their pool through objects/info/alternates.
+
+    The refs of every member are kept in the pool under
+    refs/members/<md5 of clone name>/, so all objects that a member borrows
+    stay reachable in the pool and repacking the pool never drops them.
+    """
+
+    def __init__(self, pools_dir: Path):
+        self.pools_dir = pools_dir
+        self._locks = {}  # type: Dict[str, threading.Lock]
+        self._lock = threading.Lock()
+
+    def pool_path(self, name: str) -> Path:
+        return self.pools_dir / Path(name + ".git")
+
+    def pool_lock(self, name: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def find_pool(self, shas: Iterable[str]) -> Optional[Path]:
+        """Returns the first pool that contains any of the given objects."""
+        if not self.pools_dir.exists():
+            return None
+        batch = "".join(sha + "\n" for sha in shas).encode("utf-8")
+        for pool in sorted(self.pools_dir.glob("*.git")):
+            result = subprocess.run(
+                ["git", "cat-file", "--batch-check"], cwd=str(pool),
+                input=batch, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL)
+            if any(not line.endswith(b" missing") for line in
+                   result.stdout.splitlines()):
+                return pool
+        return None
+
+    def add(self, name: str, repo_dir: Path):
+        """
+        Moves the objects of the bare clone in repo_dir to the pool with
+        the given name. The pool is created if it does not exist.
+        """
+        pool = self.pool_path(name)
+        with self.pool_lock(name):
+            if not pool.exists():
+                git.Repo.init(str(pool), bare=True)
+            objects = self.object_count(pool)
+            git.Repo(str(pool)).git.fetch(
+                "--no-tags", str(repo_dir.absolute()),
+                "+refs/*:refs/members/{0}/*".format(
+                    string_to_md5(repo_dir.name)))
+            moved = self.object_count(pool) > objects
+        alternates = repo_dir / Path("objects", "info", "alternates")
+        pool_objects = str((pool / Path("objects")).absolute())
+        if (not alternates.exists() or
+                pool_objects not in alternates.read_text().splitlines()):
+            with alternates.open("at") as alternates_h:
+                alternates_h.write(pool_objects + "\n")
+            moved = True
+        # Repacking walks the whole history, so it only runs when the clone
+        # has objects that are now in the pool. -l only keeps the objects
+        # that are not in the pool.
+        if moved:
+            git.Repo(str(repo_dir)).git.repack("-a", "-d", "-l", "-q")
+
+    @staticmethod
+    def object_count(repo_dir: Path) -> int:
+        counts = RepoMaintenance.count_objects(repo_dir)
+        return counts.get("count", 0) + counts.get("in-pack", 0)
+
+
+class ReferenceCache(object):
+    """
+    Local copies of repositories in cache_dir that new clones are seeded
+    from, so only the objects that are missing are downloaded. These are
+    bare repositories named like the clone, such as a copy of an old clone
+    dir, and git bundles named <name>.bundle.
+
+    With write_bundles a bundle is written for every synced repository that
+    has none, so a large initial transfer is prepared once and can be
+    copied to the hosts that need it.
+    """
+
+    def __init__(self, cache_dir: Path, write_bundles: bool = False):
+        self.cache_dir = cache_dir
+        self.write_bundles = write_bundles
+
+    def bundle_path(self, repo_dir: Path) -> Path:
+        name = repo_dir.name
+        if name.endswith(".git"):
+            name = name[:-len(".git")]
+        return self.cache_dir / Path(name + ".bundle")
+
+    def find(self, repo_dir: Path) -> Optional[Path]:
+        """Returns the bare repository or bundle to seed repo_dir from."""
+        reference = self.cache_dir / Path(repo_dir.name)
+        if (reference / Path("objects")).is_dir():
+            return reference
+        bundle = self.bundle_path(repo_dir)
+        return bundle if bundle.is_file() else None
+
+    def write_bundle(self, repo_dir: Path) -> bool:
+        """
+        Writes a bundle of all refs of the clone in repo_dir if it has none.
+        Returns whether a bundle was written.
+        """
+        bundle = self.bundle_path(repo_dir)
+        repo = git.Repo(str(repo_dir))
+        if bundle.exists() or not repo.git.for_each_ref():
+            # git can not bundle a repository without refs.
+            return False
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Written under a temporary name, so a seed never uses a bundle
+        # that is incomplete.
+        partial = bundle.parent / Path(bundle.name + ".partial")
+        repo.git.bundle("create", str(partial.absolute()), "--all")
+        partial.rename(bundle)
+        return True
+
+
+LFS_POINTER_REGEX = re.compile(
+    rb"^version https://git-lfs\.github\.com/spec/v1\n"
+    rb"oid sha256:(?P<oid>[0-9a-f]{64})\nsize (?P<size>[0-9]+)\n$")
+# LFS pointer files are smaller than this, so larger blobs are not read.
+LFS_POINTER_MAX_SIZE = 1024
+LFS_MEDIA_TYPE = "application/vnd.git-lfs+json"
+# The number of objects per request to the LFS batch API.
+LFS_BATCH_SIZE = 100
+
+
+class LFSError(git.GitError):
+    """A Git LFS server refused a request or sent an invalid object."""
+
+
+def lfs_endpoint(url: str) -> Optional[str]:
+    """
+    Returns the LFS server of the repository at url, as git lfs derives it
+    from http(s) urls. Other urls have no LFS server that can be reached
+    without git lfs.
+    """
+    if not url.startswith(("http://", "https://")):
+        return None
+    url = url.rstrip("/")
+    if not url.endswith(".git"):
+        url += ".git"
+    return url + "/info/lfs"
+
+
+def lfs_request(url: str, data=None, headers: Optional[Dict[str, str]] = None,
+                method: Optional[str] = None,
+                timeout: Optional[float] = None):
+    """
+    Opens url with urllib. Credentials in the url are sent with basic
+    authentication. Errors raise LFSError.
+    """
+    parts = urllib.parse.urlsplit(url)
+    headers = dict(headers or {})
+    if parts.username is not None:
+        credentials = "{0}:{1}".format(
+            urllib.parse.unquote(parts.username),
+            urllib.parse.unquote(parts.password or ""))
+        headers.setdefault("Authorization", "Basic " + base64.b64encode(
+            credentials.encode("utf-8")).decode("ascii"))
+        url = urllib.parse.urlunsplit(parts._replace(
+            netloc=parts.netloc.rpartition("@")[2]))
+    request = urllib.request.Request(url, data=data, headers=headers,
+                                     method=method)
+    try:
+        return urllib.request.urlopen(request, timeout=timeout)
+    except OSError as e:
+        raise LFSError("{0} {1} failed: {2}".format(
+            request.get_method(), url, e))
+
+
+def lfs_pointers(repo_dir: Path, include: List[str],
+                 exclude: List[str]) -> Dict[str, int]:
+    """
+    Returns the oid and size of the LFS objects of the pointer files that
+    are reachable from the commits in include and not from the commits in
+    exclude.
+    """
+    def run_git(*args: str, input: bytes) -> bytes:
+        result = subprocess.run(["git"] + list(args), cwd=str(repo_dir),
+                                input=input, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise git.GitCommandError(["git"] + list(args),
+                                      result.returncode, result.stderr)
+        return result.stdout
+
+    if not include:
+        return {}
+    # Commits in exclude that were removed since are ignored.
+    objects = run_git("rev-list", "--objects", "--ignore-missing", "--stdin",
+                      input="".join(
+                          [sha + "\n" for sha in include] +
+                          ["^" + sha + "\n" for sha in exclude]
+                      ).encode("ascii"))
+    checks = run_git(
+        "cat-file", "--batch-check=%(objectname) %(objecttype) "
+        "%(objectsize)", input=b"".join(
+            line.split(b" ")[0] + b"\n" for line in objects.splitlines()))
+    blobs = []  # type: List[bytes]
+    for line in checks.splitlines():
+        sha, object_type, object_size = line.split(b" ")
+        if (object_type == b"blob" and
+                int(object_size) <= LFS_POINTER_MAX_SIZE):
+            blobs.append(sha)
+    # The contents of the small blobs of a large history do not fit in
+    # memory, so they are read one blob at a time. The shas are written from
+    # another thread, as git blocks when its output is not read.
+    args = ["cat-file", "--batch"]
+    process = subprocess.Popen(["git"] + args, cwd=str(repo_dir),
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    stdout, stderr_pipe = process.stdout, process.stderr
+    assert stdout is not None and stderr_pipe is not None
+
+    def write_shas():
+        try:
+            with process.stdin:
+                for sha in blobs:
+                    process.stdin.write(sha + b"\n")
+        except BrokenPipeError:
+            # git exited. Its error is raised below.
+            pass
+
+    writer = threading.Thread(target=write_shas)
+    writer.start()
+    pointers = {}  # type: Dict[str, int]
+    try:
+        # Every blob is a "<sha> blob <size>" line, the content and a
+        # newline.
+        for header in iter(stdout.readline, b""):
+            size = int(header.split(b" ")[2])
+            content = stdout.read(size + 1)[:size]
+            match = LFS_POINTER_REGEX.match(content)
+            if match is not None:
+                pointers[match.group("oid").decode("ascii")] = int(
+                    match.group("size"))
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        writer.join()
+        stdout.close()
+        stderr = stderr_pipe.read()
+        stderr_pipe.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise git.GitCommandError(["git"] + args, returncode, stderr)
+    return pointers
+
+
+class LFSStore(object):
+    """
+    A content-addressed store of Git LFS objects in store_dir, shared by
+    all repos, with the layout of .git/lfs/objects. Objects are transferred
+    with the LFS batch API and its basic transfer adapter, with up to
+    threads objects at the same time.
+    """
+
+    def __init__(self, store_dir: Path, threads: int = 4):
+        self.store_dir = store_dir
+        self.threads = threads
+
+    def path(self, oid: str) -> Path:
+        return self.store_dir / Path(oid[0:2], oid[2:4], oid)
+
+    def has(self, oid: str) -> bool:
+        return self.path(oid).is_file()
+
+    def batch(self, url: str, operation: str, objects: Dict[str, int],
+              timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Returns the objects of the batch API response for an upload or
+        download of objects to or from the LFS server of url.
+        """
+        endpoint = lfs_endpoint(url)
+        if endpoint is None:
+            raise LFSError("{0} has no LFS server. Only http(s) urls are "
+                           "supported.".format(url))
+        headers = {"Accept": LFS_MEDIA_TYPE, "Content-Type": LFS_MEDIA_TYPE}
+        items = sorted(objects.items())
+        results = []  # type: List[Dict[str, Any]]
+        for start in range(0, len(items), LFS_BATCH_SIZE):
+            body = json.dumps({
+                "operation": operation, "transfers": ["basic"],
+                "objects": [{"oid": oid, "size": size} for oid, size in
+                            items[start:start + LFS_BATCH_SIZE]]})
+            with lfs_request(endpoint + "/objects/batch",
+                             data=body.encode("utf-8"), headers=headers,
+                             method="POST", timeout=timeout) as response:
+                results.extend(json.loads(
+                    response.read().decode("utf-8")).get("objects", []))
+        for result in results:
+            if "error" in result:
+                raise LFSError("LFS object {0} on {1}: {2}".format(
+                    result["oid"], url, result["error"].get("message")))
+        return results
+
+    def map(self, function: Callable, items: List[Any]):
+        if items:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=min(self.threads, len(items))) as executor:
+                list(executor.map(function, items))
+
+    def download(self, url: str, objects: Dict[str, int],
+                 timeout: Optional[float] = None) -> int:
+        """
+        Downloads the objects that are not in the store from the LFS server
+        of url. Returns the number of bytes that were downloaded.
+        """
+        missing = {oid: size for oid, size in objects.items()
+                   if not self.has(oid)}
+        if not missing:
+            return 0
+        results = self.batch(url, "download", missing, timeout)
+
+        def download(result: Dict[str, Any]):
+            oid = result["oid"]
+            action = result.get("actions", {}).get("download")
+            if action is None:
+                raise LFSError("LFS object {0} is not on {1}".format(
+                    oid, url))
+            path = self.path(oid)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            digest = hashlib.sha256()
+            # A unique temporary name, as other repos can download the same
+            # object at the same time.
+            partial = tempfile.NamedTemporaryFile(dir=str(path.parent),
+                                                  delete=False)
+            try:
+                with partial, lfs_request(action["href"],
+                                          headers=action.get("header"),
+                                          timeout=timeout) as response:
+                    for chunk in iter(lambda: response.read(1024 ** 2), b""):
+                        digest.update(chunk)
+                        partial.write(chunk)
+                if digest.hexdigest() != oid:
+                    raise LFSError("LFS object {0} from {1} does not match "
+                                   "its oid".format(oid, url))
+                os.replace(partial.name, str(path))
+            finally:
+                # Only left after an error.
+                if os.path.exists(partial.name):
+                    os.unlink(partial.name)
+
+        self.map(download, results)
+        return sum(missing.values())
+
+    def upload(self, url: str, objects: Dict[str, int],
+               timeout: Optional[float] = None) -> int:
+        """
+        Uploads the objects that the LFS server of url does not have from
+        the store. Returns the number of bytes that were uploaded.
+        """
+        # The server leaves out the actions of objects it already has.
+        uploads = [result for result in
+                   self.batch(url, "upload", objects, timeout)
+                   if "upload" in result.get("actions", {})]
+
+        def upload(result: Dict[str, Any]):
+            actions = result["actions"]
+            path = self.path(result["oid"])
+            headers = dict(actions["upload"].get("header", {}))
+            headers["Content-Type"] = "application/octet-stream"
+            headers["Content-Length"] = str(path.stat().st_size)
+            with path.open("rb") as data:
+                with lfs_request(actions["upload"]["href"], data=data,
+                                 headers=headers, method="PUT",
+                                 timeout=timeout) as response:
+                    response.read()
+            if "verify" in actions:
+                headers = dict(actions["verify"].get("header", {}))
+                headers.update({"Accept": LFS_MEDIA_TYPE,
+                                "Content-Type": LFS_MEDIA_TYPE})
+                body = json.dumps({"oid": result["oid"],
+                                   "size": result["size"]})
+                with lfs_request(actions["verify"]["href"],
+                                 data=body.encode("utf-8"), headers=headers,
+                                 method="POST", timeout=timeout) as response:
+                    response.read()
+
+        self.map(upload, uploads)
+        return sum(result["size"] for result in uploads)
+
+
+# git repack --write-midx was added in git 2.34.
+MIDX_GIT_VERSION = (2, 34)
+
+
+def low_priority_command() -> List[str]:
+    """The command prefix that runs a process with idle CPU and IO."""
+    prefix = []  # type: List[str]
+    if shutil.which("nice") is not None:
+        prefix.extend(["nice", "-n", "19"])
+    if shutil.which("ionice") is not None:
+        prefix.extend(["ionice", "-c", "3"])
+    return prefix
+
+
+class RepoMaintenance(object):
+    """
+    Keeps bare clones fast to fetch into and push from. Every fetch adds a
+    pack, so over time the clones get many small packs and loose objects.
+    Maintenance is due when one of the thresholds is exceeded, or when it
+    has not run for interval seconds.
+
+    Maintenance rolls the packs up geometrically, writes a multi-pack-index
+    with reachability bitmaps and writes a split commit-graph. Clones that
+    borrow objects from an object pool are repacked locally instead, as
+    bitmaps need all objects to be in the clone.
+    """
+
+    def __init__(self, loose_objects: int = 1000, packs: int = 20,
+                 interval: float = 7 * 24 * 3600):
+        self.loose_objects = loose_objects
+        self.packs = packs
+        self.interval = interval
+
+    @staticmethod
+    def stamp_file(repo_dir: Path) -> Path:
+        """The file whose modification time is the last maintenance run."""
+        return repo_dir.parent / Path(repo_dir.name + ".maintenance")
+
+    @staticmethod
+    def count_objects(repo_dir: Path) -> Dict[str, int]:
+        """The loose object and pack counts of git count-objects -v."""
+        output = str(git.Repo(str(repo_dir)).git.count_objects("-v"))
+        counts = {}  # type: Dict[str, int]
+        for line in output.splitlines():
+            name, _, value = line.partition(": ")
+            if value.isdigit():
+                counts[name] = int(value)
+        return counts
+
+    def needed(self, repo_dir: Path) -> bool:
+        stamp_file = self.stamp_file(repo_dir)
+        if (not stamp_file.exists() or
+                time.time() - stamp_file.stat().st_mtime >= self.interval):
+            return True
+        counts = self.count_objects(repo_dir)
+        return (counts.get("count", 0) >= self.loose_objects or
+                counts.get("packs", 0) >= self.packs)
+
+    def run(self, repo_dir: Path):
+        repo = git.Repo(str(repo_dir))
+        prefix = low_priority_command() + ["git"]
+        alternates = repo_dir / Path("objects", "info", "alternates")
+        if alternates.exists():
+            repo.git.execute(prefix + ["repack", "-a", "-d", "-l", "-q"])
+        elif repo.git.version_info >= MIDX_GIT_VERSION:
+            repo.git.execute(prefix + [
+                "repack", "-d", "-l", "-q", "--geometric=2", "--write-midx",
+                "--write-bitmap-index"])
+        else:
+            repo.git.execute(prefix + ["repack", "-d", "-l", "-q"])
+        repo.git.execute(prefix + ["commit-graph", "write", "--reachable",
+                                   "--split"])
+        self.stamp_file(repo_dir).touch()
+
+
+# Units of the transfer sizes in git's progress output.
+SIZE_UNITS = {"bytes": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3,
+              "TiB": 1024 ** 4}
+SIZE_REGEX = re.compile(r"(?P<size>[0-9.]+) (?P<unit>{0})".format(
+    "|".join(SIZE_UNITS)))
+
+
+class TransferProgress(git.RemoteProgress):
+    """
+    Counts the objects and bytes that were received or sent, as reported in
+    the progress output of git clone, fetch and push.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.objects = 0
+        self.bytes = 0.0
+
+    def update(self, op_code, cur_count, max_count=None, message=""):
+        if (op_code & self.END and
+                op_code & (self.RECEIVING | self.WRITING)):
+            self.objects += int(max_count or cur_count)
+            match = SIZE_REGEX.search(message)
+            if match:
+                self.bytes += (float(match.group("size")) *
+                               SIZE_UNITS[match.group("unit")])
+
+    def parse_output(self, output: str):
+        """Parses progress output that was not produced through GitPython."""
+        handler = self.new_message_handler()
+        for line in re.split(r"[\r\n]", output):
+            handler(line)
+
+
+# Lines of git fetch and git push --porcelain output for updated refs.
+FETCH_UPDATE_REGEX = re.compile(r"^ [ +*t-] .* -> ")
+PORCELAIN_UPDATE_REGEX = re.compile(r"^[ +*-]\t")
+
+# The arguments of the git commands that both engines run. Refs that were
+# deleted from the main repository, or from a seed, are pruned from the
+# clone, so the pushes delete them from the mirrors too.
+FETCH_ARGS = ("--progress", "--prune", "origin")
+PUSH_ARGS = ("--porcelain", "--progress")
+
+# The metrics that are exported, with their help text.
+METRICS = {
+    "phase_duration_seconds": "Wall time of a phase of the last run.",
+    "queue_wait_seconds": "Time the repository waited in the queue.",
+    "received_objects": "Objects received from the main repository.",
+    "received_bytes": "Bytes received from the main repository.",
+    "fetched_refs": "Refs that were updated by the fetch.",
+    "push_duration_seconds": "Wall time of the pushes to a mirror.",
+    "sent_objects": "Objects sent to a mirror.",
+    "sent_bytes": "Bytes sent to a mirror.",
+    "pushed_refs": "Refs that were updated on a mirror.",
+    "lfs_received_bytes": "Bytes of LFS objects downloaded from the main "
+                          "repository.",
+    "lfs_sent_bytes": "Bytes of LFS objects uploaded to a mirror.",
+    "errors": "Errors during the last run.",
+    "status": "Result of the last run (synced, skipped or failed).",
+}
+
+
+# The refs that are pushed to the mirrors. Other refs, such as the
+# refs/pull/* refs created by GitHub, are not mirrored.
+MIRRORED_REF_PREFIXES = ("refs/heads/", "refs/tags/")
+# for-each-ref format that produces the same lines as ls-remote.
+LOCAL_REFS_FORMAT = "--format=%(objectname)\t%(refname)"
+
+
+# The kinds of differences between two sets of refs that are audited.
+DRIFT_KINDS = ("missing", "stale", "extra")
+
+
+def ref_drift(source_refs: Dict[str, str],
+              target_refs: Dict[str, str]) -> Dict[str, List[str]]:
+    """
+    Returns the mirrored refs of source_refs that are missing in
+    target_refs, that point to another object in target_refs (stale) and
+    the refs in target_refs that are not in source_refs (extra).
+    """
+    def mirrored(refs: Dict[str, str]) -> Dict[str, str]:
+        # A changed annotated tag is already stale without its peeled ^{}.
+        return {ref: sha for ref, sha in refs.items()
+                if ref.startswith(MIRRORED_REF_PREFIXES) and
+                not ref.endswith("^{}")}
+    source = mirrored(source_refs)
+    target = mirrored(target_refs)
+    return {
+        "missing": sorted(ref for ref in source if ref not in target),
+        "stale": sorted(ref for ref, sha in source.items()
+                        if ref in target and target[ref] != sha),
+        "extra": sorted(ref for ref in target if ref not in source),
+    }
+
+
+# Negative refspecs (^refs/...), which exclude refs, were added in git 2.29.
+NEGATIVE_REFSPEC_GIT_VERSION = (2, 29)
+# Characters that are not allowed in a ref pattern. * is allowed once.
+INVALID_REF_PATTERN_REGEX = re.compile(r"[\x00-\x20\x7f~^:?[\\]|\.\.|@\{")
+
+
+@functools.lru_cache(maxsize=None)
+def git_version() -> Tuple[int, ...]:
+    """The version of git, which only runs git the first time."""
+    return git.cmd.Git().version_info
+
+
+def check_ref_patterns(patterns: List[str]):
+    """
+    Raises a ValueError for patterns that git does not accept in a refspec.
+    These are also the patterns that RefFilter.matches() and git agree on.
+    """
+    for pattern in patterns:
+        if (not pattern.startswith("refs/") or pattern.count("*") > 1 or
+                INVALID_REF_PATTERN_REGEX.search(pattern) is not None):
+            raise ValueError(
+                "Invalid ref pattern '{0}'. A pattern starts with refs/ and "
+                "can contain one * as its only wildcard.".format(pattern))
+
+
+class RefFilter(object):
+    """
+    Include and exclude patterns for the refs that are mirrored, such as
+    refs/heads/* or refs/pull/*. As in git refspecs, * also matches /. A ref
+    is mirrored if it matches any include pattern, or there are no include
+    patterns, and matches no exclude pattern.
+
+    The patterns become the fetch refspecs of the clone, so git only asks
+    the server for the included refs (protocol v2 ref-prefix) and does not
+    fetch the excluded ones. Invalid patterns, and exclude patterns with a
+    git that does not support them, raise a ValueError.
+    """
+
+    def __init__(self, include: Optional[List[str]] = None,
+                 exclude: Optional[List[str]] = None):
+        self.include = include or []
+        self.exclude = exclude or []
+        check_ref_patterns(self.include + self.exclude)
+        if self.exclude and git_version() < NEGATIVE_REFSPEC_GIT_VERSION:
+            raise ValueError(
+                "Excluding refs needs git {0} or later, found git {1}."
+                .format(".".join(map(str, NEGATIVE_REFSPEC_GIT_VERSION)),
+                        ".".join(map(str, git_version()))))
+
+    def __bool__(self):
+        return bool(self.include or self.exclude)
+
+    def matches(self, ref: str) -> bool:
+        return ((not self.include or any(
+            fnmatch.fnmatchcase(ref, pattern) for pattern in self.include))
+            and not any(fnmatch.fnmatchcase(ref, pattern)
+                        for pattern in self.exclude))
+
+    def filter(self, refs: Dict[str, str]) -> Dict[str, str]:
+        """Returns the refs that match. Peeled tags (^{}) are kept too."""
+        return {ref: sha for ref, sha in refs.items()
+                if self.matches(ref[:-len("^{}")] if ref.endswith("^{}")
+                                else ref)}
+
+    def fetch_refspecs(self) -> List[str]:
+        include = self.include or ["refs/*"]
+        return (["+{0}:{0}".format(pattern) for pattern in include] +
+                ["^" + pattern for pattern in self.exclude])
+
+    def configure(self, repo: git.Repo):
+        """Sets the fetch refspecs of origin in repo."""
+        refspecs = self.fetch_refspecs()
+        try:
+            current = str(repo.git.config(
+                "--get-all", "remote.origin.fetch")).splitlines()
+        except git.GitCommandError:
+            current = []
+        if current != refspecs:
+            repo.git.config("--unset-all", "remote.origin.fetch",
+                            with_exceptions=False)
+            for refspec in refspecs:
+                repo.git.config("--add", "remote.origin.fetch", refspec)
+
+    def push_refspecs(self) -> List[str]:
+        """
+        The refspecs for pushing the branches and tags that match, the
+        equivalent of git push --all followed by git push --tags.
+        """
+        include = []  # type: List[str]
+        for pattern in self.include or ["refs/*"]:
+            if pattern.startswith(MIRRORED_REF_PREFIXES):
+                include.append(pattern)
+            elif pattern.endswith("*"):
+                # A pattern such as refs/* includes all branches or tags.
+                include.extend(prefix + "*" for prefix in
+                               MIRRORED_REF_PREFIXES
+                               if prefix.startswith(pattern[:-1]))
+        return (["{0}:{0}".format(pattern) for pattern in include] +
+                ["^" + pattern for pattern in self.exclude])
+
+
+def split_patterns(patterns: Optional[str]) -> Optional[List[str]]:
+    """Splits the comma separated patterns of a config option."""
+    if patterns is None:
+        return None
+    return [pattern for pattern in patterns.split(",") if pattern]
+
+
+class RunJournal(object):
+    """
+    SQLite journal of the steps that were completed in a run, per repo and
+    per mirror, with the ref state they were completed at. Every step is
+    committed right away, so the journal survives a crash and an
+    interrupted run can be resumed without repeating completed steps.
+
+    lock() prevents two runs from using the same clone directory at the
+    same time.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock_file = path.parent / Path(path.name + ".lock")
+        self.run_id = None  # type: Optional[int]
+        self._connection = None  # type: Optional[sqlite3.Connection]
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def lock(self) -> Iterator[None]:
+        """Holds an exclusive lock on the journal, or raises ValueError."""
+        self.lock_file.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock_file.open("w") as lock_h:
+            try:
+                fcntl.flock(lock_h, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise ValueError("Another run is using {0}".format(
+                    self.path.parent))
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_h, fcntl.LOCK_UN)
+
+    def start(self, resume: bool = False) -> bool:
+        """
+        Starts a new run, or continues the last run if resume is True and
+        that run did not finish. Returns whether a run was resumed.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Workers record their steps from their own threads.
+        self._connection = sqlite3.connect(str(self.path),
+                                           check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, "
+                "started REAL, finished REAL)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS steps (run INTEGER, repo TEXT, "
+                "mirror TEXT, step TEXT, state TEXT, completed REAL, "
+                "PRIMARY KEY (run, repo, mirror, step))")
+            last_run = self._connection.execute(
+                "SELECT id, finished FROM runs ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+            if resume and last_run is not None and last_run[1] is None:
+                self.run_id = last_run[0]
+                return True
+            self.run_id = self._connection.execute(
+                "INSERT INTO runs (started) VALUES (?)", (time.time(),)
+            ).lastrowid
+            # Only the last run can be resumed.
+            self._connection.execute("DELETE FROM steps WHERE run < ?",
+                                     (self.run_id,))
+        return False
+
+    def record(self, repo: str, step: str, mirror: str = "",
+               state: Optional[str] = None):
+        """Records that step was completed for repo, or one of its mirrors."""
+        assert self._connection is not None
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?, ?)",
+                (self.run_id, repo, mirror, step, state, time.time()))
+
+    def completed(self, repo: str, step: str, mirror: str = "",
+                  state: Optional[str] = None) -> bool:
+        """
+        Returns whether step was completed in this run. If state is given,
+        the step must have been completed at that state.
+        """
+        assert self._connection is not None
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT state FROM steps WHERE run = ? AND repo = ? AND "
+                "mirror = ? AND step = ?",
+                (self.run_id, repo, mirror, step)).fetchone()
+        return row is not None and (state is None or row[0] == state)
+
+    def finish(self):
+        assert self._connection is not None
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE runs SET finished = ? WHERE id = ?",
+                (time.time(), self.run_id))
+        self._connection.close()
+        self._connection = None
+
+
 class GitRepo(object):
     """Wrapper for using the git.Repo class in an automated way."""
 
@@ -39,30 +1159,303 @@ class GitRepo(object):
                  main_url: str,
                  repo_dir: Path,
                  mirror_urls: Optional[List[str]] = None,
+                 use_fingerprint: bool = True,
+                 ref_diff_push: bool = False,
+                 mirror_threads: int = 1,
+                 host_limiter: Optional[HostLimiter] = None,
+                 object_pools: Optional[ObjectPools] = None,
+                 object_group: Optional[str] = None,
+                 maintenance: Optional[RepoMaintenance] = None,
+                 circuit_breaker: Optional[CircuitBreaker] = None,
+                 journal: Optional[RunJournal] = None,
+                 ref_filter: Optional[RefFilter] = None,
+                 timeouts: Optional[Dict[str, float]] = None,
+                 reference_cache: Optional[ReferenceCache] = None,
+                 lfs_store: Optional[LFSStore] = None,
                  ):
         self.main_url = main_url
         self.mirror_urls = mirror_urls if mirror_urls is not None else []
-        self.mirrors = []  # type: List[git.Remote]
+        self._mirrors = []  # type: List[git.Remote]
         self.errors = []  # type: List[Exception]
         self.repo_dir = repo_dir
+        # The fingerprint is stored next to the bare clone, so it is
+        # clear which clone it belongs to.
+        self.fingerprint_file = repo_dir.parent / Path(
+            repo_dir.name + ".fingerprint")
+        self.use_fingerprint = use_fingerprint
+        self.ref_diff_push = ref_diff_push
+        # The number of mirrors that are pushed to at the same time.
+        self.mirror_threads = mirror_threads
+        self.host_limiter = (host_limiter if host_limiter is not None
+                             else HostLimiter())
+        self.circuit_breaker = (circuit_breaker if circuit_breaker is not None
+                                else CircuitBreaker())
+        # When object_pools is set the objects are shared with the other
+        # repos in object_group, or with repos that have the same root
+        # commit if no group is given.
+        self.object_pools = object_pools
+        self.object_group = object_group
+        self.maintenance = maintenance
+        # The steps that were completed are recorded in the journal, and
+        # skipped when the run is resumed.
+        self.journal = journal
+        self.ref_filter = ref_filter if ref_filter is not None else RefFilter()
+        # Seconds per phase in TIMEOUT_PHASES after which git is killed.
+        self.timeouts = timeouts if timeouts is not None else {}
+        self.reference_cache = reference_cache
+        # When lfs_store is set the LFS objects are mirrored too. The
+        # commits whose objects were mirrored are stored in lfs_state_file.
+        self.lfs_store = lfs_store
+        self.lfs_state_file = repo_dir.parent / Path(repo_dir.name + ".lfs")
+        # One of "synced", "skipped" or "failed" after processing.
+        self.status = None  # type: Optional[str]
+        # Wall time in seconds per phase (check, clone, fetch, push, lfs,
+        # maintenance, bundle) and in total for the last mirror run.
+        self.durations = {}  # type: Dict[str, float]
+        # Transfer metrics of the last mirror run, for the repo as a whole
+        # and per mirror url. See METRICS for the names.
+        self.metrics = {}  # type: Dict[str, float]
+        self.mirror_metrics = {}  # type: Dict[str, Dict[str, float]]
+        self._metrics_lock = threading.Lock()
+        # Mirror urls that were skipped because their host is unavailable.
+        self.unavailable_mirrors = []  # type: List[str]
+        # Set by RepoQueue to measure the time spent waiting in the queue.
+        self.queued_at = None  # type: Optional[float]
+        # The fingerprint of the last mirror_fetch(), for mirror_push().
+        self._fingerprint = None  # type: Optional[str]
+        # The clone is opened on first use, on the thread that mirrors it,
+        # so creating many GitRepo objects is cheap.
+        self._repo = None  # type: Optional[git.Repo]
+        self._opened = False
+
+    @property
+    def repo(self) -> Optional[git.Repo]:
+        """The bare clone, or None if it does not exist yet."""
+        if not self._opened:
+            self.open()
+        return self._repo
+
+    @repo.setter
+    def repo(self, repo: Optional[git.Repo]):
+        self._repo = repo
+        self._opened = True
+
+    @property
+    def mirrors(self) -> List[git.Remote]:
+        """The remotes of the clone that are pushed to."""
+        if not self._opened:
+            self.open()
+        return self._mirrors
+
+    @mirrors.setter
+    def mirrors(self, mirrors: List[git.Remote]):
+        self._mirrors = mirrors
+
+    def open(self):
+        """
+        Opens the existing clone and its mirror remotes. Remotes are added
+        for mirror urls that are new, and removed for mirror urls that are
+        no longer in mirror_urls.
+        """
+        if self._opened:
+            return
+        self._opened = True
         if self.repo_dir.exists():
-            self.repo = git.Repo(path=self.repo_dir)
-            self.repo.remote().set_url(main_url)
-            self.mirrors = [remote for remote in
-                            git.Remote.list_items(self.repo) if
-                            remote.name != "origin"]
-        else:
-            self.repo = None
+            self._repo = git.Repo(path=self.repo_dir)
+            self._repo.remote().set_url(self.main_url)
+            self.ref_filter.configure(self._repo)
+            remotes = {remote.name: remote for remote in
+                       git.Remote.list_items(self._repo) if
+                       remote.name != "origin"}
+            self._mirrors = []
+            for mirror_url in self.mirror_urls:
+                name = string_to_md5(mirror_url)
+                if name in remotes:
+                    remote = remotes.pop(name)
+                elif any(mirror.name == name for mirror in self._mirrors):
+                    # The url is listed twice.
+                    continue
+                else:
+                    remote = git.Remote.add(self._repo, name, mirror_url)
+                self._mirrors.append(remote)
+            for name in remotes:
+                git.Remote.remove(self._repo, name)
+
+    def close(self):
+        """
+        Releases the clone and the git processes GitPython keeps for it. It
+        is opened again when it is used.
+        """
+        if self._repo is not None:
+            self._repo.close()
+        self._repo = None
+        self._opened = False
+        self._mirrors = []
+
+    def step_completed(self, step: str, mirror: str = "",
+                       state: Optional[str] = None) -> bool:
+        return (self.journal is not None and
+                self.journal.completed(self.main_url, step, mirror, state))
+
+    def record_step(self, step: str, mirror: str = "",
+                    state: Optional[str] = None):
+        if self.journal is not None:
+            self.journal.record(self.main_url, step, mirror, state)
+
+    @contextlib.contextmanager
+    def timed(self, phase: str) -> Iterator[None]:
+        """Adds the time spent in the with block to self.durations."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.durations[phase] = (self.durations.get(phase, 0.0) +
+                                     time.monotonic() - start)
+
+    def add_metric(self, name: str, value: float,
+                   mirror: Optional[str] = None):
+        """Adds value to a metric of the repo or of one of its mirrors."""
+        with self._metrics_lock:
+            if mirror is None:
+                metrics = self.metrics
+            else:
+                metrics = self.mirror_metrics.setdefault(mirror, {})
+            metrics[name] = metrics.get(name, 0) + value
+
+    def remote_operation(self, url: str, function: Callable, *args,
+                         **kwargs):
+        """
+        Returns function(*args, **kwargs), a git operation that connects to
+        url. The host limit and the circuit breaker of the host are applied,
+        and connection failures are retried with backoff. Operations that
+        were killed after their timeout raise OperationTimeout and are not
+        retried.
+        """
+        attempt = 0
+        while True:
+            self.circuit_breaker.check(url)
+            try:
+                with self.host_limiter.limit(url):
+                    result = function(*args, **kwargs)
+            except git.GitCommandError as e:
+                if TIMEOUT_REGEX.search(str(e.stderr)) is not None:
+                    self.circuit_breaker.record_failure(url)
+                    raise OperationTimeout("git {0} on {1} timed out".format(
+                        e.command[1] if len(e.command) > 1 else "", url))
+                if not is_connection_error(e):
+                    # The host did respond.
+                    self.circuit_breaker.record_success(url)
+                    raise
+                self.circuit_breaker.record_failure(url)
+                if (attempt >= self.circuit_breaker.retries or
+                        self.circuit_breaker.is_open(url)):
+                    raise
+                time.sleep(self.circuit_breaker.backoff_delay(attempt))
+                attempt += 1
+            else:
+                self.circuit_breaker.record_success(url)
+                return result
 
     def clone(self):
         if self.repo is None:
-            self.repo = git.Repo.clone_from(
-                url=self.main_url,
-                to_path=self.repo_dir.absolute(),
-                mirror=True
-            )
-            for mirror_url in self.mirror_urls:
-                self.add_mirror(mirror_url)
+            pool = self.find_object_pool()
+            progress = TransferProgress()
+            seed = self.find_seed()
+            timeout = self.timeouts.get("clone")
+            with self.timed("clone"):
+                if self.ref_filter or seed is not None:
+                    repo = self.init_clone(pool, seed)
+                    _, _, stderr = self.remote_operation(
+                        self.main_url, repo.git.fetch, *FETCH_ARGS,
+                        with_extended_output=True,
+                        kill_after_timeout=timeout)
+                    repo.close()
+                else:
+                    # Not git.Repo.clone_from, which can not time out.
+                    _, _, stderr = self.remote_operation(
+                        self.main_url, git.cmd.Git().clone,
+                        *self.clone_args(pool), with_extended_output=True,
+                        kill_after_timeout=timeout)
+                progress.parse_output(stderr)
+            self.cloned(progress)
+
+    def clone_args(self, pool: Optional[Path]) -> List[str]:
+        """The git clone arguments for a new clone without a filter."""
+        reference = (["--reference", str(pool.absolute())]
+                     if pool is not None else [])
+        return (["--mirror", "--progress"] + reference +
+                [self.main_url, str(self.repo_dir.absolute())])
+
+    def cloned(self, progress: TransferProgress):
+        """
+        Opens the new clone, adds its mirror remotes and records the
+        transfer metrics of the clone.
+        """
+        self.repo = git.Repo(str(self.repo_dir.absolute()))
+        self.add_metric("received_objects", progress.objects)
+        self.add_metric("received_bytes", progress.bytes)
+        for mirror_url in self.mirror_urls:
+            self.add_mirror(mirror_url)
+
+    def find_seed(self) -> Optional[Path]:
+        """Returns the local repository or bundle to seed a clone from."""
+        if self.reference_cache is None:
+            return None
+        return self.reference_cache.find(self.repo_dir)
+
+    def init_clone(self, pool: Optional[Path],
+                   seed: Optional[Path] = None) -> git.Repo:
+        """
+        Creates a mirror clone that fetches only the refs of self.ref_filter.
+        git clone --mirror would fetch all refs. The clone gets the objects
+        of seed, so the fetch from the main url only downloads the rest.
+        """
+        repo = git.Repo.init(str(self.repo_dir.absolute()), bare=True)
+        repo.git.remote("add", "--mirror=fetch", "origin", self.main_url)
+        if pool is not None:
+            alternates = self.repo_dir / Path("objects", "info", "alternates")
+            alternates.write_text(
+                str((pool / Path("objects")).absolute()) + "\n")
+        self.ref_filter.configure(repo)
+        if seed is not None:
+            try:
+                repo.git.fetch(str(seed.absolute()),
+                               *self.ref_filter.fetch_refspecs())
+            except git.GitCommandError:
+                # An unusable seed only means more is downloaded.
+                pass
+        return repo
+
+    def find_object_pool(self) -> Optional[Path]:
+        """Returns the pool a new clone can borrow objects from."""
+        if self.object_pools is None:
+            return None
+        if self.object_group is not None:
+            pool = self.object_pools.pool_path(self.object_group)
+            return pool if pool.exists() else None
+        refs = self.remote_operation(self.main_url, ls_remote, self.main_url,
+                                     self.timeouts.get("check"))
+        return self.object_pools.find_pool(refs.values())
+
+    @property
+    def root_commit(self) -> Optional[str]:
+        if self.repo is not None:
+            try:
+                roots = str(self.repo.git.rev_list("--max-parents=0", "HEAD"))
+            except git.GitCommandError:
+                # Empty repositories have no HEAD.
+                return None
+            return sorted(roots.splitlines())[0] if roots else None
+        else:
+            raise ValueError("Can only be performed on cloned repos.")
+
+    def update_object_pool(self):
+        """Moves the objects of this repo to its shared object pool."""
+        if self.object_pools is None:
+            return
+        name = self.object_group or self.root_commit
+        if name is not None:
+            self.object_pools.add(name, self.repo_dir)
 
     def add_mirror(self, mirror_url):
         if self.repo is not None:
@@ -76,24 +1469,380 @@ class GitRepo(object):
 
     def fetch(self):
         if self.repo is not None:
-            self.repo.remote().fetch()
+            progress = TransferProgress()
+            with self.timed("fetch"):
+                # Not git.Remote.fetch, which hangs when it kills git after
+                # kill_after_timeout.
+                _, _, stderr = self.remote_operation(
+                    self.main_url, self.repo.git.fetch, *FETCH_ARGS,
+                    with_extended_output=True,
+                    kill_after_timeout=self.timeouts.get("fetch"))
+            progress.parse_output(stderr)
+            self.add_fetch_metrics(progress)
         else:
             raise ValueError("Can only be performed on cloned repos.")
 
+    def add_fetch_metrics(self, progress: TransferProgress):
+        self.add_metric("received_objects", progress.objects)
+        self.add_metric("received_bytes", progress.bytes)
+        self.add_metric("fetched_refs", sum(
+            1 for line in progress.other_lines
+            if FETCH_UPDATE_REGEX.match(line)))
+
+    def _push(self, remote: git.Remote, url: str, *args: str):
+        """git push remote *args that records the metrics for the mirror."""
+        progress = TransferProgress()
+        start = time.monotonic()
+        # Not git.Remote.push, which hangs when it kills git after
+        # kill_after_timeout.
+        _, output, stderr = self.remote_operation(
+            url, remote.repo.git.push, *PUSH_ARGS, remote.name, *args,
+            with_extended_output=True,
+            kill_after_timeout=self.timeouts.get("push"))
+        progress.parse_output(stderr)
+        self.add_push_metrics(url, progress, output,
+                              time.monotonic() - start)
+
+    def add_push_metrics(self, url: str, progress: TransferProgress,
+                         output: str, duration: float):
+        self.add_metric("push_duration_seconds", duration, mirror=url)
+        self.add_metric("sent_objects", progress.objects, mirror=url)
+        self.add_metric("sent_bytes", progress.bytes, mirror=url)
+        self.add_metric("pushed_refs", sum(
+            1 for line in output.splitlines()
+            if PORCELAIN_UPDATE_REGEX.match(line)), mirror=url)
+
     def push_branches(self):
         for remote in self.mirrors:
-            remote.push(all=True)
+            self._push(remote, list(remote.urls)[0], "--all")
 
     def push_tags(self):
         for remote in self.mirrors:
-            remote.push(tags=True)
+            self._push(remote, list(remote.urls)[0], "--tags")
+
+    @property
+    def local_refs(self) -> Dict[str, str]:
+        if self.repo is not None:
+            return self.ref_filter.filter(parse_refs(
+                self.repo.git.for_each_ref(LOCAL_REFS_FORMAT,
+                                           *MIRRORED_REF_PREFIXES)))
+        else:
+            raise ValueError("Can only be performed on cloned repos.")
+
+    def ref_diff_push_args(self) -> List[str]:
+        """
+        git push arguments that make the mirrored refs of a mirror equal to
+        those of the clone. git compares them with the refs the mirror
+        advertises for the push, so it takes a single connection. Refs on
+        the mirror that are not mirrored are left alone.
+        """
+        return ["--force", "--prune"] + self.ref_filter.push_refspecs()
+
+    def push_mirrors(self):
+        """
+        Pushes to all mirrors, using up to mirror_threads mirrors at the same
+        time. Errors are collected per mirror in self.errors, so a failing
+        mirror does not prevent the other mirrors from being updated.
+        """
+        if not self.mirrors:
+            return
+        with self.timed("push"):
+            self._push_mirrors()
+
+    def _push_mirrors(self):
+        state = self.push_state()
+
+        def push(remote: git.Remote):
+            url = self.mirror_url(remote)
+            if self.step_completed("push", url, state):
+                return
+            with self.mirror_errors(url):
+                for args in self.push_args():
+                    self._push(remote, url, *args)
+                self.record_step("push", url, state)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(self.mirror_threads, len(self.mirrors))
+        ) as executor:
+            # Consume the results so exceptions other than the caught ones
+            # are raised here.
+            list(executor.map(push, self.mirrors))
+
+    def push_state(self) -> str:
+        """The state of the local refs that pushes are journaled with."""
+        local_refs = self.local_refs if self.journal is not None else {}
+        return refs_fingerprint(local_refs, [])
+
+    def push_args(self) -> List[List[str]]:
+        """The arguments of each git push that updates a mirror."""
+        if self.ref_diff_push:
+            return [self.ref_diff_push_args()]
+        if self.ref_filter:
+            return [self.ref_filter.push_refspecs()]
+        return [["--all"], ["--tags"]]
+
+    def mirror_url(self, remote: git.Remote) -> str:
+        # Remotes added by this tool are named after the md5 of their url.
+        # This avoids a git config call for every remote.
+        for mirror_url in self.mirror_urls:
+            if string_to_md5(mirror_url) == remote.name:
+                return mirror_url
+        return list(remote.urls)[0]
+
+    @contextlib.contextmanager
+    def mirror_errors(self, url: str) -> Iterator[None]:
+        """
+        Stores the errors of the with block for a single mirror, so a
+        failing mirror does not prevent the other mirrors from being
+        updated.
+        """
+        try:
+            yield
+        except CircuitOpenError:
+            self.unavailable_mirrors.append(url)
+        except (ValueError, git.GitError) as e:
+            self.errors.append(e)
+
+    def fingerprint(self) -> str:
+        """Returns the fingerprint of the refs advertised by the main url."""
+        with self.timed("check"):
+            refs = self.remote_operation(self.main_url, ls_remote,
+                                         self.main_url,
+                                         self.timeouts.get("check"))
+        return self.fingerprint_of(refs)
+
+    def fingerprint_of(self, refs: Dict[str, str]) -> str:
+        # Changes to refs that are not mirrored do not need a sync.
+        return refs_fingerprint(self.ref_filter.filter(refs),
+                                self.mirror_urls)
+
+    def stored_fingerprint(self) -> Optional[str]:
+        if self.fingerprint_file.exists():
+            return self.fingerprint_file.read_text().strip()
+        return None
+
+    def audit(self) -> Dict[str, Any]:
+        """
+        Compares the refs of the mirrors and the local clone to the refs of
+        the main url, without fetching or pushing anything. Only the ref
+        advertisements are transferred, with an ls-remote of all urls at
+        the same time. Returns a report with the missing, stale and extra
+        refs of every mirror and of the clone, which is None if there is no
+        clone. The status of the report is "in sync", "drift" or "failed"
+        if an url could not be listed.
+        """
+        urls = [self.main_url] + self.mirror_urls
+        refs = {}  # type: Dict[str, Dict[str, str]]
+        errors = {}  # type: Dict[str, str]
+
+        def list_refs(url: str):
+            try:
+                refs[url] = self.ref_filter.filter(self.remote_operation(
+                    url, ls_remote, url, self.timeouts.get("check")))
+            except (CircuitOpenError, git.GitError) as e:
+                errors[url] = str(e)
+
+        with self.timed("check"):
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=min(self.mirror_threads + 1, len(urls))
+            ) as executor:
+                list(executor.map(list_refs, urls))
+        clone = None  # type: Optional[Dict[str, List[str]]]
+        mirrors = {}  # type: Dict[str, Dict[str, List[str]]]
+        source_refs = refs.get(self.main_url)
+        if source_refs is not None:
+            if self.repo_dir.exists():
+                # Not self.repo, which updates the urls of the clone.
+                repo = git.Repo(str(self.repo_dir))
+                try:
+                    clone = ref_drift(source_refs, self.ref_filter.filter(
+                        parse_refs(repo.git.for_each_ref(
+                            LOCAL_REFS_FORMAT, *MIRRORED_REF_PREFIXES))))
+                finally:
+                    repo.close()
+            mirrors = {url: ref_drift(source_refs, refs[url])
+                       for url in self.mirror_urls if url in refs}
+        drifts = list(mirrors.values()) + ([clone] if clone else [])
+        if errors:
+            status = "failed"
+        elif any(drift[kind] for drift in drifts for kind in DRIFT_KINDS):
+            status = "drift"
+        else:
+            status = "in sync"
+        return {"repo": self.main_url, "status": status, "clone": clone,
+                "mirrors": mirrors, "errors": errors}
 
     def mirror(self):
         """Mirrors the repo from the main git url to the miror git urls"""
+        if self.mirror_fetch():
+            self.mirror_push()
+
+    def mirror_fetch(self) -> bool:
+        """
+        The first half of mirror(), which clones and fetches. Returns False
+        if the repo is skipped, so mirror_push() does not need to run.
+        """
+        self.reset()
+        if self.completed():
+            return False
+        fingerprint = None  # type: Optional[str]
+        if self.use_fingerprint:
+            fingerprint = self.fingerprint()
+            if self.unchanged(fingerprint):
+                return False
         self.clone()
-        self.fetch()
-        self.push_branches()
-        self.push_tags()
+        if self.fetch_needed(fingerprint):
+            self.fetch()
+            self.record_step("fetch", state=fingerprint)
+        self._fingerprint = fingerprint
+        return True
+
+    def mirror_push(self):
+        """
+        The second half of mirror(), which pushes to the mirrors and stores
+        the fingerprint of the fetch.
+        """
+        self.push_mirrors()
+        self.update_object_pool()
+        self.mirror_lfs()
+        self.finish_run(self._fingerprint)
+
+    def reset(self):
+        """
+        Clears the results of the previous run, so a repo that is mirrored
+        again, such as in the daemon, starts from a clean state. The time
+        the repo waited in the queue for this run is kept.
+        """
+        queue_wait = self.metrics.get("queue_wait_seconds")
+        self.status = None
+        self.errors = []
+        self.unavailable_mirrors = []
+        self.durations = {}
+        self.metrics = {}
+        self.mirror_metrics = {}
+        self._fingerprint = None
+        if queue_wait is not None:
+            self.metrics["queue_wait_seconds"] = queue_wait
+
+    def completed(self) -> bool:
+        """Returns True if the resumed run already completed the repo."""
+        if self.step_completed("done"):
+            self.status = "skipped"
+            return True
+        return False
+
+    def unchanged(self, fingerprint: str) -> bool:
+        """
+        Returns True if the repo is skipped, because the fingerprint of the
+        main url did not change since the last successful run.
+        """
+        if self.repo is not None and fingerprint == self.stored_fingerprint():
+            self.status = "skipped"
+            self.record_step("done")
+            return True
+        return False
+
+    def fetch_needed(self, fingerprint: Optional[str]) -> bool:
+        # Without a fingerprint it is unknown whether the main repo changed
+        # since the fetch in the resumed run.
+        return fingerprint is None or not self.step_completed(
+            "fetch", state=fingerprint)
+
+    def finish_run(self, fingerprint: Optional[str]):
+        """Sets the status after the push and stores the fingerprint."""
+        if self.errors:
+            self.status = "failed"
+            return
+        if self.unavailable_mirrors:
+            self.status = "skipped"
+            return
+        # Only store the fingerprint after everything was pushed, so a failed
+        # run is retried the next time.
+        if fingerprint is not None:
+            self.fingerprint_file.write_text(fingerprint + "\n")
+        self.status = "synced"
+        self.record_step("done")
+
+    def mirror_lfs(self):
+        """
+        Copies the LFS objects of the commits that were not mirrored yet
+        from the main url to the mirrors, through the shared store. Objects
+        that are in the store are not downloaded again, and objects that a
+        mirror has are not uploaded. All commits are checked again when the
+        mirrors or the main url change.
+
+        The commits of a main url without an LFS server are stored as well,
+        so only new commits are checked for LFS objects, which are reported
+        but can not be mirrored.
+        """
+        if self.lfs_store is None or self.repo is None:
+            return
+        lfs_store = self.lfs_store
+        state = {"source": self.main_url,
+                 "mirrors": sorted(self.mirror_urls),
+                 "commits": sorted(set(self.local_refs.values()))}
+        mirrored = []  # type: List[str]
+        if self.lfs_state_file.exists():
+            stored = json.loads(self.lfs_state_file.read_text())
+            if (stored.get("source") == state["source"] and
+                    stored["mirrors"] == state["mirrors"]):
+                mirrored = stored["commits"]
+        errors = []  # type: List[Exception]
+        with self.timed("lfs"):
+            objects = lfs_pointers(self.repo_dir, state["commits"], mirrored)
+            if objects and lfs_endpoint(self.main_url) is None:
+                self.warn_no_lfs_server(self.main_url)
+            elif objects:
+                self.add_metric("lfs_received_bytes", lfs_store.download(
+                    self.main_url, objects, self.timeouts.get("fetch")))
+
+                def upload(url: str):
+                    try:
+                        sent = lfs_store.upload(url, objects,
+                                                self.timeouts.get("push"))
+                    except git.GitError as e:
+                        errors.append(e)
+                    else:
+                        self.add_metric("lfs_sent_bytes", sent, mirror=url)
+
+                urls = []  # type: List[str]
+                for url in self.mirror_urls:
+                    if lfs_endpoint(url) is None:
+                        self.warn_no_lfs_server(url)
+                    elif url not in self.unavailable_mirrors:
+                        urls.append(url)
+                if urls:
+                    with concurrent.futures.ThreadPoolExecutor(
+                            max_workers=min(self.mirror_threads, len(urls))
+                    ) as executor:
+                        list(executor.map(upload, urls))
+        self.errors.extend(errors)
+        if not errors and not self.unavailable_mirrors:
+            self.lfs_state_file.write_text(json.dumps(state))
+
+    def warn_no_lfs_server(self, url: str):
+        # Not an error, or the repo would fail on every run. Only git lfs
+        # can find the LFS server of an ssh url.
+        print("lfs: {0} has no http(s) url, so its LFS objects are not "
+              "mirrored ({1})".format(url, self.main_url),
+              file=sys.stderr, flush=True)
+
+    def maintain(self):
+        """Runs the repository maintenance if it is due."""
+        if self.maintenance is None or self.repo is None:
+            return
+        if self.maintenance.needed(self.repo_dir):
+            with self.timed("maintenance"):
+                self.maintenance.run(self.repo_dir)
+
+    def write_bundle(self):
+        """Writes a bundle to the reference cache if it is enabled."""
+        if (self.reference_cache is None or
+                not self.reference_cache.write_bundles or
+                self.status != "synced"):
+            return
+        with self.timed("bundle"):
+            self.reference_cache.write_bundle(self.repo_dir)
 
     @property
     def branches(self) -> List[str]:
@@ -103,16 +1852,396 @@ class GitRepo(object):
             raise ValueError("Can only be performed on cloned repos.")
 
 
+@contextlib.contextmanager
+def recorded_errors(repo: GitRepo) -> Iterator[None]:
+    """
+    Stores the errors of the with block on the repo instead of raising, and
+    adds the time spent to its total duration.
+    """
+    try:
+        with repo.timed("total"):
+            yield
+    except CircuitOpenError:
+        # Failing fast on a host that is down is not a new error. The
+        # failures that opened the circuit were recorded on other repos.
+        repo.status = "skipped"
+    except (ValueError, git.GitError) as e:
+        repo.errors.append(e)
+        repo.status = "failed"
+
+
+def mirror_repo(repo: GitRepo):
+    """
+    Mirrors a repo and stores errors on the repo instead of raising. The
+    maintenance runs after the mirroring, so it never runs during a sync of
+    the same repo.
+    """
+    with recorded_errors(repo):
+        repo.mirror()
+        repo.maintain()
+        repo.write_bundle()
+
+
+def fetch_repo(repo: GitRepo) -> bool:
+    """
+    The fetch stage of mirror_repo(). Returns whether the repo needs the
+    push stage, push_repo().
+    """
+    with recorded_errors(repo):
+        return repo.mirror_fetch()
+    return False
+
+
+def push_repo(repo: GitRepo):
+    """The push stage of mirror_repo()."""
+    with recorded_errors(repo):
+        repo.mirror_push()
+        repo.maintain()
+        repo.write_bundle()
+
+
+def audit_repos(repos: Iterable[GitRepo], number_of_threads: int,
+                output: TextIO) -> bool:
+    """
+    Audits number_of_threads repos at the same time and writes the report
+    of every repo as a JSON line to output when it is done. Returns whether
+    all repos are in sync.
+    """
+    in_sync = True
+    pending = set()  # type: set
+
+    def write_reports(
+            done: Iterable[concurrent.futures.Future]) -> bool:
+        reports = [future.result() for future in done]
+        for report in reports:
+            output.write(json.dumps(report) + "\n")
+        output.flush()
+        return all(report["status"] == "in sync" for report in reports)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=number_of_threads) as executor:
+        for repo in repos:
+            # Only a few repos are queued, so the repos can be streamed.
+            if len(pending) >= 2 * number_of_threads:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                in_sync = write_reports(done) and in_sync
+            pending.add(executor.submit(repo.audit))
+        in_sync = write_reports(
+            concurrent.futures.wait(pending).done) and in_sync
+    return in_sync
+
+
+class DurationStore(object):
+    """
+    The durations of earlier runs per repo, stored as JSON in path. Used to
+    estimate how long mirroring a repo will take.
+    """
+
+    # Weight of the newest run in the moving averages.
+    smoothing = 0.5
+    # Estimate in seconds when there is no history at all.
+    default_estimate = 60.0
+
+    def __init__(self, path: Path):
+        self.path = path
+        # repo name -> phase -> average seconds
+        self.durations = {}  # type: Dict[str, Dict[str, float]]
+        if self.path.exists():
+            self.durations = json.loads(self.path.read_text())
+        self._lock = threading.Lock()
+
+    def _median(self, phases: Tuple[str, ...]) -> float:
+        totals = sorted(sum(durations[phase] for phase in phases)
+                        for durations in self.durations.values()
+                        if all(phase in durations for phase in phases))
+        if not totals:
+            return self.default_estimate
+        return totals[len(totals) // 2]
+
+    def estimate(self, repo: GitRepo) -> float:
+        """
+        Returns the expected duration of repo.mirror() in seconds. Repos
+        without history get the median of the other repos.
+        """
+        with self._lock:
+            durations = self.durations.get(repo.repo_dir.name, {})
+            # repo.repo would open the clone.
+            if not repo.repo_dir.exists():
+                # A new clone.
+                phases = ("clone", "push")  # type: Tuple[str, ...]
+            else:
+                phases = ("total",)
+            if all(phase in durations for phase in phases):
+                return sum(durations[phase] for phase in phases)
+            return self._median(phases)
+
+    def record(self, repo: GitRepo):
+        """Adds the durations of the last run of repo."""
+        with self._lock:
+            durations = self.durations.setdefault(repo.repo_dir.name, {})
+            for phase, duration in repo.durations.items():
+                if phase in durations:
+                    duration = (self.smoothing * duration +
+                                (1 - self.smoothing) * durations[phase])
+                durations[phase] = duration
+
+    def save(self):
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(json.dumps(self.durations, indent=2,
+                                            sort_keys=True))
+
+
+def predicted_run_time(estimates: List[float],
+                       number_of_threads: int) -> float:
+    """
+    Returns the run time when jobs with the given durations are processed
+    longest first by number_of_threads threads.
+    """
+    loads = [0.0] * max(number_of_threads, 1)
+    for estimate in sorted(estimates, reverse=True):
+        heapq.heapreplace(loads, loads[0] + estimate)
+    return max(loads)
+
+
+def prometheus_labels(**labels: str) -> str:
+    escaped = ['{0}="{1}"'.format(
+        name, value.replace("\\", "\\\\").replace('"', '\\"').replace(
+            "\n", "\\n")) for name, value in sorted(labels.items())]
+    return "{" + ",".join(escaped) + "}"
+
+
+def add_prometheus_samples(repo: GitRepo, samples: Dict[str, List[str]]):
+    """Adds the samples of the last run of repo per metric name."""
+    for phase, duration in sorted(repo.durations.items()):
+        samples["phase_duration_seconds"].append("{0} {1}".format(
+            prometheus_labels(repo=repo.main_url, phase=phase), duration))
+    for name, value in sorted(repo.metrics.items()):
+        samples[name].append("{0} {1}".format(
+            prometheus_labels(repo=repo.main_url), value))
+    for mirror, metrics in sorted(repo.mirror_metrics.items()):
+        for name, value in sorted(metrics.items()):
+            samples[name].append("{0} {1}".format(
+                prometheus_labels(repo=repo.main_url, mirror=mirror), value))
+    samples["errors"].append("{0} {1}".format(
+        prometheus_labels(repo=repo.main_url), len(repo.errors)))
+    if repo.status is not None:
+        samples["status"].append("{0} 1".format(
+            prometheus_labels(repo=repo.main_url, status=repo.status)))
+
+
+def write_prometheus_samples(samples: Dict[str, List[str]], path: Path,
+                             run_duration: Optional[float] = None):
+    """
+    Writes the samples of a run, collected with add_prometheus_samples(), in
+    the format of the Prometheus node exporter's textfile collector. The
+    file is replaced atomically so the collector never reads a partial file.
+    """
+    lines = []  # type: List[str]
+    for name, help_text in sorted(METRICS.items()):
+        if not samples[name]:
+            continue
+        metric = "git_synchronizer_" + name
+        lines.append("# HELP {0} {1}".format(metric, help_text))
+        lines.append("# TYPE {0} gauge".format(metric))
+        lines.extend(metric + sample for sample in samples[name])
+    if run_duration is not None:
+        lines.append("git_synchronizer_run_duration_seconds {0}".format(
+            run_duration))
+    lines.append("git_synchronizer_last_run_timestamp_seconds {0}".format(
+        time.time()))
+    temporary_path = path.parent / Path("." + path.name + ".tmp")
+    temporary_path.write_text("\n".join(lines) + "\n")
+    os.replace(str(temporary_path), str(path))
+
+
+def json_line(repo: GitRepo, timestamp: float) -> str:
+    return json.dumps({
+        "timestamp": timestamp,
+        "repo": repo.main_url,
+        "status": repo.status,
+        "durations": repo.durations,
+        "metrics": repo.metrics,
+        "mirrors": repo.mirror_metrics,
+        "errors": [str(error) for error in repo.errors],
+    }, sort_keys=True) + "\n"
+
+
+class RunSummary(object):
+    """
+    Collects the results of a run as each repo finishes, so the repos do
+    not have to be kept until the end of the run. Prints the status of the
+    repo, records its durations and appends its metrics to metrics_json.
+    The prometheus samples are kept until they are written at the end.
+    """
+
+    def __init__(self, durations: Optional[DurationStore] = None,
+                 metrics_json: Optional[Path] = None,
+                 prometheus: bool = False):
+        self.durations = durations
+        self.metrics_json = metrics_json
+        self.prometheus_samples = (
+            {name: [] for name in METRICS} if prometheus else None
+        )  # type: Optional[Dict[str, List[str]]]
+        self.errors = []  # type: List[Exception]
+        self.timestamp = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, repo: GitRepo):
+        with self._lock:
+            print("{0}\t{1}".format(repo.status, repo.main_url), flush=True)
+            self.errors.extend(repo.errors)
+            if self.durations is not None:
+                self.durations.record(repo)
+            if self.metrics_json is not None:
+                with self.metrics_json.open("at") as json_h:
+                    json_h.write(json_line(repo, self.timestamp))
+            if self.prometheus_samples is not None:
+                add_prometheus_samples(repo, self.prometheus_samples)
+
+
+# Responses of servers that limit the number of requests.
+THROTTLE_REGEX = re.compile(
+    r"The requested URL returned error: 429|Too Many Requests|rate limit",
+    re.IGNORECASE)
+
+
+def is_congestion_error(error: Exception) -> bool:
+    """Whether error is a sign that too much is done at the same time."""
+    return (isinstance(error, OperationTimeout) or
+            is_connection_error(error) or
+            (isinstance(error, git.GitCommandError) and
+             THROTTLE_REGEX.search(str(error.stderr)) is not None))
+
+
+class ConcurrencyController(object):
+    """
+    Adjusts the number of repos that are mirrored at the same time during a
+    run, between minimum and maximum, with additive increase and
+    multiplicative decrease (AIMD).
+
+    After every window of as many completed repos as the current limit,
+    the limit is halved when a repo failed with a connection error, a
+    timeout or a throttling response, or when the median time per repo
+    became latency_factor times the best median so far without the number
+    of repos per second increasing. Otherwise the limit is increased by
+    one. Every change is written to output.
+    """
+
+    def __init__(self, minimum: int = 1, maximum: int = 16,
+                 latency_factor: float = 2.0,
+                 output: Optional[TextIO] = None):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.latency_factor = latency_factor
+        self.output = output
+        self.limit = self.minimum
+        # The limits that were chosen during the run, in order.
+        self.levels = [self.limit]
+        self._active = 0
+        self._condition = threading.Condition()
+        self._window_start = time.monotonic()
+        self._latencies = []  # type: List[float]
+        self._congested = 0
+        self._best_latency = None  # type: Optional[float]
+        self._throughput = 0.0
+
+    @contextlib.contextmanager
+    def slot(self) -> Iterator[None]:
+        """Waits until fewer than limit with blocks are running."""
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    def record(self, repo: GitRepo):
+        """Records a completed repo and adjusts the limit after a window."""
+        with self._condition:
+            self._latencies.append(repo.durations.get("total", 0.0))
+            if any(is_congestion_error(error) for error in repo.errors):
+                self._congested += 1
+            if len(self._latencies) >= self.limit:
+                self._adjust()
+                self._condition.notify_all()
+
+    def _adjust(self):
+        now = time.monotonic()
+        throughput = len(self._latencies) / max(now - self._window_start,
+                                                1e-6)
+        latency = sorted(self._latencies)[len(self._latencies) // 2]
+        slower = (self._best_latency is not None and
+                  latency > self.latency_factor * self._best_latency and
+                  throughput <= self._throughput)
+        old_limit = self.limit
+        if self._congested or slower:
+            self.limit = max(self.minimum, self.limit // 2)
+        else:
+            self.limit = min(self.maximum, self.limit + 1)
+        if self.limit != old_limit:
+            self.levels.append(self.limit)
+            if self.output is not None:
+                print("threads: {0} -> {1} ({2:.2f} repos/s, median "
+                      "{3:.1f}s per repo, {4} congestion errors)".format(
+                          old_limit, self.limit, throughput, latency,
+                          self._congested),
+                      file=self.output, flush=True)
+        if self._best_latency is None or latency < self._best_latency:
+            self._best_latency = latency
+        self._throughput = throughput
+        self._window_start = now
+        self._latencies = []
+        self._congested = 0
+
+
 class RepoQueue(queue.Queue):
-    """A queue object that will hold git repos to be cloned and mirrored."""
+    """
+    A queue object that will hold git repos to be cloned and mirrored.
+    If durations is given, the repos that are expected to take the longest
+    are processed first. Otherwise repos are processed in order. If
+    callback is given it is called with every repo when it is done. The
+    clone of a repo is closed when it is done.
+    """
 
     # Example taken from pytest-workflow's queue implementation.
 
-    def __init__(self):
+    def __init__(self, durations: Optional[DurationStore] = None,
+                 callback: Optional[Callable[[GitRepo], None]] = None):
+        self.durations = durations
+        self.callback = callback
         # We will allow infinite sizes of queues
         super().__init__()
         # This is to store errors during processing
-        self._process_errors = []
+        self._process_errors = []  # type: List[Exception]
+
+    # _init, _qsize, _put and _get are the hooks queue.Queue provides to
+    # change the order of the items.
+    def _init(self, maxsize):
+        # Heap of (-estimate, counter, repo).
+        self.queue = []  # type: List[Tuple[float, int, GitRepo]]
+        self._counter = 0
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        estimate = (self.durations.estimate(item)
+                    if self.durations is not None else 0.0)
+        self._counter += 1
+        heapq.heappush(self.queue, (-estimate, self._counter, item))
+        item.queued_at = time.monotonic()
+
+    def _get(self):
+        item = heapq.heappop(self.queue)[2]
+        item.add_metric("queue_wait_seconds",
+                        time.monotonic() - item.queued_at)
+        return item
 
     def put(self, item, block=True, timeout=None):
         """Like Queue.put(item) but tests if item is a repo."""
@@ -122,90 +2251,1123 @@ class RepoQueue(queue.Queue):
             raise ValueError("Only GitRepo objects can be submitted to this "
                              "queue")
 
-    def worker(self):
+    def worker(self, handoff: Optional[queue.Queue] = None,
+               controller: Optional[ConcurrencyController] = None):
         """
-        Clones repos until the queue is empty.
+        Clones repos until the queue is empty. With handoff the repos are
+        only fetched, and the repos that need a push are put in handoff.
+        With controller a repo is only started when the controller has a
+        free slot.
         """
         while True:
-            try:
-                # We know the type is GitRepo, because this was enforced in
-                # the put method.
-                repo = self.get_nowait()  # type: GitRepo
-            except queue.Empty:
-                break
-            else:
+            with contextlib.ExitStack() as stack:
+                if controller is not None:
+                    stack.enter_context(controller.slot())
+                try:
+                    # We know the type is GitRepo, because this was enforced
+                    # in the put method.
+                    repo = self.get_nowait()  # type: GitRepo
+                except queue.Empty:
+                    break
                 try:
-                    repo.mirror()
-                except (ValueError, git.GitError) as e:
-                    repo.errors.append(e)
+                    needs_push = False
+                    with self.unexpected_errors(repo):
+                        if handoff is None:
+                            mirror_repo(repo)
+                        else:
+                            needs_push = fetch_repo(repo)
+                    if controller is not None:
+                        controller.record(repo)
+                    if handoff is None or not needs_push:
+                        self.finish(repo)
+                    else:
+                        # Blocks while handoff is full, so fetched repos do
+                        # not pile up when pushing is slower than fetching.
+                        handoff.put(repo)
                 finally:
                     self.task_done()
 
-    def process(self, number_of_threads: int = 1):
+    def push_worker(self, handoff: queue.Queue):
+        """Pushes the repos from handoff until it gets None."""
+        while True:
+            repo = handoff.get()  # type: Optional[GitRepo]
+            if repo is None:
+                break
+            try:
+                with self.unexpected_errors(repo):
+                    push_repo(repo)
+            finally:
+                self.finish(repo)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def unexpected_errors(repo: GitRepo) -> Iterator[None]:
+        """
+        Stores errors that mirror_repo() does not catch on the repo. A
+        thread that died on them would leave the fetch threads waiting for
+        room in the handoff queue forever.
+        """
+        try:
+            yield
+        except Exception as e:
+            repo.errors.append(e)
+            repo.status = "failed"
+
+    def finish(self, repo: GitRepo):
+        if self.callback is not None:
+            self.callback(repo)
+        repo.close()
+
+    def process(self, number_of_threads: int = 1, push_threads: int = 0,
+                handoff_size: int = 0,
+                controller: Optional[ConcurrencyController] = None):
+        """
+        Mirrors the repos in number_of_threads threads. With push_threads
+        the fetches and pushes run in separate pools: number_of_threads
+        threads fetch and push_threads threads push. They are connected by
+        a queue that holds at most handoff_size fetched repos, push_threads
+        by default. With controller the controller decides how many of
+        controller.maximum threads mirror or fetch at the same time.
+        """
+        if controller is not None:
+            number_of_threads = controller.maximum
+        handoff = None  # type: Optional[queue.Queue]
+        push_workers = []
+        if push_threads > 0:
+            handoff = queue.Queue(handoff_size or push_threads)
+            for _ in range(push_threads):
+                thread = threading.Thread(target=self.push_worker,
+                                          args=(handoff,))
+                thread.start()
+                push_workers.append(thread)
         threads = []
         for _ in range(number_of_threads):
-            thread = threading.Thread(target=self.worker)
+            thread = threading.Thread(target=self.worker,
+                                      args=(handoff, controller))
             thread.start()
             threads.append(thread)
         self.join()
         for thread in threads:
             thread.join()
+        if handoff is not None:
+            for _ in push_workers:
+                handoff.put(None)
+            for thread in push_workers:
+                thread.join()
+
+
+class AsyncRepoQueue(object):
+    """
+    An alternative to RepoQueue that runs git as subprocesses from a single
+    asyncio event loop instead of using GitPython from multiple threads.
+    The results and errors stored on the GitRepo objects are the same as
+    those of GitRepo.mirror().
+    """
+
+    def __init__(self, max_per_host: int = 0,
+                 durations: Optional[DurationStore] = None,
+                 circuit_breaker: Optional[CircuitBreaker] = None,
+                 callback: Optional[Callable[[GitRepo], None]] = None):
+        self.durations = durations
+        # Called with every repo when it is done, as in RepoQueue.
+        self.callback = callback
+        self.circuit_breaker = (circuit_breaker if circuit_breaker is not None
+                                else CircuitBreaker())
+        self._repos = []  # type: List[GitRepo]
+        # Created in _process, so they belong to the running event loop.
+        # _semaphore limits the git processes, _repo_semaphore the repos
+        # that are mirrored at the same time.
+        self._semaphore = None  # type: Optional[asyncio.Semaphore]
+        self._repo_semaphore = None  # type: Optional[asyncio.Semaphore]
+        # 0 means no limit.
+        self.max_per_host = max_per_host
+        self._host_semaphores = {}  # type: Dict[str, asyncio.Semaphore]
+
+    def put(self, item):
+        """Adds a repo to the queue. Only GitRepo objects are allowed."""
+        if isinstance(item, GitRepo):
+            self._repos.append(item)
+        else:
+            raise ValueError("Only GitRepo objects can be submitted to this "
+                             "queue")
+
+    def process(self, max_operations: int = 1):
+        """
+        Mirrors all repos running at most max_operations git processes, and
+        at most max_operations repos at the same time.
+        """
+        if self.durations is not None:
+            # Waiting coroutines get the repo semaphore in order, so this
+            # starts the longest jobs first.
+            self._repos.sort(key=self.durations.estimate, reverse=True)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._process(max_operations))
+        finally:
+            loop.close()
+
+    async def _process(self, max_operations: int):
+        self._semaphore = asyncio.Semaphore(max_operations)
+        self._repo_semaphore = asyncio.Semaphore(max_operations)
+        await asyncio.gather(*[self._worker(repo) for repo in self._repos])
+
+    async def _git(self, *args: str, cwd: Optional[Path] = None,
+                   url: Optional[str] = None,
+                   progress: Optional[TransferProgress] = None,
+                   timeout: Optional[float] = None) -> str:
+        """
+        Runs a git command and returns its output. If the command connects
+        to url, the per host limit and the circuit breaker for url are
+        applied, as in GitRepo.remote_operation(). If progress is given
+        the progress output of the command is passed to it. git is killed
+        after timeout seconds.
+        """
+        if url is None:
+            return await self._run_git(*args, cwd=cwd, progress=progress,
+                                       timeout=timeout)
+        attempt = 0
+        while True:
+            self.circuit_breaker.check(url)
+            try:
+                output = await self._run_git_on_host(
+                    *args, cwd=cwd, url=url, progress=progress,
+                    timeout=timeout)
+            except OperationTimeout:
+                self.circuit_breaker.record_failure(url)
+                raise
+            except git.GitCommandError as e:
+                if not is_connection_error(e):
+                    self.circuit_breaker.record_success(url)
+                    raise
+                self.circuit_breaker.record_failure(url)
+                if (attempt >= self.circuit_breaker.retries or
+                        self.circuit_breaker.is_open(url)):
+                    raise
+                await asyncio.sleep(
+                    self.circuit_breaker.backoff_delay(attempt))
+                attempt += 1
+            else:
+                self.circuit_breaker.record_success(url)
+                return output
+
+    async def _run_git_on_host(self, *args: str, cwd: Optional[Path],
+                               url: str,
+                               progress: Optional[TransferProgress],
+                               timeout: Optional[float]) -> str:
+        host = url_host(url)
+        if host is not None and self.max_per_host > 0:
+            host_semaphore = self._host_semaphores.setdefault(
+                host, asyncio.Semaphore(self.max_per_host))
+            async with host_semaphore:
+                return await self._run_git(*args, cwd=cwd, progress=progress,
+                                           timeout=timeout)
+        return await self._run_git(*args, cwd=cwd, progress=progress,
+                                   timeout=timeout)
+
+    async def _run_git(self, *args: str, cwd: Optional[Path] = None,
+                       progress: Optional[TransferProgress] = None,
+                       timeout: Optional[float] = None) -> str:
+        assert self._semaphore is not None
+        async with self._semaphore:
+            # In its own process group, so the ssh or http helper processes
+            # of git can be killed with it.
+            process = await asyncio.create_subprocess_exec(
+                "git", *args,
+                cwd=str(cwd) if cwd is not None else None,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True)
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    # git exited just as the timeout expired.
+                    pass
+                await process.wait()
+                raise OperationTimeout(
+                    "git {0} timed out after {1} seconds".format(
+                        args[0], timeout))
+        if process.returncode != 0:
+            raise git.GitCommandError(["git"] + list(args),
+                                      process.returncode, stderr)
+        if progress is not None:
+            progress.parse_output(stderr.decode("utf-8", "replace"))
+        return stdout.decode("utf-8")
+
+    async def _worker(self, repo: GitRepo):
+        assert self._repo_semaphore is not None
+        loop = asyncio.get_event_loop()
+        queued_at = time.monotonic()
+        # The time waiting for the semaphore is not part of the total
+        # duration, as in RepoQueue.
+        async with self._repo_semaphore:
+            repo.add_metric("queue_wait_seconds",
+                            time.monotonic() - queued_at)
+            try:
+                # An error that escaped would abort all other repos in
+                # asyncio.gather.
+                with RepoQueue.unexpected_errors(repo), \
+                        recorded_errors(repo):
+                    # Opening the clone runs git, which would block the
+                    # loop.
+                    await loop.run_in_executor(None, repo.open)
+                    await self._mirror(repo)
+                    await loop.run_in_executor(None, repo.maintain)
+                    await loop.run_in_executor(None, repo.write_bundle)
+            finally:
+                if self.callback is not None:
+                    self.callback(repo)
+                repo.close()
+
+    async def _mirror(self, repo: GitRepo):
+        """
+        The equivalent of GitRepo.mirror(). Only the git commands are run
+        differently, the decisions are made by the same GitRepo methods.
+        """
+        repo.reset()
+        if repo.completed():
+            return
+        fingerprint = None  # type: Optional[str]
+        if repo.use_fingerprint:
+            with repo.timed("check"):
+                refs = parse_refs(await self._git(
+                    "ls-remote", repo.main_url, url=repo.main_url,
+                    timeout=repo.timeouts.get("check")))
+            fingerprint = repo.fingerprint_of(refs)
+            if repo.unchanged(fingerprint):
+                return
+        repo_dir = repo.repo_dir.absolute()
+        loop = asyncio.get_event_loop()
+        if repo.repo is None:
+            pool = await loop.run_in_executor(None, repo.find_object_pool)
+            seed = repo.find_seed()
+            progress = TransferProgress()
+            with repo.timed("clone"):
+                if repo.ref_filter or seed is not None:
+                    init_repo = await loop.run_in_executor(
+                        None, repo.init_clone, pool, seed)
+                    init_repo.close()
+                    await self._git("fetch", *FETCH_ARGS, cwd=repo_dir,
+                                    url=repo.main_url, progress=progress,
+                                    timeout=repo.timeouts.get("clone"))
+                else:
+                    await self._git("clone", *repo.clone_args(pool),
+                                    url=repo.main_url, progress=progress,
+                                    timeout=repo.timeouts.get("clone"))
+            await loop.run_in_executor(None, repo.cloned, progress)
+        if repo.fetch_needed(fingerprint):
+            progress = TransferProgress()
+            with repo.timed("fetch"):
+                await self._git("fetch", *FETCH_ARGS, cwd=repo_dir,
+                                url=repo.main_url, progress=progress,
+                                timeout=repo.timeouts.get("fetch"))
+            repo.add_fetch_metrics(progress)
+            repo.record_step("fetch", state=fingerprint)
+        if repo.mirrors:
+            with repo.timed("push"):
+                await self._push_mirrors(repo)
+        await loop.run_in_executor(None, repo.update_object_pool)
+        await loop.run_in_executor(None, repo.mirror_lfs)
+        repo.finish_run(fingerprint)
+
+    async def _push_mirrors(self, repo: GitRepo):
+        """The equivalent of GitRepo.push_mirrors()."""
+        repo_dir = repo.repo_dir.absolute()
+        loop = asyncio.get_event_loop()
+        state = await loop.run_in_executor(None, repo.push_state)
+        mirror_semaphore = asyncio.Semaphore(repo.mirror_threads)
+
+        async def push_refs(remote_name: str, url: str, *args: str):
+            """The equivalent of GitRepo._push()."""
+            progress = TransferProgress()
+            start = time.monotonic()
+            output = await self._git(
+                "push", *PUSH_ARGS, remote_name, *args,
+                cwd=repo_dir, url=url, progress=progress,
+                timeout=repo.timeouts.get("push"))
+            repo.add_push_metrics(url, progress, output,
+                                  time.monotonic() - start)
+
+        async def push(remote: git.Remote):
+            url = repo.mirror_url(remote)
+            if repo.step_completed("push", url, state):
+                return
+            with repo.mirror_errors(url):
+                async with mirror_semaphore:
+                    for args in repo.push_args():
+                        await push_refs(remote.name, url, *args)
+                repo.record_step("push", url, state)
+
+        await asyncio.gather(*[push(remote) for remote in repo.mirrors])
+
+
+# Options that can be set per repository in the config file with a
+# name=value column after the urls.
+CONFIG_OPTIONS = {"group", "interval", "include", "exclude"}
+CONFIG_OPTION_REGEX = re.compile(r"^(?P<name>[a-z_]+)=(?P<value>.*)$")
+
+
+ConfigEntry = Tuple[str, List[str], Dict[str, str]]
 
 
-def parse_config(config: Path) -> List[Tuple[str, List[str]]]:
+def webhook_urls(payload: dict) -> List[str]:
+    """
+    Returns the repository urls in a GitHub, GitLab or Gitea push event
+    payload.
+    """
+    urls = []  # type: List[str]
+    # GitHub and Gitea use "repository", GitLab uses "project" and the
+    # deprecated "repository".
+    for key in ("repository", "project"):
+        repository = payload.get(key)
+        if not isinstance(repository, dict):
+            continue
+        for url_key in ("clone_url", "ssh_url", "git_url", "html_url",
+                        "git_http_url", "git_ssh_url", "url", "homepage"):
+            url = repository.get(url_key)
+            if isinstance(url, str) and url:
+                urls.append(url)
+    return urls
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    """Triggers the daemon for the repository in a push event payload."""
+
+    def _respond(self, code: int, message: str):
+        body = (message + "\n").encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self, body: bytes) -> bool:
+        secret = cast(WebhookServer, self.server).secret
+        if secret is None:
+            return True
+        # GitLab sends the secret itself.
+        token = self.headers.get("X-Gitlab-Token")
+        if token is not None:
+            return hmac.compare_digest(token, secret)
+        # GitHub and Gitea sign the body.
+        digest = hmac.new(secret.encode("utf-8"), body,
+                          hashlib.sha256).hexdigest()
+        signature = (self.headers.get("X-Hub-Signature-256") or
+                     self.headers.get("X-Gitea-Signature") or "")
+        if signature.startswith("sha256="):
+            signature = signature[len("sha256="):]
+        return hmac.compare_digest(signature, digest)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self._authorized(body):
+            self._respond(403, "Invalid secret")
+            return
+        try:
+            payload = json.loads(body.decode("utf-8"))
+        except ValueError:
+            self._respond(400, "Invalid JSON")
+            return
+        if not isinstance(payload, dict):
+            self._respond(400, "Invalid payload")
+            return
+        daemon = cast(WebhookServer, self.server).daemon
+        source_url = daemon.find_source_url(webhook_urls(payload))
+        if source_url is None or not daemon.trigger(source_url):
+            self._respond(404, "Repository not in config")
+            return
+        self._respond(202, "Queued {0}".format(source_url))
+
+    def log_message(self, format, *args):
+        print("webhook: " + format % args, file=sys.stderr, flush=True)
+
+
+class WebhookServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    HTTP server that accepts push event webhooks from GitHub, GitLab and
+    Gitea and lets the daemon mirror only the repository that changed.
+    When secret is set, requests must contain the secret (GitLab) or be
+    signed with it (GitHub, Gitea).
+    """
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], daemon: "Daemon",
+                 secret: Optional[str] = None):
+        super().__init__(address, WebhookHandler)
+        self.daemon = daemon
+        self.secret = secret
+
+
+class Daemon(object):
+    """
+    Keeps the repos from the config file in memory and mirrors each repo at
+    its own interval, using number_of_threads worker threads. The config
+    file is checked for changes every reload_interval seconds. Only the
+    repos whose config line was added or changed are (re)created. The
+    clones stay open between runs, and are closed when their config line is
+    removed or changed.
+
+    A repo can be mirrored before its interval has passed with trigger(),
+    for instance by the WebhookServer.
+    """
+
+    def __init__(self,
+                 config: Path,
+                 repo_factory: Callable[[str, List[str], Dict[str, str]],
+                                        GitRepo],
+                 default_interval: float = 300,
+                 number_of_threads: int = 1,
+                 reload_interval: float = 5,
+                 shard_index: int = 0,
+                 shard_count: int = 1):
+        self.config = config
+        self.repo_factory = repo_factory
+        self.default_interval = default_interval
+        self.number_of_threads = number_of_threads
+        self.reload_interval = reload_interval
+        # Only the repos of this shard are mirrored. See shard_of().
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        # source url -> (repo, config entry, interval)
+        self.repos = {}  # type: Dict[str, Tuple[GitRepo, ConfigEntry, float]]
+        # Heap of (due time, counter, source url, repo). The counter makes
+        # sure repos are never compared.
+        self._schedule = []  # type: List[Tuple[float, int, str, GitRepo]]
+        self._counter = 0
+        # source url -> (due time, counter) of the only valid entry in the
+        # schedule. Other entries for the same url are skipped.
+        self._entries = {}  # type: Dict[str, Tuple[float, int]]
+        self._running = set()  # type: set
+        # Repos that were triggered while they were running.
+        self._rerun = set()  # type: set
+        # normalize_url(source url) -> source url
+        self._normalized_urls = {}  # type: Dict[str, str]
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._config_mtime = None  # type: Optional[float]
+
+    def _schedule_repo(self, source_url: str, repo: GitRepo, due: float):
+        # Must be called while holding self._condition.
+        self._counter += 1
+        heapq.heappush(self._schedule, (due, self._counter, source_url, repo))
+        self._entries[source_url] = (due, self._counter)
+        self._condition.notify()
+
+    def trigger(self, source_url: str) -> bool:
+        """
+        Mirrors the repo as soon as possible. Returns False if the repo is
+        not in the config. Triggers for a repo that is already due or
+        running are merged into one run.
+        """
+        with self._condition:
+            current = self.repos.get(source_url)
+            if current is None:
+                return False
+            now = time.monotonic()
+            if source_url in self._running:
+                self._rerun.add(source_url)
+            elif self._entries.get(source_url, (now + 1, 0))[0] > now:
+                self._schedule_repo(source_url, current[0], now)
+            return True
+
+    def find_source_url(self, urls: Iterable[str]) -> Optional[str]:
+        """Returns the source url in the config that matches one of urls."""
+        with self._condition:
+            for url in urls:
+                source_url = self._normalized_urls.get(normalize_url(url))
+                if source_url is not None:
+                    return source_url
+        return None
+
+    def reload_config(self):
+        """
+        Applies the changes in the config file since the last load. If the
+        config can not be read, the error is printed and the current repos
+        are kept. It is read again when it changes.
+        """
+        try:
+            self._reload_config()
+        except (OSError, ValueError) as e:
+            print("Could not reload {0}: {1}".format(self.config, e),
+                  file=sys.stderr, flush=True)
+
+    def _reload_config(self):
+        mtime = self.config.stat().st_mtime
+        if mtime == self._config_mtime:
+            return
+        self._config_mtime = mtime
+        entries = {entry[0]: entry for entry in parse_config(self.config)
+                   if shard_of(entry[0], self.shard_count) ==
+                   self.shard_index}
+        # The new repos are created before anything is changed, so an
+        # invalid line leaves the current repos alone. Only the main thread
+        # changes self.repos.
+        new_repos = {}  # type: Dict[str, Tuple[GitRepo, ConfigEntry, float]]
+        for source_url, entry in entries.items():
+            if (source_url in self.repos and
+                    self.repos[source_url][1] == entry):
+                continue
+            _, mirror_urls, options = entry
+            interval = float(options.get("interval", self.default_interval))
+            new_repos[source_url] = (
+                self.repo_factory(source_url, mirror_urls, options), entry,
+                interval)
+        now = time.monotonic()
+        with self._condition:
+            for source_url in set(self.repos) - set(entries):
+                # Removed repos are skipped when their schedule entry comes
+                # up.
+                self._release(source_url)
+                del self.repos[source_url]
+                self._entries.pop(source_url, None)
+            self._normalized_urls = {normalize_url(source_url): source_url
+                                     for source_url in entries}
+            for source_url, new_repo in new_repos.items():
+                self._release(source_url)
+                self.repos[source_url] = new_repo
+                self._schedule_repo(source_url, new_repo[0], now)
+
+    def _release(self, source_url: str):
+        """
+        Closes the clone of a repo that is removed from the config. A
+        running repo is closed by its worker when it is done.
+        """
+        # Must be called while holding self._condition.
+        if source_url in self.repos and source_url not in self._running:
+            self.repos[source_url][0].close()
+
+    def _next_repo(self) -> Optional[GitRepo]:
+        """Waits for the next due repo. Returns None when stopped."""
+        with self._condition:
+            while not self._stopped:
+                if not self._schedule:
+                    self._condition.wait()
+                    continue
+                due, counter, source_url, repo = self._schedule[0]
+                now = time.monotonic()
+                if self._entries.get(source_url) != (due, counter):
+                    # Removed, replaced or rescheduled.
+                    heapq.heappop(self._schedule)
+                elif due > now:
+                    self._condition.wait(due - now)
+                elif source_url in self._running:
+                    # The previous version of this repo is still being
+                    # mirrored. Try again later.
+                    heapq.heappop(self._schedule)
+                    self._schedule_repo(source_url, repo, now + 1)
+                else:
+                    heapq.heappop(self._schedule)
+                    del self._entries[source_url]
+                    self._running.add(source_url)
+                    return repo
+            return None
+
+    def worker(self):
+        while True:
+            repo = self._next_repo()
+            if repo is None:
+                break
+            with RepoQueue.unexpected_errors(repo):
+                mirror_repo(repo)
+            print("{0}\t{1}".format(repo.status, repo.main_url), flush=True)
+            for error in repo.errors:
+                print(str(error), file=sys.stderr, flush=True)
+            with self._condition:
+                self._running.discard(repo.main_url)
+                rerun = repo.main_url in self._rerun
+                self._rerun.discard(repo.main_url)
+                current = self.repos.get(repo.main_url)
+                if current is not None and current[0] is repo:
+                    due = time.monotonic() if rerun else (
+                        time.monotonic() + current[2])
+                    self._schedule_repo(repo.main_url, repo, due)
+                else:
+                    # Its config line was removed or changed while it was
+                    # running.
+                    repo.close()
+
+    def run(self):
+        """Runs until stop() is called."""
+        threads = []
+        for _ in range(self.number_of_threads):
+            thread = threading.Thread(target=self.worker)
+            thread.start()
+            threads.append(thread)
+        try:
+            while True:
+                with self._condition:
+                    if self._stopped:
+                        break
+                self.reload_config()
+                with self._condition:
+                    self._condition.wait_for(lambda: self._stopped,
+                                             self.reload_interval)
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join()
+            for repo, _, _ in self.repos.values():
+                repo.close()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+
+def parse_config(config: Path
+                 ) -> List[Tuple[str, List[str], Dict[str, str]]]:
+    return list(iter_config(config))
+
+
+def iter_config(config: Path) -> Iterator[ConfigEntry]:
+    """Yields the entries of the config file one line at a time."""
     with config.open('rt') as config_h:
-        config_lines = config_h.readlines()
-    config_list = []
-    for line in config_lines:
-        clean_line = line.strip()
-        source_url = clean_line.split('\t')[0]
-        dest_urls = clean_line.split('\t')[1:]
-        config_list.append((source_url, dest_urls))
-    return config_list
+        for line in config_h:
+            yield parse_config_line(line)
+
+
+def parse_config_line(line: str) -> ConfigEntry:
+    clean_line = line.strip()
+    source_url = clean_line.split('\t')[0]
+    dest_urls = []  # type: List[str]
+    options = {}  # type: Dict[str, str]
+    for column in clean_line.split('\t')[1:]:
+        match = CONFIG_OPTION_REGEX.match(column)
+        if match is None:
+            dest_urls.append(column)
+        elif match.group("name") in CONFIG_OPTIONS:
+            options[match.group("name")] = match.group("value")
+            if match.group("name") in ("include", "exclude"):
+                try:
+                    check_ref_patterns(
+                        split_patterns(match.group("value")) or [])
+                except ValueError as e:
+                    raise ValueError("{0} for {1}".format(e, source_url))
+        else:
+            raise ValueError("Unknown option '{0}' for {1}".format(
+                match.group("name"), source_url))
+    return source_url, dest_urls, options
+
+
+def parse_threads(value: str) -> Optional[int]:
+    """Parses --threads, which is a number or auto (None)."""
+    if value == "auto":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "'{0}' is not a number or auto".format(value))
 
 
 def argument_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument("--clone-dir", type=Path, dest="clone_dir",
-                        required=True,
                         help="Where repositories should be cloned on the "
-                             "local machine.")
+                             "local machine. Required, except with "
+                             "--print-shards.")
     parser.add_argument("--config", type=Path, required=True,
                         help="The tab delimited configuration file. In the "
                              "form: \nmain_git_url<tab>mirror_git_url1<tab>"
                              "mirror_git_url2 etc. Number of mirror_git_urls "
                              "should be at least 1.")
-    parser.add_argument("--threads", type=int, default=1,
+    parser.add_argument("--threads", type=parse_threads, default=1,
                         help="The number of git operations which will be "
-                             "performed at the same time.")
+                             "performed at the same time. 'auto' adjusts "
+                             "the number during the run between "
+                             "--min-threads and --max-threads, based on the "
+                             "repositories per second, the time per "
+                             "repository and connection, timeout and "
+                             "throttling errors. The chosen numbers are "
+                             "printed to stderr.")
+    parser.add_argument("--min-threads", type=int, default=1,
+                        dest="min_threads",
+                        help="The lowest number of threads for --threads "
+                             "auto. Default: 1.")
+    parser.add_argument("--max-threads", type=int, default=16,
+                        dest="max_threads",
+                        help="The highest number of threads for --threads "
+                             "auto. Default: 16.")
+    parser.add_argument("--push-threads", type=int, default=0,
+                        dest="push_threads",
+                        help="Push in this many separate threads, so "
+                             "fetches and pushes of different repositories "
+                             "overlap. --threads then sets the number of "
+                             "threads that clone and fetch. Default: 0, "
+                             "every thread fetches and pushes.")
+    parser.add_argument("--handoff-size", type=int, default=0,
+                        dest="handoff_size",
+                        help="With --push-threads, the number of fetched "
+                             "repositories that can wait for a push thread. "
+                             "Fetching pauses when this many are waiting. "
+                             "Default: the number of push threads.")
+    parser.add_argument("--engine", choices=["threads", "asyncio"],
+                        default="threads",
+                        help="How git operations are run. 'threads' uses "
+                             "GitPython in --threads threads. 'asyncio' runs "
+                             "git processes from a single thread, with at "
+                             "most --threads processes and repositories at "
+                             "the same time. "
+                             "This scales to hundreds of simultaneous "
+                             "operations.")
+    parser.add_argument("--force", action="store_true",
+                        help="Synchronize all repositories, also the ones "
+                             "whose refs did not change since the last "
+                             "successful run.")
+    parser.add_argument("--ref-diff-push", action="store_true",
+                        dest="ref_diff_push",
+                        help="Push the branches and tags to each mirror in "
+                             "a single push, in which git only sends the "
+                             "refs that differ from the mirror. Branches "
+                             "and tags that no longer exist in the main "
+                             "repository are deleted from the mirrors.")
+    parser.add_argument("--mirror-threads", type=int, default=1,
+                        dest="mirror_threads",
+                        help="The number of mirrors of a single repository "
+                             "that are pushed to at the same time. This is "
+                             "in addition to --threads.")
+    parser.add_argument("--host-limit", type=int, default=0,
+                        dest="host_limit",
+                        help="The maximum number of git operations on the "
+                             "same host at the same time. By default there "
+                             "is no limit.")
+    parser.add_argument("--host-failure-limit", type=int, default=5,
+                        dest="host_failure_limit",
+                        help="After this many consecutive connection "
+                             "failures on a host, skip the remaining "
+                             "operations on that host instead of waiting for "
+                             "the network timeouts. The host is tried again "
+                             "after 300 seconds. 0 disables this. "
+                             "Default: 5.")
+    parser.add_argument("--retries", type=int, default=2,
+                        help="The number of times a git operation is retried "
+                             "after a connection failure. Default: 2.")
+    parser.add_argument("--retry-backoff", type=float, default=1.0,
+                        dest="retry_backoff",
+                        help="The maximum delay in seconds before the first "
+                             "retry. The maximum doubles for every next "
+                             "retry. The actual delay is random. "
+                             "Default: 1.")
+    parser.add_argument("--include-refs", dest="include_refs",
+                        help="Comma separated patterns of the refs that are "
+                             "mirrored, for instance 'refs/heads/*,"
+                             "refs/tags/*'. Other refs are not fetched. Can "
+                             "be set per repository with an "
+                             "include=<patterns> column in the config file. "
+                             "Default: all refs.")
+    parser.add_argument("--exclude-refs", dest="exclude_refs",
+                        help="Comma separated patterns of refs that are not "
+                             "mirrored, for instance 'refs/pull/*'. Can be "
+                             "set per repository with an exclude=<patterns> "
+                             "column in the config file. Requires git 2.29 "
+                             "or later.")
+    parser.add_argument("--timeout", type=parse_timeout, action="append",
+                        default=[], metavar="PHASE=SECONDS",
+                        help="Kill git and record a timeout error when a "
+                             "phase takes longer than SECONDS. PHASE is one "
+                             "of {0}; push is the time for a single push "
+                             "to a mirror. Can be given once per phase."
+                             .format(", ".join(TIMEOUT_PHASES)))
+    parser.add_argument("--low-speed-limit", type=int,
+                        dest="low_speed_limit",
+                        help="Abort http transfers that are slower than this "
+                             "many bytes per second for --low-speed-time "
+                             "seconds. Also aborts ssh connections on which "
+                             "the server stops responding for that long.")
+    parser.add_argument("--low-speed-time", type=int, default=60,
+                        dest="low_speed_time",
+                        help="See --low-speed-limit. Default: 60.")
+    parser.add_argument("--ssh-multiplexing", action="store_true",
+                        dest="ssh_multiplexing",
+                        help="Reuse a single ssh connection for all git "
+                             "operations on the same host, instead of "
+                             "connecting for every fetch and push.")
+    parser.add_argument("--shared-objects", action="store_true",
+                        dest="shared_objects",
+                        help="Share the git objects of related repositories "
+                             "in pools in the clone directory, instead of "
+                             "storing them for every repository. Repositories "
+                             "are related if they are in the same group (set "
+                             "with a group=<name> column in the config file) "
+                             "or, without a group, if they have the same root "
+                             "commit.")
+    parser.add_argument("--shard-count", type=int, default=1,
+                        dest="shard_count",
+                        help="The number of hosts that share the config "
+                             "file. Every repository is mirrored by one of "
+                             "them, based on a hash of its source url. "
+                             "Adding a host moves only the repositories that "
+                             "are assigned to the new host.")
+    parser.add_argument("--shard-index", type=int, default=0,
+                        dest="shard_index",
+                        help="The shard of this host, from 0 to "
+                             "--shard-count - 1. Only the repositories of "
+                             "this shard are mirrored.")
+    parser.add_argument("--print-shards", action="store_true",
+                        dest="print_shards",
+                        help="Print the shard index and source url of every "
+                             "repository in the config file for "
+                             "--shard-count shards and exit.")
+    parser.add_argument("--maintenance", action="store_true",
+                        help="Repack the clones, and write "
+                             "multi-pack-indexes, reachability bitmaps and "
+                             "commit-graphs for them, after they are "
+                             "synchronized. This runs at low priority when "
+                             "one of the --maintenance-* thresholds is "
+                             "exceeded.")
+    parser.add_argument("--maintenance-loose-objects", type=int,
+                        default=1000, dest="maintenance_loose_objects",
+                        help="Run maintenance when a clone has at least this "
+                             "many loose objects. Default: 1000.")
+    parser.add_argument("--maintenance-packs", type=int, default=20,
+                        dest="maintenance_packs",
+                        help="Run maintenance when a clone has at least this "
+                             "many packs. Default: 20.")
+    parser.add_argument("--maintenance-interval", type=float,
+                        default=7 * 24 * 3600, dest="maintenance_interval",
+                        help="Run maintenance when it did not run for this "
+                             "many seconds. Default: one week.")
+    parser.add_argument("--reference-dir", type=Path, dest="reference_dir",
+                        help="Seed new clones from the bare repositories "
+                             "(<name>.git) and git bundles (<name>.bundle) "
+                             "in this directory, such as a copy of an old "
+                             "clone directory. Only the objects that are "
+                             "missing are downloaded.")
+    parser.add_argument("--write-bundles", action="store_true",
+                        dest="write_bundles",
+                        help="Write a git bundle to --reference-dir for "
+                             "every synchronized repository that has none.")
+    parser.add_argument("--lfs", action="store_true",
+                        help="Also mirror the Git LFS objects of the "
+                             "commits that were not mirrored yet. The "
+                             "objects are kept in .lfs-objects in the clone "
+                             "directory, shared by all repositories, and "
+                             "only uploaded to mirrors that do not have "
+                             "them. Only http(s) urls are supported.")
+    parser.add_argument("--lfs-threads", type=int, default=4,
+                        dest="lfs_threads",
+                        help="The number of LFS objects that are transferred "
+                             "at the same time per repository and mirror. "
+                             "Default: 4.")
+    parser.add_argument("--audit", action="store_true",
+                        help="Only compare the refs of the mirrors and the "
+                             "clones to the refs of the sources, using "
+                             "ls-remote, without fetching or pushing. A "
+                             "JSON line with the missing, stale and extra "
+                             "refs of every repository is printed. Exits "
+                             "with status 1 if any repository is not in "
+                             "sync.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue the last run if it was interrupted, "
+                             "skipping the fetches and pushes it completed. "
+                             "The completed steps of every run are recorded "
+                             "in .journal.sqlite in the clone directory.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running and mirror every repository "
+                             "periodically. Changes to the config file are "
+                             "applied while running.")
+    parser.add_argument("--interval", type=float, default=300,
+                        help="The number of seconds between two "
+                             "synchronizations of a repository in --daemon "
+                             "mode. Can be set per repository with an "
+                             "interval=<seconds> column in the config file.")
+    parser.add_argument("--webhook-port", type=int, dest="webhook_port",
+                        help="In --daemon mode, listen on this port for "
+                             "GitHub, GitLab or Gitea push webhooks and "
+                             "mirror the pushed repository right away.")
+    parser.add_argument("--webhook-address", default="",
+                        dest="webhook_address",
+                        help="The address the webhook server listens on. "
+                             "Default: all addresses.")
+    parser.add_argument("--webhook-secret", dest="webhook_secret",
+                        help="The secret that is configured for the "
+                             "webhooks. Requests without it are rejected.")
+    parser.add_argument("--metrics-prometheus", type=Path,
+                        dest="metrics_prometheus",
+                        help="Write the durations and transfer metrics of "
+                             "the run to this file, for the Prometheus node "
+                             "exporter's textfile collector. Not with "
+                             "--daemon.")
+    parser.add_argument("--metrics-json", type=Path, dest="metrics_json",
+                        help="Append the durations and transfer metrics of "
+                             "every repository to this file as JSON lines. "
+                             "Not with --daemon.")
     return parser
 
 
 def main():
-    args = argument_parser().parse_args()
+    parser = argument_parser()
+    args = parser.parse_args()
+    if args.daemon and args.engine != "threads":
+        parser.error("--daemon can only be used with the threads engine.")
+    if args.threads is None and (args.engine != "threads" or args.daemon):
+        parser.error("--threads auto can only be used with the threads "
+                     "engine and without --daemon.")
+    if args.push_threads and args.engine != "threads":
+        parser.error("--push-threads can only be used with the threads "
+                     "engine.")
+    if args.webhook_port is not None and not args.daemon:
+        parser.error("--webhook-port can only be used with --daemon.")
+    if args.resume and args.daemon:
+        parser.error("--resume can not be used with --daemon.")
+    if args.daemon and (args.metrics_prometheus is not None or
+                        args.metrics_json is not None):
+        parser.error("--metrics-prometheus and --metrics-json can not be "
+                     "used with --daemon.")
+    if args.audit and (args.daemon or args.resume):
+        parser.error("--audit can not be used with --daemon or --resume.")
+    if args.write_bundles and args.reference_dir is None:
+        parser.error("--write-bundles can only be used with --reference-dir.")
+    if args.shard_count < 1:
+        parser.error("--shard-count must be at least 1.")
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error("--shard-index must be from 0 to --shard-count - 1.")
+    try:
+        RefFilter(split_patterns(args.include_refs),
+                  split_patterns(args.exclude_refs))
+    except ValueError as e:
+        parser.error(str(e))
+    if args.print_shards:
+        for source_url, _, _ in iter_config(args.config):
+            print("{0}\t{1}".format(
+                shard_of(source_url, args.shard_count), source_url))
+        return
+    if args.clone_dir is None:
+        parser.error("--clone-dir is required.")
     clone_dir = args.clone_dir  # type: Path
-    configuration = parse_config(
-        args.config)  # type: List[Tuple[str, List[str]]]
-    repo_queue = RepoQueue()
-    repos = []  # type: List[GitRepo]
-    for source_url, mirror_urls in configuration:
-        git_repo = GitRepo(
+
+    def configuration() -> Iterator[ConfigEntry]:
+        # The config is streamed, so large configs are never held in
+        # memory as a whole.
+        return (entry for entry in iter_config(args.config)
+                if shard_of(entry[0], args.shard_count) == args.shard_index)
+
+    # With --threads auto the controller chooses up to --max-threads.
+    controller = (ConcurrencyController(args.min_threads, args.max_threads,
+                                        output=sys.stderr)
+                  if args.threads is None else None)
+    threads = args.threads if args.threads is not None else args.max_threads
+    durations = DurationStore(clone_dir / Path(".durations.json"))
+    summary = RunSummary(durations, metrics_json=args.metrics_json,
+                         prometheus=args.metrics_prometheus is not None)
+    circuit_breaker = CircuitBreaker(
+        failure_threshold=args.host_failure_limit, retries=args.retries,
+        backoff=args.retry_backoff)
+    if args.engine == "asyncio":
+        repo_queue = AsyncRepoQueue(max_per_host=args.host_limit,
+                                    durations=durations,
+                                    circuit_breaker=circuit_breaker,
+                                    callback=summary.add)
+    else:
+        repo_queue = RepoQueue(durations, callback=summary.add)
+    host_limiter = HostLimiter(args.host_limit)
+    object_pools = (ObjectPools(clone_dir / Path(".object-pools"))
+                    if args.shared_objects else None)
+    maintenance = (RepoMaintenance(args.maintenance_loose_objects,
+                                   args.maintenance_packs,
+                                   args.maintenance_interval)
+                   if args.maintenance else None)
+    reference_cache = (ReferenceCache(args.reference_dir, args.write_bundles)
+                       if args.reference_dir is not None else None)
+    lfs_store = (LFSStore(clone_dir / Path(".lfs-objects"), args.lfs_threads)
+                 if args.lfs else None)
+    journal = RunJournal(clone_dir / Path(".journal.sqlite"))
+
+    def new_repo(source_url: str, mirror_urls: List[str],
+                 options: Dict[str, str]) -> GitRepo:
+        return GitRepo(
             main_url=source_url,
             mirror_urls=mirror_urls,
             # Use the last part of the repo url to clone.
             # https://github.com/LUMC/git-synchronizer.git -> git-synchronizer.git  # noqa: E501
-            repo_dir=clone_dir / Path(source_url.split('/')[-1])
+            repo_dir=clone_dir / Path(source_url.split('/')[-1]),
+            use_fingerprint=not args.force,
+            ref_diff_push=args.ref_diff_push,
+            mirror_threads=args.mirror_threads,
+            host_limiter=host_limiter,
+            circuit_breaker=circuit_breaker,
+            object_pools=object_pools,
+            object_group=options.get("group"),
+            maintenance=maintenance,
+            # A daemon has no runs to resume.
+            journal=journal if not args.daemon else None,
+            ref_filter=RefFilter(
+                split_patterns(options.get("include", args.include_refs)),
+                split_patterns(options.get("exclude", args.exclude_refs))),
+            timeouts=dict(args.timeout),
+            reference_cache=reference_cache,
+            lfs_store=lfs_store
         )
-        repos.append(git_repo)
-        repo_queue.put(git_repo)
-    repo_queue.process(number_of_threads=args.threads)
-    errors = []  # type: List[Exception]
-    for repo in repos:
-        errors.extend(repo.errors)
-
-    if len(errors) > 0:
+
+    estimates = []  # type: List[float]
+    with contextlib.ExitStack() as stack:
+        # Taken before the repos are opened, as opening sets their urls.
+        # An audit only reads, so it can run next to a sync.
+        if not args.audit:
+            stack.enter_context(journal.lock())
+        if not args.daemon and not args.audit:
+            journal.start(resume=args.resume)
+            for source_url, mirror_urls, options in configuration():
+                git_repo = new_repo(source_url, mirror_urls, options)
+                estimates.append(durations.estimate(git_repo))
+                repo_queue.put(git_repo)
+        if args.low_speed_limit is not None:
+            # Before the SSHMultiplexer, which adds to GIT_SSH_COMMAND.
+            stack.enter_context(environment(low_speed_environment(
+                args.low_speed_limit, args.low_speed_time)))
+        if args.ssh_multiplexing:
+            stack.enter_context(SSHMultiplexer(
+                url for source_url, mirror_urls, _ in configuration()
+                for url in [source_url] + mirror_urls))
+        if args.audit:
+            in_sync = audit_repos(
+                (new_repo(source_url, mirror_urls, options)
+                 for source_url, mirror_urls, options in configuration()),
+                threads, sys.stdout)
+            sys.exit(0 if in_sync else 1)
+        if args.daemon:
+            daemon = Daemon(args.config, new_repo,
+                            default_interval=args.interval,
+                            number_of_threads=args.threads,
+                            shard_index=args.shard_index,
+                            shard_count=args.shard_count)
+            signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+            if args.webhook_port is not None:
+                webhook_server = WebhookServer(
+                    (args.webhook_address, args.webhook_port), daemon,
+                    secret=args.webhook_secret)
+                threading.Thread(target=webhook_server.serve_forever,
+                                 daemon=True).start()
+                stack.callback(webhook_server.server_close)
+                stack.callback(webhook_server.shutdown)
+            try:
+                daemon.run()
+            except KeyboardInterrupt:
+                pass
+            return
+        predicted = predicted_run_time(estimates, threads)
+        start = time.monotonic()
+        if isinstance(repo_queue, RepoQueue):
+            repo_queue.process(threads, args.push_threads, args.handoff_size,
+                               controller)
+        else:
+            repo_queue.process(args.threads)
+        actual = time.monotonic() - start
+        journal.finish()
+        durations.save()
+    if summary.prometheus_samples is not None:
+        write_prometheus_samples(summary.prometheus_samples,
+                                 args.metrics_prometheus, actual)
+    print("Predicted run time: {0:.1f}s. Actual run time: {1:.1f}s.".format(
+        predicted, actual))
+
+    if len(summary.errors) > 0:
         raise ValueError("errors were found: {0}".format(
-            [str(error) for error in errors]))
+            [str(error) for error in summary.errors]))
 
 
 if __name__ == "__main__":
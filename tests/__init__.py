@@ -14,11 +14,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
 
+import http.server
+import os
+import subprocess
 import tempfile
 from pathlib import Path
+from typing import List, Optional
 
 import git
 
+from git_synchronizer.git_synchronizer import (AsyncRepoQueue, GitRepo,
+                                               mirror_repo)
+
 
 def clone_this_repo() -> git.Repo:
     this_repo = Path(__file__).parent.parent
@@ -31,3 +38,90 @@ def empty_repo() -> git.Repo:
         tempfile.mkdtemp(suffix=".git", prefix="mirror1")).absolute()
     repo = git.Repo.init(str(temp_dir), bare=True)
     return repo
+
+
+def file_url(repo: git.Repo) -> str:
+    """
+    A file:// url for repo. Unlike a path, git transfers objects for it and
+    reports the progress.
+    """
+    return "file://" + str(repo.working_dir)
+
+
+def new_git_repo(main_url: Optional[str] = None,
+                 mirror_urls: Optional[List[str]] = None,
+                 **kwargs) -> GitRepo:
+    """
+    A GitRepo with its clone in a new directory. The main url is a clone of
+    this repo and there is one empty mirror, unless they are given.
+    """
+    clone_dir = Path(tempfile.mkdtemp(prefix="clone_dir")) / Path(
+        "git-synchronizer.git")
+    if main_url is None:
+        main_url = str(clone_this_repo().working_dir)
+    if mirror_urls is None:
+        mirror_urls = [str(empty_repo().working_dir)]
+    return GitRepo(main_url=main_url, mirror_urls=mirror_urls,
+                   repo_dir=clone_dir, **kwargs)
+
+
+def mirror_with_engine(repo: GitRepo, engine: str):
+    """Mirrors repo with the "threads" or the "asyncio" engine."""
+    if engine == "asyncio":
+        repo_queue = AsyncRepoQueue()
+        repo_queue.put(repo)
+        repo_queue.process()
+    else:
+        mirror_repo(repo)
+
+
+def read_chunked(rfile) -> bytes:
+    """Reads a body with Transfer-Encoding: chunked."""
+    body = []  # type: List[bytes]
+    while True:
+        size = int(rfile.readline().split(b";")[0].strip(), 16)
+        if size == 0:
+            rfile.readline()
+            return b"".join(body)
+        body.append(rfile.read(size))
+        rfile.readline()
+
+
+def read_body(handler: http.server.BaseHTTPRequestHandler) -> bytes:
+    if handler.headers.get("Transfer-Encoding") == "chunked":
+        return read_chunked(handler.rfile)
+    return handler.rfile.read(int(handler.headers.get("Content-Length", 0)))
+
+
+def git_http_backend(handler: http.server.BaseHTTPRequestHandler,
+                     root: Path, body: bytes):
+    """
+    Serves the request of handler for the repositories in root with git
+    http-backend, like a CGI server.
+    """
+    path, _, query = handler.path.partition("?")
+    environment = dict(
+        os.environ, GIT_PROJECT_ROOT=str(root), GIT_HTTP_EXPORT_ALL="1",
+        PATH_INFO=path, QUERY_STRING=query, REQUEST_METHOD=handler.command,
+        CONTENT_TYPE=handler.headers.get("Content-Type", ""),
+        CONTENT_LENGTH=str(len(body)),
+        HTTP_CONTENT_ENCODING=handler.headers.get("Content-Encoding", ""),
+        GIT_PROTOCOL=handler.headers.get("Git-Protocol", ""),
+        REMOTE_USER="test", REMOTE_ADDR="127.0.0.1")
+    output = subprocess.run(["git", "http-backend"], input=body,
+                            env=environment, stdout=subprocess.PIPE).stdout
+    header_block, _, content = output.partition(b"\r\n\r\n")
+    status = 200
+    headers = []
+    for line in header_block.decode("latin-1").splitlines():
+        name, _, value = line.partition(":")
+        if name.lower() == "status":
+            status = int(value.strip().split()[0])
+        elif name:
+            headers.append((name, value.strip()))
+    handler.send_response(status)
+    for name, value in headers:
+        handler.send_header(name, value)
+    handler.send_header("Content-Length", str(len(content)))
+    handler.end_headers()
+    handler.wfile.write(content)
@@ -0,0 +1,137 @@
+# Copyright (C) 2019 Leiden University Medical Center
+# This file is part of git-synchronizer
+#
+# git-synchronizer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# git-synchronizer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
+
+import tempfile
+import time
+from pathlib import Path
+
+import git
+
+from git_synchronizer.git_synchronizer import AsyncRepoQueue, GitRepo
+
+import pytest
+
+from . import (clone_this_repo, empty_repo, mirror_with_engine,
+               new_git_repo)
+
+
+def test_async_mirror():
+    git_repo = new_git_repo(mirror_urls=[str(empty_repo().working_dir),
+                                         str(empty_repo().working_dir)])
+    repo_queue = AsyncRepoQueue()
+    repo_queue.put(git_repo)
+    repo_queue.process(4)
+    assert git_repo.errors == []
+    assert git_repo.status == "synced"
+    for mirror in git_repo.mirrors:
+        mirror_repo = git.Repo(list(mirror.urls)[0])
+        assert mirror_repo.branches == git_repo.repo.branches
+        assert mirror_repo.tags == git_repo.repo.tags
+
+    git_repo = GitRepo(git_repo.main_url, repo_dir=git_repo.repo_dir,
+                       mirror_urls=git_repo.mirror_urls)
+    repo_queue = AsyncRepoQueue()
+    repo_queue.put(git_repo)
+    repo_queue.process(4)
+    assert git_repo.status == "skipped"
+
+
+@pytest.mark.parametrize("ref_diff_push", [False, True])
+def test_async_mirror_errors_same_as_threads(ref_diff_push):
+    results = []
+    for engine in ("threads", "asyncio"):
+        git_repo = new_git_repo(mirror_urls=[str(empty_repo().working_dir),
+                                             "/non/existing/mirror.git"])
+        git_repo.ref_diff_push = ref_diff_push
+        mirror_with_engine(git_repo, engine)
+        results.append((git_repo.status,
+                        [type(error) for error in git_repo.errors]))
+    assert results[0] == results[1] == ("failed", [git.GitCommandError])
+
+
+def test_async_total_excludes_waiting():
+    main_url = list(clone_this_repo().remote().urls)[0]
+    clone_dir = Path(str(tempfile.mkdtemp(prefix="clone_dir")))
+    git_repos = [GitRepo(main_url, repo_dir=clone_dir / Path(
+        "{0}.git".format(number)), mirror_urls=[empty_repo().working_dir])
+        for number in range(4)]
+    repo_queue = AsyncRepoQueue()
+    for git_repo in git_repos:
+        repo_queue.put(git_repo)
+    start = time.monotonic()
+    repo_queue.process(1)
+    run_time = time.monotonic() - start
+    assert all(git_repo.status == "synced" for git_repo in git_repos)
+    # One repo at a time, so the totals do not overlap.
+    assert sum(git_repo.durations["total"] for git_repo in git_repos) <= \
+        run_time
+    assert git_repos[-1].metrics["queue_wait_seconds"] > 0
+
+
+def test_async_opens_clones_in_turn():
+    main_url = list(clone_this_repo().remote().urls)[0]
+    clone_dir = Path(str(tempfile.mkdtemp(prefix="clone_dir")))
+    repo_dirs = [clone_dir / Path("{0}.git".format(number))
+                 for number in range(4)]
+    for repo_dir in repo_dirs:
+        git.Repo.clone_from(main_url, str(repo_dir), mirror=True)
+    git_repos = [GitRepo(main_url, repo_dir=repo_dir, use_fingerprint=False)
+                 for repo_dir in repo_dirs]
+    open_clones = []
+
+    def counting_open(git_repo):
+        original_open = git_repo.open
+
+        def open_clone():
+            original_open()
+            open_clones.append(sum(1 for other in git_repos
+                                   if other._repo is not None))
+        return open_clone
+
+    repo_queue = AsyncRepoQueue()
+    for git_repo in git_repos:
+        git_repo.open = counting_open(git_repo)
+        repo_queue.put(git_repo)
+    repo_queue.process(1)
+    assert all(git_repo.status == "synced" for git_repo in git_repos)
+    assert open_clones == [1, 1, 1, 1]
+
+
+def test_async_unexpected_error():
+    main_url = clone_this_repo().working_dir
+    clone_dir = Path(str(tempfile.mkdtemp(prefix="clone_dir")))
+    repos = [GitRepo(main_url, repo_dir=clone_dir / Path(
+        "{0}.git".format(number)), mirror_urls=[empty_repo().working_dir])
+        for number in range(3)]
+
+    def maintain():
+        raise OSError("disk full")
+    for repo in repos:
+        repo.maintain = maintain
+    done = []
+    repo_queue = AsyncRepoQueue(callback=done.append)
+    for repo in repos:
+        repo_queue.put(repo)
+    repo_queue.process(1)
+    assert done == repos
+    assert all(repo.status == "failed" for repo in repos)
+    assert all(isinstance(repo.errors[0], OSError) for repo in repos)
+    assert all(repo._repo is None for repo in repos)
+
+
+def test_async_queue_only_git_repos():
+    with pytest.raises(ValueError):
+        AsyncRepoQueue().put("not a repo")
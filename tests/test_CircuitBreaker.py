@@ -0,0 +1,108 @@
+# Copyright (C) 2019 Leiden University Medical Center
+# This file is part of git-synchronizer
+#
+# git-synchronizer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# git-synchronizer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
+
+import tempfile
+import time
+from pathlib import Path
+
+from git_synchronizer.git_synchronizer import (AsyncRepoQueue,
+                                               CircuitBreaker,
+                                               CircuitOpenError, GitRepo,
+                                               mirror_repo)
+
+import pytest
+
+from . import clone_this_repo, empty_repo
+
+# Nothing listens on port 1, so connecting fails right away.
+DOWN_URL = "http://127.0.0.1:1/mirror.git"
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+    breaker.record_failure("https://example.com/one.git")
+    breaker.check("https://example.com/two.git")
+    breaker.record_failure("https://example.com/two.git")
+    with pytest.raises(CircuitOpenError):
+        breaker.check("https://example.com/three.git")
+    breaker.check("https://other.example.com/one.git")
+
+
+def test_circuit_breaker_success_resets():
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure("https://example.com/one.git")
+    breaker.record_success("https://example.com/two.git")
+    breaker.record_failure("https://example.com/one.git")
+    breaker.check("https://example.com/one.git")
+
+
+def test_circuit_breaker_half_open():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure("https://example.com/one.git")
+    time.sleep(0.1)
+    # One operation may test the host, the others still fail fast.
+    breaker.check("https://example.com/one.git")
+    with pytest.raises(CircuitOpenError):
+        breaker.check("https://example.com/one.git")
+    breaker.record_success("https://example.com/one.git")
+    breaker.check("https://example.com/one.git")
+
+
+def test_backoff_delay():
+    breaker = CircuitBreaker(backoff=1.0)
+    for attempt in range(4):
+        assert 0 <= breaker.backoff_delay(attempt) <= 2 ** attempt
+
+
+def new_repos(circuit_breaker):
+    main_url = list(clone_this_repo().remote().urls)[0]
+    clone_dir = Path(tempfile.mkdtemp(prefix="clone_dir"))
+    return [GitRepo(main_url, clone_dir / Path("{0}.git".format(number)),
+                    mirror_urls=[empty_repo().working_dir, DOWN_URL],
+                    circuit_breaker=circuit_breaker)
+            for number in range(3)]
+
+
+def test_mirror_host_down():
+    breaker = CircuitBreaker(failure_threshold=2, retries=1, backoff=0.01)
+    repos = new_repos(breaker)
+    for repo in repos:
+        mirror_repo(repo)
+    # The first repo tried twice and opened the circuit.
+    assert repos[0].status == "failed"
+    assert len(repos[0].errors) == 1
+    for repo in repos[1:]:
+        assert repo.status == "skipped"
+        assert repo.errors == []
+        assert repo.unavailable_mirrors == [DOWN_URL]
+        assert not repo.fingerprint_file.exists()
+        # The healthy mirror was still updated.
+        assert repo.mirror_metrics[repo.mirror_urls[0]]["pushed_refs"] > 0
+
+
+def test_async_mirror_host_down():
+    breaker = CircuitBreaker(failure_threshold=2, retries=1, backoff=0.01)
+    repos = new_repos(breaker)
+    for start, end in ((0, 1), (1, 3)):
+        repo_queue = AsyncRepoQueue(circuit_breaker=breaker)
+        for repo in repos[start:end]:
+            repo_queue.put(repo)
+        repo_queue.process(2)
+    assert repos[0].status == "failed"
+    for repo in repos[1:]:
+        assert repo.status == "skipped"
+        assert repo.errors == []
+        assert repo.unavailable_mirrors == [DOWN_URL]
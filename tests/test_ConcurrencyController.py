@@ -0,0 +1,119 @@
+# Copyright (C) 2019 Leiden University Medical Center
+# This file is part of git-synchronizer
+#
+# git-synchronizer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# git-synchronizer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
+
+import io
+import tempfile
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+import git
+
+from git_synchronizer.git_synchronizer import (ConcurrencyController,
+                                               GitRepo, OperationTimeout,
+                                               RepoQueue)
+
+from . import clone_this_repo, empty_repo
+
+
+def completed_repo(total: float,
+                   errors: Optional[List[Exception]] = None) -> GitRepo:
+    repo = GitRepo("https://example.com/repo.git",
+                   repo_dir=Path("repo.git"))
+    repo.durations = {"total": total}
+    repo.errors = errors or []
+    return repo
+
+
+def test_additive_increase():
+    output = io.StringIO()
+    controller = ConcurrencyController(1, 3, output=output)
+    for _ in range(10):
+        controller.record(completed_repo(1.0))
+    assert controller.limit == 3
+    assert controller.levels == [1, 2, 3]
+    assert output.getvalue().startswith("threads: 1 -> 2 (")
+
+
+def test_decrease_on_congestion():
+    controller = ConcurrencyController(1, 8)
+    for _ in range(1 + 2 + 3):
+        controller.record(completed_repo(1.0))
+    assert controller.limit == 4
+    throttled = git.GitCommandError(
+        ["git", "fetch"], 128,
+        "fatal: The requested URL returned error: 429")
+    controller.record(completed_repo(1.0, [OperationTimeout("timed out")]))
+    for _ in range(3):
+        controller.record(completed_repo(1.0))
+    assert controller.limit == 2
+    controller.record(completed_repo(1.0, [throttled]))
+    controller.record(completed_repo(1.0))
+    assert controller.limit == 1
+    assert controller.levels == [1, 2, 3, 4, 2, 1]
+    # Other errors are not a sign of congestion.
+    controller.record(completed_repo(1.0, [ValueError("not cloned")]))
+    assert controller.limit == 2
+
+
+def test_decrease_on_latency():
+    controller = ConcurrencyController(1, 8)
+    controller.record(completed_repo(1.0))
+    assert controller.limit == 2
+    # The previous window had a throughput that was not exceeded.
+    controller._throughput = float("inf")
+    controller.record(completed_repo(3.0))
+    controller.record(completed_repo(3.0))
+    assert controller.limit == 1
+
+
+def test_slot():
+    controller = ConcurrencyController(2, 2)
+    active = []
+    maximum = [0]
+    lock = threading.Lock()
+    barrier = threading.Barrier(2)
+
+    def work():
+        with controller.slot():
+            with lock:
+                active.append(1)
+                maximum[0] = max(maximum[0], len(active))
+            barrier.wait(timeout=1)
+            with lock:
+                active.pop()
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert maximum[0] == 2
+
+
+def test_repo_queue_with_controller():
+    main_url = clone_this_repo().working_dir
+    clone_dir = Path(str(tempfile.mkdtemp(prefix="clone_dir")))
+    repos = [GitRepo(main_url, repo_dir=clone_dir / Path(
+        "{0}.git".format(number)), mirror_urls=[empty_repo().working_dir])
+        for number in range(4)]
+    controller = ConcurrencyController(1, 2)
+    repo_queue = RepoQueue()
+    for repo in repos:
+        repo_queue.put(repo)
+    repo_queue.process(controller=controller)
+    assert [repo.status for repo in repos] == ["synced"] * 4
+    assert controller.levels[:2] == [1, 2]
@@ -0,0 +1,155 @@
+# Copyright (C) 2019 Leiden University Medical Center
+# This file is part of git-synchronizer
+#
+# git-synchronizer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# git-synchronizer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
+
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import git
+
+from git_synchronizer.git_synchronizer import Daemon, GitRepo
+
+from . import clone_this_repo, empty_repo
+
+
+def wait_until(condition, timeout=10.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "Timed out"
+        time.sleep(0.05)
+
+
+def test_daemon():
+    clone_dir = Path(str(tempfile.mkdtemp(prefix="clone_dir")))
+    _, config_file = tempfile.mkstemp(prefix="config", suffix=".tsv")
+    config = Path(config_file)
+    main_url = clone_this_repo().working_dir
+    mirror_one = empty_repo().working_dir
+    config.write_text(
+        "{0}\t{1}\tinterval=0.2\n".format(main_url, mirror_one))
+    runs = []
+
+    def new_repo(source_url, mirror_urls, options):
+        repo = GitRepo(source_url, repo_dir=clone_dir / Path("repo.git"),
+                       mirror_urls=mirror_urls)
+        original_mirror = repo.mirror
+
+        def mirror():
+            original_mirror()
+            runs.append((repo, repo.status))
+        repo.mirror = mirror
+        return repo
+
+    daemon = Daemon(config, new_repo, number_of_threads=2,
+                    reload_interval=0.1)
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    try:
+        wait_until(lambda: len(runs) >= 2)
+        first_repo = daemon.repos[main_url][0]
+        assert [status for _, status in runs[:2]] == ["synced", "skipped"]
+        # The clone stays open between runs.
+        assert first_repo._repo is not None
+
+        # Unchanged lines keep their repo, changed lines get a new one.
+        mirror_two = empty_repo().working_dir
+        config.write_text("{0}\t{1}\t{2}\tinterval=0.2\n".format(
+            main_url, mirror_one, mirror_two))
+        os.utime(str(config), (time.time() + 10, time.time() + 10))
+        wait_until(lambda: daemon.repos[main_url][0] is not first_repo)
+        wait_until(lambda: runs[-1][0] is daemon.repos[main_url][0])
+        assert runs[-1][0].mirror_urls == [mirror_one, mirror_two]
+        assert runs[-1][1] == "synced"
+        assert len(git.Repo(mirror_two).branches) > 0
+        assert first_repo._repo is None
+        second_repo = runs[-1][0]
+
+        config.write_text("")
+        os.utime(str(config), (time.time() + 20, time.time() + 20))
+        wait_until(lambda: daemon.repos == {})
+        wait_until(lambda: second_repo._repo is None)
+    finally:
+        daemon.stop()
+        thread.join()
+
+
+def test_daemon_invalid_config(capsys):
+    _, config_file = tempfile.mkstemp(prefix="config", suffix=".tsv")
+    config = Path(config_file)
+    config.write_text("https://example.com/one.git\tmirror\n")
+    created = []
+
+    def new_repo(source_url, mirror_urls, options):
+        created.append(source_url)
+        return GitRepo(source_url, mirror_urls=mirror_urls,
+                       repo_dir=Path(tempfile.mkdtemp()) / Path("repo.git"))
+
+    daemon = Daemon(config, new_repo)
+    daemon.reload_config()
+    repo = daemon.repos["https://example.com/one.git"][0]
+
+    config.write_text("https://example.com/one.git\tmirror\n"
+                      "https://example.com/two.git\tmirror\tintervall=5\n")
+    os.utime(str(config), (time.time() + 10, time.time() + 10))
+    daemon.reload_config()
+    assert "Unknown option 'intervall'" in capsys.readouterr().err
+    assert list(daemon.repos) == ["https://example.com/one.git"]
+    assert daemon.repos["https://example.com/one.git"][0] is repo
+
+    config.unlink()
+    daemon.reload_config()
+    assert "Could not reload" in capsys.readouterr().err
+    assert list(daemon.repos) == ["https://example.com/one.git"]
+
+    config.write_text("https://example.com/one.git\tmirror\n"
+                      "https://example.com/two.git\tmirror\tinterval=5\n")
+    daemon.reload_config()
+    assert sorted(daemon.repos) == ["https://example.com/one.git",
+                                    "https://example.com/two.git"]
+    assert daemon.repos["https://example.com/one.git"][0] is repo
+    assert created == ["https://example.com/one.git",
+                       "https://example.com/two.git"]
+
+
+def test_daemon_worker_unexpected_error():
+    _, config_file = tempfile.mkstemp(prefix="config", suffix=".tsv")
+    config = Path(config_file)
+    config.write_text("https://example.com/one.git\tmirror\tinterval=0.1\n")
+    runs = []
+
+    def new_repo(source_url, mirror_urls, options):
+        repo = GitRepo(source_url, mirror_urls=mirror_urls,
+                       repo_dir=Path(tempfile.mkdtemp()) / Path("repo.git"))
+
+        def mirror():
+            runs.append(repo)
+            raise OSError("disk full")
+        repo.mirror = mirror
+        return repo
+
+    daemon = Daemon(config, new_repo, reload_interval=0.1)
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    try:
+        # The worker survives the error and mirrors the repo again.
+        wait_until(lambda: len(runs) >= 2)
+        assert runs[0].status == "failed"
+        assert isinstance(runs[0].errors[0], OSError)
+    finally:
+        daemon.stop()
+        thread.join()
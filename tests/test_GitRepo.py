@@ -19,11 +19,14 @@ from pathlib import Path
 
 import git
 
-from git_synchronizer.git_synchronizer import GitRepo
+from git_synchronizer.git_synchronizer import (GitRepo, ObjectPools,
+                                               RefFilter, RepoMaintenance,
+                                               mirror_repo)
 
 import pytest
 
-from . import clone_this_repo, empty_repo
+from . import (clone_this_repo, empty_repo, mirror_with_engine,
+               new_git_repo)
 
 
 @pytest.fixture()
@@ -63,7 +66,20 @@ def test_remotes():
 def test_remotes_existing(git_repository):
     git_repository.clone()
     git_repo = GitRepo(list(git_repository.repo.remote().urls)[0],
-                       repo_dir=Path(git_repository.repo.working_dir))
+                       repo_dir=Path(git_repository.repo.working_dir),
+                       mirror_urls=git_repository.mirror_urls)
+    assert len(git_repo.mirrors) == 2
+
+
+def test_open_lazily(git_repository):
+    git_repository.clone()
+    git_repo = GitRepo(git_repository.main_url,
+                       repo_dir=git_repository.repo_dir,
+                       mirror_urls=git_repository.mirror_urls)
+    assert git_repo._repo is None
+    assert git_repo.repo is not None
+    git_repo.close()
+    assert git_repo._repo is None
     assert len(git_repo.mirrors) == 2
 
 # Will fail on travis due to git push failing.
@@ -77,3 +93,190 @@ def test_mirror(git_repository):
         print(mirror_repo.working_dir)
         assert mirror_repo.branches == git_repo.repo.branches
         assert mirror_repo.tags == git_repo.repo.tags
+
+
+def test_mirror_skips_unchanged(git_repository):
+    git_repository.mirror()
+    assert git_repository.status == "synced"
+    assert git_repository.fingerprint_file.exists()
+    git_repo = GitRepo(git_repository.main_url,
+                       repo_dir=git_repository.repo_dir,
+                       mirror_urls=git_repository.mirror_urls)
+    git_repo.mirror()
+    assert git_repo.status == "skipped"
+
+
+def test_mirror_new_mirror_not_skipped(git_repository):
+    git_repository.mirror()
+    git_repo = GitRepo(git_repository.main_url,
+                       repo_dir=git_repository.repo_dir,
+                       mirror_urls=git_repository.mirror_urls + [
+                           empty_repo().working_dir])
+    assert git_repo.fingerprint() != git_repository.stored_fingerprint()
+
+
+def test_mirror_changed_mirrors(git_repository):
+    git_repository.mirror()
+    new_mirror = empty_repo().working_dir
+    mirror_urls = git_repository.mirror_urls[1:] + [new_mirror]
+    git_repo = GitRepo(git_repository.main_url,
+                       repo_dir=git_repository.repo_dir,
+                       mirror_urls=mirror_urls)
+    git_repo.mirror()
+    assert git_repo.status == "synced"
+    assert len(git.Repo(new_mirror).branches) > 0
+    # The remote of the removed mirror is gone.
+    assert [list(remote.urls)[0] for remote in git_repo.mirrors] == \
+        mirror_urls
+    assert sorted(remote.name for remote in git_repo.repo.remotes) == \
+        sorted(["origin"] + [remote.name for remote in git_repo.mirrors])
+
+
+def test_mirror_force(git_repository):
+    git_repository.mirror()
+    git_repo = GitRepo(git_repository.main_url,
+                       repo_dir=git_repository.repo_dir,
+                       mirror_urls=git_repository.mirror_urls,
+                       use_fingerprint=False)
+    git_repo.mirror()
+    assert git_repo.status == "synced"
+
+
+def test_ref_diff_push_args(git_repository):
+    assert git_repository.ref_diff_push_args() == [
+        "--force", "--prune", "refs/heads/*:refs/heads/*",
+        "refs/tags/*:refs/tags/*"]
+    git_repository.ref_filter = RefFilter(exclude=["refs/heads/wip/*"])
+    assert git_repository.ref_diff_push_args()[-1] == "^refs/heads/wip/*"
+
+
+def test_mirror_ref_diff_push(git_repository):
+    git_repository.ref_diff_push = True
+    git_repository.mirror()
+    for mirror in git_repository.mirrors:
+        mirror_repo = git.Repo(list(mirror.urls)[0])
+        mirror_repo.create_head("stale")
+    # The main repository did not change, so only the push can remove the
+    # stale branch.
+    git_repository.use_fingerprint = False
+    git_repository.mirror()
+    assert git_repository.status == "synced"
+    for mirror in git_repository.mirrors:
+        mirror_repo = git.Repo(list(mirror.urls)[0])
+        assert [head.name for head in mirror_repo.branches] == \
+            git_repository.branches
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_mirror_ref_diff_push_deletes_refs(engine):
+    source = clone_this_repo()
+    source.create_head("feature")
+    source.create_tag("v1")
+    git_repo = new_git_repo(main_url=str(source.working_dir),
+                            ref_diff_push=True)
+    mirror_with_engine(git_repo, engine)
+    mirror = git.Repo(git_repo.mirror_urls[0])
+    assert "feature" in [head.name for head in mirror.branches]
+    assert "v1" in [tag.name for tag in mirror.tags]
+    source.delete_head("feature", force=True)
+    source.delete_tag(source.tags["v1"])
+    git_repo = GitRepo(git_repo.main_url, mirror_urls=git_repo.mirror_urls,
+                       repo_dir=git_repo.repo_dir, ref_diff_push=True)
+    mirror_with_engine(git_repo, engine)
+    assert git_repo.status == "synced"
+    for repo in (mirror, git_repo.repo):
+        assert "feature" not in [head.name for head in repo.branches]
+        assert "v1" not in [tag.name for tag in repo.tags]
+
+
+def test_mirror_resets_previous_run(git_repository):
+    # The results of an earlier run in which a mirror host was down.
+    git_repository.unavailable_mirrors = [git_repository.mirror_urls[0]]
+    git_repository.errors = [ValueError("earlier error")]
+    git_repository.durations = {"push": 100.0}
+    git_repository.mirror_metrics = {"old mirror": {"pushed_refs": 1}}
+    git_repository.mirror()
+    assert git_repository.status == "synced"
+    assert git_repository.errors == []
+    assert git_repository.fingerprint_file.exists()
+    assert git_repository.durations["push"] < 100.0
+    assert "old mirror" not in git_repository.mirror_metrics
+
+
+def test_push_mirrors_errors_per_mirror(git_repository):
+    git_repository.mirror_urls.append("/non/existing/mirror.git")
+    git_repository.mirror_threads = 3
+    git_repository.mirror()
+    assert git_repository.status == "failed"
+    assert len(git_repository.errors) == 1
+    assert not git_repository.fingerprint_file.exists()
+    for mirror in git_repository.mirrors[:2]:
+        mirror_repo = git.Repo(list(mirror.urls)[0])
+        assert len(mirror_repo.branches) > 0
+
+
+def test_shared_objects(monkeypatch):
+    main_url = list(clone_this_repo().remote().urls)[0]
+    clone_dir = Path(str(tempfile.mkdtemp(prefix="clone_dir")))
+    object_pools = ObjectPools(clone_dir / Path(".object-pools"))
+    repos = []
+    for name in ("one.git", "two.git"):
+        git_repo = GitRepo(main_url=main_url,
+                           mirror_urls=[empty_repo().working_dir],
+                           repo_dir=clone_dir / Path(name),
+                           object_pools=object_pools)
+        git_repo.mirror()
+        assert git_repo.status == "synced"
+        repos.append(git_repo)
+    pools = list(object_pools.pools_dir.iterdir())
+    assert [pool.name for pool in pools] == [repos[0].root_commit + ".git"]
+    pool_refs = git.Repo(str(pools[0])).git.for_each_ref("refs/members")
+    for git_repo in repos:
+        alternates = git_repo.repo_dir / Path("objects", "info",
+                                              "alternates")
+        assert alternates.read_text().strip() == str(
+            (pools[0] / Path("objects")).absolute())
+        assert git_repo.repo.git.fsck() == ""
+        assert git_repo.branches[0] in pool_refs
+    # The second repo was cloned with the pool as reference.
+    assert repos[1].find_object_pool() == pools[0]
+
+    # The clone is not repacked when the pool fetch added no objects.
+    commands = []
+    call_process = git.cmd.Git._call_process
+
+    def record_call(self, method, *args, **kwargs):
+        commands.append(method)
+        return call_process(self, method, *args, **kwargs)
+    monkeypatch.setattr(git.cmd.Git, "_call_process", record_call)
+    object_pools.add(pools[0].name[:-len(".git")], repos[0].repo_dir)
+    assert "fetch" in commands
+    assert "repack" not in commands
+
+
+def test_maintenance(git_repository):
+    git_repository.maintenance = RepoMaintenance(interval=3600)
+    mirror_repo(git_repository)
+    assert git_repository.status == "synced"
+    assert "maintenance" in git_repository.durations
+    objects = git_repository.repo_dir / Path("objects")
+    assert (objects / Path("info", "commit-graphs",
+                           "commit-graph-chain")).exists()
+    assert (objects / Path("pack", "multi-pack-index")).exists()
+    assert list((objects / Path("pack")).glob("multi-pack-index-*.bitmap"))
+    assert RepoMaintenance.stamp_file(git_repository.repo_dir).exists()
+    assert not git_repository.maintenance.needed(git_repository.repo_dir)
+    assert git_repository.repo.git.fsck() == ""
+
+
+def test_maintenance_thresholds(git_repository):
+    git_repository.mirror()
+    counts = RepoMaintenance.count_objects(git_repository.repo_dir)
+    maintenance = RepoMaintenance(loose_objects=counts["count"] + 1,
+                                  packs=counts["packs"] + 1, interval=3600)
+    RepoMaintenance.stamp_file(git_repository.repo_dir).touch()
+    assert not maintenance.needed(git_repository.repo_dir)
+    loose_object = git_repository.repo_dir / Path("loose_object")
+    loose_object.write_text("loose object")
+    git_repository.repo.git.hash_object("-w", str(loose_object))
+    assert maintenance.needed(git_repository.repo_dir)
@@ -0,0 +1,80 @@
+# Copyright (C) 2019 Leiden University Medical Center
+# This file is part of git-synchronizer
+#
+# git-synchronizer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# git-synchronizer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
+
+import os
+import threading
+import time
+from pathlib import Path
+
+from git_synchronizer.git_synchronizer import (HostLimiter, SSHMultiplexer,
+                                               ssh_destination, url_host)
+
+import pytest
+
+URLS = [
+    ("https://example.com/examples/example.git", "example.com",
+     None),
+    ("git@mygit.com:/examples/example.git", "mygit.com",
+     ("git@mygit.com", None)),
+    ("ssh://git@myothergit.com:2222/example/example2.git", "myothergit.com",
+     ("git@myothergit.com", 2222)),
+    ("file:///tmp/example.git", None, None),
+    ("/tmp/example.git", None, None),
+]
+
+
+@pytest.mark.parametrize(["url", "host", "destination"], URLS)
+def test_url_host(url, host, destination):
+    assert url_host(url) == host
+    assert ssh_destination(url) == destination
+
+
+def test_host_limiter():
+    limiter = HostLimiter(2)
+    running = {"example.com": 0, "mygit.com": 0}
+    maximum = {"example.com": 0, "mygit.com": 0}
+    lock = threading.Lock()
+
+    def operation(url, host):
+        with limiter.limit(url):
+            with lock:
+                running[host] += 1
+                maximum[host] = max(maximum[host], running[host])
+            time.sleep(0.05)
+            with lock:
+                running[host] -= 1
+
+    threads = [threading.Thread(target=operation, args=url[:2])
+               for url in URLS[:2] * 4]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert maximum == {"example.com": 2, "mygit.com": 2}
+
+
+def test_ssh_multiplexer_environment():
+    old_ssh_command = os.environ.pop("GIT_SSH_COMMAND", None)
+    try:
+        with SSHMultiplexer([url for url, _, _ in URLS]) as multiplexer:
+            assert len(multiplexer.destinations) == 2
+            assert "ControlMaster=auto" in os.environ["GIT_SSH_COMMAND"]
+            assert Path(str(multiplexer.control_dir)).exists()
+        assert "GIT_SSH_COMMAND" not in os.environ
+        assert not Path(str(multiplexer.control_dir)).exists()
+    finally:
+        if old_ssh_command is not None:
+            os.environ["GIT_SSH_COMMAND"] = old_ssh_command
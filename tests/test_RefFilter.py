@@ -0,0 +1,131 @@
+# Copyright (C) 2019 Leiden University Medical Center
+# This file is part of git-synchronizer
+#
+# git-synchronizer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# git-synchronizer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
+
+import tempfile
+from pathlib import Path
+
+import git
+
+from git_synchronizer import git_synchronizer
+from git_synchronizer.git_synchronizer import (GitRepo, RefFilter,
+                                               mirror_repo)
+
+import pytest
+
+from . import clone_this_repo, empty_repo, mirror_with_engine
+
+
+def test_ref_filter():
+    ref_filter = RefFilter(include=["refs/heads/*", "refs/tags/*"],
+                           exclude=["refs/heads/wip/*"])
+    assert ref_filter.matches("refs/heads/main")
+    assert ref_filter.matches("refs/heads/feature/one")
+    assert not ref_filter.matches("refs/heads/wip/one")
+    assert not ref_filter.matches("refs/pull/1/head")
+    assert ref_filter.filter({"refs/tags/v1": "a", "refs/tags/v1^{}": "b",
+                              "refs/pull/1/head": "c"}) == {
+        "refs/tags/v1": "a", "refs/tags/v1^{}": "b"}
+    assert ref_filter.fetch_refspecs() == [
+        "+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*",
+        "^refs/heads/wip/*"]
+    assert not RefFilter()
+    assert RefFilter().fetch_refspecs() == ["+refs/*:refs/*"]
+
+
+@pytest.mark.parametrize(["include", "refspecs"], [
+    ([], ["refs/heads/*:refs/heads/*", "refs/tags/*:refs/tags/*"]),
+    (["refs/*"], ["refs/heads/*:refs/heads/*", "refs/tags/*:refs/tags/*"]),
+    (["refs/heads/release-*", "refs/pull/*"],
+     ["refs/heads/release-*:refs/heads/release-*"]),
+])
+def test_ref_filter_push_refspecs(include, refspecs):
+    ref_filter = RefFilter(include=include, exclude=["refs/tags/rc-*"])
+    assert ref_filter.push_refspecs() == refspecs + ["^refs/tags/rc-*"]
+
+
+@pytest.mark.parametrize("pattern", [
+    "refs/heads/release-?", "refs/heads/[ab]*", "refs/*/*", "heads/*",
+    "refs/heads/a..b", "refs/heads/a b"])
+def test_ref_filter_invalid_pattern(pattern):
+    with pytest.raises(ValueError) as error:
+        RefFilter(include=[pattern])
+    error.match("Invalid ref pattern")
+    with pytest.raises(ValueError):
+        RefFilter(exclude=[pattern])
+
+
+def test_ref_filter_exclude_old_git(monkeypatch):
+    monkeypatch.setattr(git_synchronizer, "git_version", lambda: (2, 28, 0))
+    assert RefFilter(include=["refs/heads/*"]).include == ["refs/heads/*"]
+    with pytest.raises(ValueError) as error:
+        RefFilter(exclude=["refs/pull/*"])
+    error.match("needs git 2.29 or later, found git 2.28.0")
+
+
+def source_repo() -> git.Repo:
+    repo = clone_this_repo()
+    head = repo.head.commit.hexsha
+    repo.git.update_ref("refs/pull/1/head", head)
+    repo.git.update_ref("refs/heads/wip/one", head)
+    repo.git.update_ref("refs/heads/keep", head)
+    return repo
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+@pytest.mark.parametrize("ref_diff_push", [False, True])
+def test_mirror_ref_filter(engine, ref_diff_push):
+    source = source_repo()
+    mirror = empty_repo()
+    repo_dir = Path(tempfile.mkdtemp(prefix="clone_dir")) / Path("repo.git")
+    repo = GitRepo(source.working_dir, repo_dir,
+                   mirror_urls=[mirror.working_dir],
+                   ref_diff_push=ref_diff_push,
+                   ref_filter=RefFilter(exclude=["refs/pull/*",
+                                                 "refs/heads/wip/*"]))
+    mirror_with_engine(repo, engine)
+    assert repo.status == "synced", repo.errors
+    clone_refs = str(git.Repo(str(repo_dir)).git.for_each_ref())
+    assert "refs/heads/keep" in clone_refs
+    assert "refs/pull/" not in clone_refs
+    assert "refs/heads/wip/" not in clone_refs
+    mirror_refs = str(mirror.git.for_each_ref())
+    assert "refs/heads/keep" in mirror_refs
+    assert "refs/heads/wip/" not in mirror_refs
+
+    # Changes to refs that are not mirrored do not trigger a sync.
+    source.git.update_ref("refs/pull/2/head", source.head.commit.hexsha)
+    repo = GitRepo(source.working_dir, repo_dir,
+                   mirror_urls=[mirror.working_dir],
+                   ref_filter=RefFilter(exclude=["refs/pull/*",
+                                                 "refs/heads/wip/*"]))
+    mirror_repo(repo)
+    assert repo.status == "skipped"
+
+
+def test_ref_diff_push_keeps_excluded_refs():
+    source = source_repo()
+    mirror = empty_repo()
+    repo_dir = Path(tempfile.mkdtemp(prefix="clone_dir")) / Path("repo.git")
+    for _ in range(2):
+        repo = GitRepo(source.working_dir, repo_dir,
+                       mirror_urls=[mirror.working_dir],
+                       use_fingerprint=False, ref_diff_push=True,
+                       ref_filter=RefFilter(exclude=["refs/heads/wip/*"]))
+        mirror_repo(repo)
+        assert repo.status == "synced", repo.errors
+        mirror.git.update_ref("refs/heads/wip/mirror-only",
+                              source.head.commit.hexsha)
+    assert "refs/heads/wip/mirror-only" in str(mirror.git.for_each_ref())
@@ -0,0 +1,84 @@
+# Copyright (C) 2019 Leiden University Medical Center
+# This file is part of git-synchronizer
+#
+# git-synchronizer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# git-synchronizer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
+
+from pathlib import Path
+
+import git
+
+from git_synchronizer.git_synchronizer import ReferenceCache, mirror_repo
+
+import pytest
+
+from . import (clone_this_repo, file_url, mirror_with_engine,
+               new_git_repo)
+
+
+def test_find(tmpdir):
+    cache = ReferenceCache(Path(str(tmpdir)))
+    repo_dir = Path("clones", "repo.git")
+    assert cache.find(repo_dir) is None
+    cache.bundle_path(repo_dir).write_text("")
+    assert cache.find(repo_dir) == Path(str(tmpdir), "repo.bundle")
+    git.Repo.init(str(Path(str(tmpdir), "repo.git")), bare=True)
+    assert cache.find(repo_dir) == Path(str(tmpdir), "repo.git")
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+@pytest.mark.parametrize("seed", ["bundle", "repository"])
+def test_seeded_clone(tmpdir, engine, seed):
+    origin = clone_this_repo()
+    origin.create_head("deleted")
+    cache_dir = Path(str(tmpdir))
+    first = new_git_repo(file_url(origin),
+                         reference_cache=ReferenceCache(
+                             cache_dir, write_bundles=True))
+    mirror_with_engine(first, engine)
+    assert first.status == "synced"
+    assert first.metrics["received_objects"] > 0
+    assert "bundle" in first.durations
+    bundle = cache_dir / Path("git-synchronizer.bundle")
+    assert bundle.exists()
+    if seed == "repository":
+        bundle.unlink()
+        cache_dir = first.repo_dir.parent
+    origin.delete_head("deleted")
+
+    second = new_git_repo(file_url(origin),
+                          reference_cache=ReferenceCache(cache_dir))
+    mirror_with_engine(second, engine)
+    assert second.status == "synced"
+    # All objects came from the seed.
+    assert second.metrics.get("received_objects", 0) == 0
+    # The branch that was deleted after the seed was made is not mirrored.
+    assert "deleted" not in second.branches
+    assert second.branches == [head.name for head in origin.branches]
+    assert not (second.repo_dir / Path("objects", "info",
+                                       "alternates")).exists()
+    assert second.repo.git.fsck() == ""
+    mirror = git.Repo(second.mirror_urls[0])
+    assert [head.name for head in mirror.branches] == second.branches
+
+
+def test_unusable_seed(tmpdir):
+    cache = ReferenceCache(Path(str(tmpdir)))
+    git_repo = new_git_repo(file_url(clone_this_repo()),
+                            reference_cache=cache)
+    cache.bundle_path(git_repo.repo_dir).write_text("not a bundle\n")
+    mirror_repo(git_repo)
+    assert git_repo.status == "synced"
+    assert git_repo.metrics["received_objects"] > 0
+    # Bundles are only written with write_bundles.
+    assert "bundle" not in git_repo.durations
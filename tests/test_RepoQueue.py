@@ -0,0 +1,150 @@
+# Copyright (C) 2019 Leiden University Medical Center
+# This file is part of git-synchronizer
+#
+# git-synchronizer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# git-synchronizer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
+
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from git_synchronizer.git_synchronizer import (DurationStore, GitRepo,
+                                               RepoQueue, predicted_run_time)
+
+from . import clone_this_repo, empty_repo
+
+
+def repos_and_durations(tmpdir):
+    durations = DurationStore(Path(str(tmpdir)) / Path("durations.json"))
+    repos = [GitRepo("https://example.com/{0}.git".format(name),
+                     repo_dir=Path(str(tmpdir)) / Path(name + ".git"))
+             for name in ("small", "unknown", "huge")]
+    # None of the repos are cloned, so the clone and push times are used.
+    durations.durations = {"small.git": {"clone": 1.0, "push": 1.0},
+                           "medium.git": {"clone": 4.0, "push": 1.0},
+                           "huge.git": {"clone": 90.0, "push": 10.0}}
+    return repos, durations
+
+
+def test_repo_queue_longest_first(tmpdir):
+    repos, durations = repos_and_durations(tmpdir)
+    repo_queue = RepoQueue(durations)
+    for repo in repos:
+        repo_queue.put(repo)
+    # Unknown repos get the median estimate.
+    assert durations.estimate(repos[1]) == 5.0
+    assert [repo_queue.get_nowait().repo_dir.name for _ in repos] == [
+        "huge.git", "unknown.git", "small.git"]
+
+
+def test_repo_queue_in_order_without_durations(tmpdir):
+    repos, _ = repos_and_durations(tmpdir)
+    repo_queue = RepoQueue()
+    for repo in repos:
+        repo_queue.put(repo)
+    assert [repo_queue.get_nowait() for _ in repos] == repos
+
+
+def test_duration_store_record_and_save(tmpdir):
+    repos, durations = repos_and_durations(tmpdir)
+    repos[0].durations = {"clone": 3.0, "total": 5.0}
+    durations.record(repos[0])
+    assert durations.durations["small.git"] == {"clone": 2.0, "push": 1.0,
+                                                "total": 5.0}
+    durations.save()
+    assert DurationStore(durations.path).durations == durations.durations
+
+
+def test_predicted_run_time():
+    assert predicted_run_time([], 2) == 0.0
+    assert predicted_run_time([1.0, 2.0, 3.0], 1) == 6.0
+    assert predicted_run_time([5.0, 4.0, 3.0, 3.0, 3.0], 2) == 10.0
+
+
+def test_repo_queue_pipeline():
+    main_url = clone_this_repo().working_dir
+    clone_dir = Path(str(tempfile.mkdtemp(prefix="clone_dir")))
+    repos = [GitRepo(main_url, repo_dir=clone_dir / Path(
+        "{0}.git".format(number)), mirror_urls=[empty_repo().working_dir])
+        for number in range(8)]
+    repos[1].mirror_urls.append("/non/existing/mirror.git")
+    lock = threading.Lock()
+    waiting = []  # type: list
+    max_waiting = [0]
+    threads = {"fetch": set(), "push": set()}  # type: dict
+
+    def instrument(repo):
+        original_fetch, original_push = repo.mirror_fetch, repo.mirror_push
+
+        def mirror_fetch():
+            threads["fetch"].add(threading.current_thread())
+            result = original_fetch()
+            with lock:
+                waiting.append(repo)
+                max_waiting[0] = max(max_waiting[0], len(waiting))
+            return result
+
+        def mirror_push():
+            threads["push"].add(threading.current_thread())
+            with lock:
+                waiting.remove(repo)
+            # Pushing is slower than fetching.
+            time.sleep(0.2)
+            original_push()
+        repo.mirror_fetch = mirror_fetch
+        repo.mirror_push = mirror_push
+
+    for repo in repos:
+        instrument(repo)
+    done = []
+    repo_queue = RepoQueue(callback=done.append)
+    for repo in repos:
+        repo_queue.put(repo)
+    repo_queue.process(2, push_threads=1, handoff_size=1)
+    assert sorted(done, key=repos.index) == repos
+    assert [repo.status for repo in repos] == ["synced", "failed"] + [
+        "synced"] * 6
+    assert not threads["fetch"] & threads["push"]
+    assert len(threads["push"]) == 1
+    # One repo in the handoff queue, one waiting to be put in it per fetch
+    # thread and one that was taken by the push thread but not started.
+    assert max_waiting[0] <= 1 + 2 + 1
+    assert all(repo._repo is None for repo in repos)
+
+
+def test_repo_queue_pipeline_unexpected_error():
+    main_url = clone_this_repo().working_dir
+    clone_dir = Path(str(tempfile.mkdtemp(prefix="clone_dir")))
+    repos = [GitRepo(main_url, repo_dir=clone_dir / Path(
+        "{0}.git".format(number)), mirror_urls=[empty_repo().working_dir])
+        for number in range(4)]
+
+    def mirror_push():
+        raise OSError("disk full")
+    for repo in repos:
+        repo.mirror_push = mirror_push
+    done = []
+    repo_queue = RepoQueue(callback=done.append)
+    for repo in repos:
+        repo_queue.put(repo)
+    # A daemon thread, so a hang does not keep pytest from exiting.
+    thread = threading.Thread(target=repo_queue.process,
+                              args=(2,), kwargs={"push_threads": 1},
+                              daemon=True)
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive()
+    assert sorted(done, key=repos.index) == repos
+    assert all(repo.status == "failed" for repo in repos)
+    assert all(isinstance(repo.errors[0], OSError) for repo in repos)
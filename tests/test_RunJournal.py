@@ -0,0 +1,95 @@
+# Copyright (C) 2019 Leiden University Medical Center
+# This file is part of git-synchronizer
+#
+# git-synchronizer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# git-synchronizer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
+
+from pathlib import Path
+
+from git_synchronizer.git_synchronizer import (GitRepo, RunJournal,
+                                               mirror_repo)
+
+import pytest
+
+from . import clone_this_repo, empty_repo, mirror_with_engine
+
+
+def test_journal(tmpdir):
+    path = Path(str(tmpdir)) / Path("journal.sqlite")
+    journal = RunJournal(path)
+    assert not journal.start(resume=True)
+    journal.record("repo", "fetch", state="abc")
+    journal.record("repo", "push", mirror="mirror")
+    assert journal.completed("repo", "fetch")
+    assert journal.completed("repo", "fetch", state="abc")
+    assert not journal.completed("repo", "fetch", state="def")
+    assert journal.completed("repo", "push", mirror="mirror")
+    assert not journal.completed("repo", "push", mirror="other")
+
+    # The run was interrupted.
+    journal = RunJournal(path)
+    assert journal.start(resume=True)
+    assert journal.completed("repo", "fetch")
+    journal.finish()
+
+    journal = RunJournal(path)
+    assert not journal.start(resume=True)
+    assert not journal.completed("repo", "fetch")
+
+
+def test_journal_lock(tmpdir):
+    path = Path(str(tmpdir)) / Path("journal.sqlite")
+    with RunJournal(path).lock():
+        with pytest.raises(ValueError) as error:
+            with RunJournal(path).lock():
+                pass
+        error.match("Another run is using")
+    with RunJournal(path).lock():
+        pass
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_resume(tmpdir, engine):
+    main_url = list(clone_this_repo().remote().urls)[0]
+    mirror_urls = [empty_repo().working_dir, "/non/existing/mirror.git"]
+    repo_dir = Path(str(tmpdir)) / Path("repo.git")
+    path = Path(str(tmpdir)) / Path("journal.sqlite")
+    journal = RunJournal(path)
+    journal.start()
+    repo = GitRepo(main_url, repo_dir, mirror_urls=mirror_urls,
+                   journal=journal)
+    mirror_repo(repo)
+    assert repo.status == "failed"
+    assert journal.completed(main_url, "push", mirror_urls[0])
+
+    journal = RunJournal(path)
+    assert journal.start(resume=True)
+    repo = GitRepo(main_url, repo_dir, mirror_urls=mirror_urls,
+                   journal=journal)
+    mirror_with_engine(repo, engine)
+    # The fetch and the push to the first mirror were completed.
+    assert "fetch" not in repo.durations
+    assert mirror_urls[0] not in repo.mirror_metrics
+    assert repo.status == "failed"
+
+    repo.mirror_urls = mirror_urls[:1]
+    repo.mirrors = repo.mirrors[:1]
+    repo.errors = []
+    mirror_repo(repo)
+    assert repo.status == "synced"
+    assert journal.completed(main_url, "done")
+    repo = GitRepo(main_url, repo_dir, mirror_urls=mirror_urls[:1],
+                   journal=journal)
+    mirror_repo(repo)
+    assert repo.status == "skipped"
+    assert "check" not in repo.durations
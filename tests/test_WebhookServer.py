@@ -0,0 +1,124 @@
+# Copyright (C) 2019 Leiden University Medical Center
+# This file is part of git-synchronizer
+#
+# git-synchronizer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# git-synchronizer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
+
+import hashlib
+import hmac
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+from git_synchronizer.git_synchronizer import (Daemon, GitRepo,
+                                               WebhookServer, normalize_url)
+
+import pytest
+
+GITHUB_PAYLOAD = {
+    "ref": "refs/heads/master",
+    "repository": {
+        "clone_url": "https://github.com/LUMC/git-synchronizer.git",
+        "ssh_url": "git@github.com:LUMC/git-synchronizer.git"}}
+GITLAB_PAYLOAD = {
+    "object_kind": "push",
+    "project": {
+        "git_http_url": "https://gitlab.example.com/lumc/other.git",
+        "git_ssh_url": "git@gitlab.example.com:lumc/other.git"}}
+CONFIG = ("git@github.com:LUMC/git-synchronizer.git\tgit@mygit.com:a.git\n"
+          "https://gitlab.example.com/lumc/other\tgit@mygit.com:b.git\n")
+
+
+@pytest.fixture()
+def webhook_server(tmpdir):
+    config = Path(str(tmpdir)) / Path("config.tsv")
+    config.write_text(CONFIG)
+    daemon = Daemon(config, lambda source_url, mirror_urls, options: GitRepo(
+        source_url, repo_dir=Path(str(tmpdir)) / Path("repo.git"),
+        mirror_urls=mirror_urls))
+    daemon.reload_config()
+    server = WebhookServer(("127.0.0.1", 0), daemon, secret="s3cret")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, payload, headers):
+    request = urllib.request.Request(
+        "http://127.0.0.1:{0}/".format(server.server_address[1]),
+        data=json.dumps(payload).encode("utf-8"), headers=headers)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def github_headers(payload, secret="s3cret"):
+    signature = hmac.new(secret.encode("utf-8"),
+                         json.dumps(payload).encode("utf-8"),
+                         hashlib.sha256).hexdigest()
+    return {"X-Hub-Signature-256": "sha256=" + signature}
+
+
+def test_normalize_url():
+    assert (normalize_url("https://GitHub.com/LUMC/git-synchronizer.git") ==
+            normalize_url("git@github.com:LUMC/git-synchronizer.git") ==
+            normalize_url("ssh://git@github.com/LUMC/git-synchronizer/") ==
+            "github.com/LUMC/git-synchronizer")
+    assert normalize_url("/tmp/repo.git") == "tmp/repo"
+
+
+def test_webhook_github(webhook_server):
+    daemon = webhook_server.daemon
+    source_url = "git@github.com:LUMC/git-synchronizer.git"
+    # Not yet due.
+    daemon._entries[source_url] = (time.monotonic() + 100, 0)
+    assert post(webhook_server, GITHUB_PAYLOAD,
+                github_headers(GITHUB_PAYLOAD)) == 202
+    due, counter = daemon._entries[source_url]
+    assert due <= time.monotonic()
+    # A second event is merged with the first.
+    assert post(webhook_server, GITHUB_PAYLOAD,
+                github_headers(GITHUB_PAYLOAD)) == 202
+    assert daemon._entries[source_url] == (due, counter)
+
+
+def test_webhook_gitlab(webhook_server):
+    assert post(webhook_server, GITLAB_PAYLOAD,
+                {"X-Gitlab-Token": "s3cret"}) == 202
+
+
+def test_webhook_while_running(webhook_server):
+    daemon = webhook_server.daemon
+    source_url = "git@github.com:LUMC/git-synchronizer.git"
+    daemon._running.add(source_url)
+    assert post(webhook_server, GITHUB_PAYLOAD,
+                github_headers(GITHUB_PAYLOAD)) == 202
+    assert source_url in daemon._rerun
+
+
+def test_webhook_wrong_secret(webhook_server):
+    assert post(webhook_server, GITHUB_PAYLOAD,
+                github_headers(GITHUB_PAYLOAD, "wrong")) == 403
+    assert post(webhook_server, GITLAB_PAYLOAD,
+                {"X-Gitlab-Token": "wrong"}) == 403
+
+
+def test_webhook_unknown_repository(webhook_server):
+    payload = {"repository": {"clone_url": "https://example.com/x.git"}}
+    assert post(webhook_server, payload, github_headers(payload)) == 404
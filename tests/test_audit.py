@@ -0,0 +1,92 @@
+# Copyright (C) 2019 Leiden University Medical Center
+# This file is part of git-synchronizer
+#
+# git-synchronizer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# git-synchronizer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
+
+import io
+import json
+
+import git
+
+from git_synchronizer.git_synchronizer import audit_repos, ref_drift
+
+from . import clone_this_repo, empty_repo, new_git_repo
+
+
+def test_ref_drift():
+    source_refs = {"refs/heads/master": "a",
+                   "refs/heads/new": "b",
+                   "refs/tags/v1": "c",
+                   "refs/tags/v1^{}": "d",
+                   "HEAD": "a"}
+    target_refs = {"refs/heads/master": "a",
+                   "refs/heads/old": "e",
+                   "refs/tags/v1": "f",
+                   "refs/pull/1/head": "g"}
+    assert ref_drift(source_refs, target_refs) == {
+        "missing": ["refs/heads/new"],
+        "stale": ["refs/tags/v1"],
+        "extra": ["refs/heads/old"]}
+
+
+def test_audit():
+    origin = clone_this_repo()
+    git_repo = new_git_repo(str(origin.working_dir),
+                            [str(empty_repo().working_dir),
+                             str(empty_repo().working_dir)],
+                            mirror_threads=2)
+    git_repo.mirror()
+    assert git_repo.status == "synced"
+    report = git_repo.audit()
+    assert report["status"] == "in sync"
+    assert report["errors"] == {}
+    no_drift = {"missing": [], "stale": [], "extra": []}
+    assert report["clone"] == no_drift
+    assert report["mirrors"] == {url: no_drift
+                                 for url in git_repo.mirror_urls}
+
+    branch = origin.active_branch.name
+    origin.index.commit("A commit that is not mirrored yet")
+    origin.create_head("new")
+    mirror = git.Repo(git_repo.mirror_urls[0])
+    mirror.create_head("extra", mirror.heads[branch].commit)
+    report = git_repo.audit()
+    assert report["status"] == "drift"
+    assert report["clone"] == {"missing": ["refs/heads/new"],
+                               "stale": ["refs/heads/" + branch],
+                               "extra": []}
+    assert report["mirrors"][git_repo.mirror_urls[0]] == {
+        "missing": ["refs/heads/new"],
+        "stale": ["refs/heads/" + branch],
+        "extra": ["refs/heads/extra"]}
+    # The audit only reads.
+    assert "new" not in git_repo.branches
+
+
+def test_audit_repos():
+    in_sync = new_git_repo()
+    in_sync.mirror()
+    not_cloned = new_git_repo(mirror_threads=2)
+    not_cloned.mirror_urls.append("/non/existing/mirror.git")
+    output = io.StringIO()
+    assert not audit_repos([in_sync, not_cloned], 2, output)
+    reports = {report["repo"]: report for report in
+               map(json.loads, output.getvalue().splitlines())}
+    assert reports[in_sync.main_url]["status"] == "in sync"
+    report = reports[not_cloned.main_url]
+    assert report["status"] == "failed"
+    assert report["clone"] is None
+    assert list(report["errors"]) == ["/non/existing/mirror.git"]
+    assert report["mirrors"][not_cloned.mirror_urls[0]]["missing"]
+    assert not not_cloned.repo_dir.exists()
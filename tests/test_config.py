@@ -16,7 +16,9 @@
 
 from pathlib import Path
 
-from git_synchronizer.git_synchronizer import parse_config
+from git_synchronizer.git_synchronizer import iter_config, parse_config
+
+import pytest
 
 EXAMPLE_CONFIG = Path(__file__).parent.parent / Path("example_config.tsv")
 
@@ -25,7 +27,50 @@ def test_config_parsing():
     config = parse_config(EXAMPLE_CONFIG)
     assert len(config) == 2
     assert config[0] == ("https://example.com/examples/example.git",
-                         ["git@mygit.com:/examples/example.git"])
+                         ["git@mygit.com:/examples/example.git"], {})
     assert config[1] == ("https://example.com/examples/example2.git",
                          ["git@mygit.com:/examples/example2.git",
-                          "git@myothergit.com/example/example2.git"])
+                          "git@myothergit.com/example/example2.git"], {})
+
+
+def test_iter_config(tmpdir):
+    config = Path(str(tmpdir)) / Path("config.tsv")
+    config.write_text("https://example.com/examples/example.git\n"
+                      "https://example.com/examples/example2.git\t"
+                      "colour=blue\n")
+    entries = iter_config(config)
+    # Lines are parsed one at a time, so an error in a later line is only
+    # raised when it is reached.
+    assert next(entries) == ("https://example.com/examples/example.git",
+                             [], {})
+    with pytest.raises(ValueError):
+        next(entries)
+
+
+def test_config_options(tmpdir):
+    config = Path(str(tmpdir)) / Path("config.tsv")
+    config.write_text("https://example.com/examples/example.git\t"
+                      "group=examples\t"
+                      "git@mygit.com:/examples/example.git\n")
+    assert parse_config(config) == [
+        ("https://example.com/examples/example.git",
+         ["git@mygit.com:/examples/example.git"], {"group": "examples"})]
+
+
+def test_config_unknown_option(tmpdir):
+    config = Path(str(tmpdir)) / Path("config.tsv")
+    config.write_text("https://example.com/examples/example.git\t"
+                      "colour=blue\n")
+    with pytest.raises(ValueError) as error:
+        parse_config(config)
+    error.match("Unknown option 'colour'")
+
+
+def test_config_invalid_ref_pattern(tmpdir):
+    config = Path(str(tmpdir)) / Path("config.tsv")
+    config.write_text("https://example.com/examples/example.git\t"
+                      "exclude=refs/pull/*,refs/heads/wip-?\n")
+    with pytest.raises(ValueError) as error:
+        parse_config(config)
+    error.match("Invalid ref pattern 'refs/heads/wip-\\?'.* for "
+                "https://example.com/examples/example.git")
@@ -69,3 +69,29 @@ def test_main():
     assert repo_clone.bare
     assert len(one.branches) > 0
     assert len(two.branches) > 0
+
+
+def test_main_invalid_ref_pattern(capsys):
+    sys.argv = [
+        "git-synchronizer",
+        "--clone-dir", str(tempfile.mkdtemp(prefix="clonedir")),
+        "--config", str(config_file()),
+        "--exclude-refs", "refs/pull/*,refs/heads/wip-?",
+    ]
+    with pytest.raises(SystemExit):
+        main()
+    assert "Invalid ref pattern 'refs/heads/wip-?'" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("metrics_option", ["--metrics-prometheus",
+                                            "--metrics-json"])
+def test_main_daemon_metrics(capsys, metrics_option):
+    sys.argv = [
+        "git-synchronizer",
+        "--clone-dir", str(tempfile.mkdtemp(prefix="clonedir")),
+        "--config", str(config_file()),
+        "--daemon", metrics_option, "metrics",
+    ]
+    with pytest.raises(SystemExit):
+        main()
+    assert "can not be used with --daemon" in capsys.readouterr().err
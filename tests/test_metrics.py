@@ -0,0 +1,117 @@
+# Copyright (C) 2019 Leiden University Medical Center
+# This file is part of git-synchronizer
+#
+# git-synchronizer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# git-synchronizer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
+
+import json
+from pathlib import Path
+
+from git_synchronizer.git_synchronizer import (AsyncRepoQueue, RepoQueue,
+                                               RunSummary,
+                                               TransferProgress,
+                                               write_prometheus_samples)
+
+import pytest
+
+from . import clone_this_repo, file_url, new_git_repo
+
+
+def test_transfer_progress():
+    progress = TransferProgress()
+    progress.parse_output(
+        "Counting objects: 100% (93/93), done.\n"
+        "Receiving objects:  50% (46/93)\r"
+        "Receiving objects: 100% (93/93), 1.50 MiB | 6.09 MiB/s, done.\n"
+        " * [new branch]      master     -> master\n")
+    assert progress.objects == 93
+    assert progress.bytes == 1.5 * 1024 ** 2
+    assert " * [new branch]      master     -> master" in progress.other_lines
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_metrics(engine):
+    git_repo = new_git_repo(file_url(clone_this_repo()))
+    repo_queue = AsyncRepoQueue() if engine == "asyncio" else RepoQueue()
+    repo_queue.put(git_repo)
+    repo_queue.process(1)
+    assert git_repo.status == "synced"
+    assert git_repo.metrics["received_objects"] > 0
+    assert git_repo.metrics["received_bytes"] > 0
+    assert set(git_repo.durations) == {"check", "clone", "fetch", "push",
+                                       "total"}
+    mirror_metrics = git_repo.mirror_metrics[git_repo.mirror_urls[0]]
+    assert mirror_metrics["sent_objects"] > 0
+    assert mirror_metrics["pushed_refs"] > 0
+    assert mirror_metrics["push_duration_seconds"] > 0
+
+
+def test_write_prometheus_and_json(tmpdir):
+    git_repo = new_git_repo(file_url(clone_this_repo()))
+    git_repo.main_url = 'https://example.com/"quoted".git'
+    git_repo.status = "synced"
+    git_repo.durations = {"fetch": 1.5}
+    git_repo.metrics = {"received_bytes": 1024}
+    git_repo.mirror_metrics = {"git@mygit.com:a.git": {"pushed_refs": 2}}
+    json_file = Path(str(tmpdir)) / Path("metrics.jsonl")
+    summary = RunSummary(metrics_json=json_file, prometheus=True)
+    summary.add(git_repo)
+    prometheus_file = Path(str(tmpdir)) / Path("git_synchronizer.prom")
+    assert summary.prometheus_samples is not None
+    write_prometheus_samples(summary.prometheus_samples, prometheus_file,
+                             run_duration=3.0)
+    lines = prometheus_file.read_text().splitlines()
+    repo_label = 'repo="https://example.com/\\"quoted\\".git"'
+    assert ('git_synchronizer_phase_duration_seconds{phase="fetch",' +
+            repo_label + '} 1.5') in lines
+    assert 'git_synchronizer_received_bytes{' + repo_label + '} 1024' in lines
+    assert ('git_synchronizer_pushed_refs{mirror="git@mygit.com:a.git",' +
+            repo_label + '} 2') in lines
+    assert ('git_synchronizer_status{' + repo_label + ',status="synced"} 1'
+            in lines)
+    assert "git_synchronizer_run_duration_seconds 3.0" in lines
+    assert "# TYPE git_synchronizer_sent_bytes gauge" not in lines
+
+    # The metrics of every run are appended.
+    RunSummary(metrics_json=json_file).add(git_repo)
+    records = [json.loads(line) for line in
+               json_file.read_text().splitlines()]
+    assert len(records) == 2
+    assert records[0]["mirrors"] == git_repo.mirror_metrics
+    assert records[0]["durations"] == {"fetch": 1.5}
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_run_summary(tmpdir, capsys, engine):
+    json_file = Path(str(tmpdir)) / Path("metrics.jsonl")
+    summary = RunSummary(metrics_json=json_file, prometheus=True)
+    repo_queue = (AsyncRepoQueue(callback=summary.add) if engine == "asyncio"
+                  else RepoQueue(callback=summary.add))
+    git_repos = [new_git_repo(file_url(clone_this_repo())),
+                 new_git_repo(file_url(clone_this_repo()))]
+    git_repos[1].mirror_urls.append("/non/existing/mirror.git")
+    for git_repo in git_repos:
+        repo_queue.put(git_repo)
+    repo_queue.process(2)
+    assert sorted(capsys.readouterr().out.splitlines()) == sorted(
+        "{0}\t{1}".format(status, git_repo.main_url)
+        for status, git_repo in zip(["synced", "failed"], git_repos))
+    assert len(summary.errors) == 1
+    assert len(json_file.read_text().splitlines()) == 2
+    prometheus_file = Path(str(tmpdir)) / Path("git_synchronizer.prom")
+    assert summary.prometheus_samples is not None
+    write_prometheus_samples(summary.prometheus_samples, prometheus_file)
+    assert len([line for line in prometheus_file.read_text().splitlines()
+                if line.startswith("git_synchronizer_status{")]) == 2
+    # The clones were closed when the repos were done.
+    assert all(git_repo._repo is None for git_repo in git_repos)
@@ -0,0 +1,68 @@
+# Copyright (C) 2019 Leiden University Medical Center
+# This file is part of git-synchronizer
+#
+# git-synchronizer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# git-synchronizer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
+
+import sys
+from pathlib import Path
+
+from git_synchronizer.git_synchronizer import Daemon, main, shard_of
+
+URLS = ["https://example.com/group/repo{0}.git".format(number)
+        for number in range(200)]
+
+
+def test_shard_of_normalized_url():
+    assert shard_of("https://example.com/group/repo.git", 5) == shard_of(
+        "git@example.com:group/repo", 5)
+
+
+def test_shard_of_all_shards_used():
+    shards = [shard_of(url, 4) for url in URLS]
+    assert set(shards) == {0, 1, 2, 3}
+    assert max(shards.count(shard) for shard in range(4)) < 80
+
+
+def test_shard_of_adding_shard_moves_only_to_new_shard():
+    for url in URLS:
+        old_shard = shard_of(url, 4)
+        new_shard = shard_of(url, 5)
+        assert new_shard in (old_shard, 4)
+    moved = sum(1 for url in URLS if shard_of(url, 5) == 4)
+    assert 0 < moved < 80
+
+
+def test_print_shards(tmpdir, capsys):
+    config = Path(str(tmpdir)) / Path("config.tsv")
+    config.write_text("".join(url + "\tgit@mygit.com:/mirror.git\n"
+                              for url in URLS[:10]))
+    sys.argv = ["git-synchronizer", "--config", str(config),
+                "--shard-count", "3", "--print-shards"]
+    main()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines == ["{0}\t{1}".format(shard_of(url, 3), url)
+                     for url in URLS[:10]]
+
+
+def test_daemon_shard(tmpdir):
+    config = Path(str(tmpdir)) / Path("config.tsv")
+    config.write_text("".join(url + "\n" for url in URLS[:10]))
+    mirrored = []
+    for shard_index in range(3):
+        daemon = Daemon(config, lambda source_url, mirror_urls, options: None,
+                        shard_index=shard_index, shard_count=3)
+        daemon.reload_config()
+        assert all(shard_of(url, 3) == shard_index for url in daemon.repos)
+        mirrored.extend(daemon.repos)
+    assert sorted(mirrored) == sorted(URLS[:10])
@@ -0,0 +1,112 @@
+# Copyright (C) 2019 Leiden University Medical Center
+# This file is part of git-synchronizer
+#
+# git-synchronizer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# git-synchronizer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with git-synchronizer.  If not, see <https://www.gnu.org/licenses/
+
+import argparse
+import os
+import socket
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from git_synchronizer.git_synchronizer import (GitRepo, OperationTimeout,
+                                               environment,
+                                               low_speed_environment,
+                                               parse_timeout)
+
+import pytest
+
+from . import clone_this_repo, empty_repo, mirror_with_engine
+
+
+@pytest.fixture()
+def hanging_url():
+    """A git:// url of a server that accepts connections but never answers."""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(8)
+    connections = []
+
+    def accept():
+        while True:
+            try:
+                connections.append(server.accept()[0])
+            except OSError:
+                break
+
+    threading.Thread(target=accept, daemon=True).start()
+    yield "git://127.0.0.1:{0}/repo.git".format(server.getsockname()[1])
+    server.close()
+    for connection in connections:
+        connection.close()
+
+
+def test_parse_timeout():
+    assert parse_timeout("fetch=1.5") == ("fetch", 1.5)
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_timeout("download=1")
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_timeout("fetch=soon")
+
+
+def test_low_speed_environment(monkeypatch):
+    monkeypatch.setenv("GIT_SSH_COMMAND", "ssh -i key")
+    monkeypatch.delenv("GIT_HTTP_LOW_SPEED_LIMIT", raising=False)
+    variables = low_speed_environment(1000, 30)
+    assert variables["GIT_SSH_COMMAND"] == (
+        "ssh -i key -o ServerAliveInterval=10 -o ServerAliveCountMax=3")
+    with environment(variables):
+        assert os.environ["GIT_HTTP_LOW_SPEED_LIMIT"] == "1000"
+        assert os.environ["GIT_HTTP_LOW_SPEED_TIME"] == "30"
+    assert "GIT_HTTP_LOW_SPEED_LIMIT" not in os.environ
+    assert os.environ["GIT_SSH_COMMAND"] == "ssh -i key"
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+@pytest.mark.parametrize("phase", ["check", "clone"])
+def test_source_timeout(hanging_url, engine, phase):
+    repo_dir = Path(tempfile.mkdtemp(prefix="clone_dir")) / Path("repo.git")
+    repo = GitRepo(hanging_url, repo_dir, use_fingerprint=phase == "check",
+                   timeouts={phase: 0.5})
+    start = time.monotonic()
+    mirror_with_engine(repo, engine)
+    assert time.monotonic() - start < 10
+    assert repo.status == "failed"
+    assert [type(error) for error in repo.errors] == [OperationTimeout]
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_fetch_timeout(hanging_url, engine):
+    repo_dir = Path(tempfile.mkdtemp(prefix="clone_dir")) / Path("repo.git")
+    GitRepo(clone_this_repo().working_dir, repo_dir).clone()
+    repo = GitRepo(hanging_url, repo_dir, use_fingerprint=False,
+                   timeouts={"fetch": 0.5})
+    mirror_with_engine(repo, engine)
+    assert repo.status == "failed"
+    assert [type(error) for error in repo.errors] == [OperationTimeout]
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_push_timeout(hanging_url, engine):
+    repo_dir = Path(tempfile.mkdtemp(prefix="clone_dir")) / Path("repo.git")
+    repo = GitRepo(clone_this_repo().working_dir, repo_dir,
+                   mirror_urls=[empty_repo().working_dir, hanging_url],
+                   mirror_threads=2, timeouts={"push": 0.5})
+    mirror_with_engine(repo, engine)
+    assert repo.status == "failed"
+    assert [type(error) for error in repo.errors] == [OperationTimeout]
+    # The other mirror was updated.
+    assert repo.mirror_metrics[repo.mirror_urls[0]]["pushed_refs"] > 0